@@ -0,0 +1,11 @@
+-- Expression index on the customer and space of hosted adjuncts, parsed from "AssetId" ({customer}/{space}/{id}).
+-- The customer storage recalculator looks for this index by name. The expressions and predicate match the ones it
+-- uses to count adjuncts, so batched runs can scan a customer range from the index rather than parsing every row,
+-- and ANALYZE keeps statistics on the parsed keys, so the planner can estimate the adjunct join properly.
+-- Every hosted adjunct's AssetId must start with a numeric customer and space for the index to build.
+-- Run outside a transaction, as CREATE INDEX CONCURRENTLY does not block writes to "Adjuncts" while it builds.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS "IX_Adjuncts_Customer_Space"
+    ON "Adjuncts" ((CAST(split_part("AssetId", '/', 1) AS integer)), (CAST(split_part("AssetId", '/', 2) AS integer)))
+    WHERE "Origin" IS NOT NULL AND "Origin" != '';
+
+ANALYZE "Adjuncts";
@@ -0,0 +1,35 @@
+-- Per-space aggregate caches used with AGGREGATE_CACHE=True
+-- Each table holds the per-space aggregates a recalculator would otherwise compute from every image on each run.
+-- The recalculators refresh them from the change log (sql/create_change_log.sql must be run first), recomputing only
+-- the spaces logged since the cache's own watermark, and read their totals from them.
+CREATE TABLE "CustomerStorageSpaceAggregates" (
+    "Customer"                                 integer NOT NULL,
+    "Space"                                    integer NOT NULL,
+    "TotalSizeInImageStorageTable"             numeric,
+    "NumberOfImagesInImageStorageTable"        bigint,
+    "TotalSizeOfThumbnailsInImageStorageTable" numeric,
+    "TotalAdjunctSizeInImageStorageTable"      numeric,
+    "NumberOfAdjunctsInAdjunctsTable"          bigint,
+    PRIMARY KEY ("Customer", "Space")
+);
+
+CREATE TABLE "EntityCounterSpaceAggregates" (
+    count    bigint,
+    space    integer NOT NULL,
+    customer integer NOT NULL,
+    PRIMARY KEY (customer, space)
+);
+
+-- The entity counter cache is refreshed from changes to "Images", which the change log does not record otherwise.
+-- Images are only counted, so an update is logged only when it moves an image to another customer or space
+CREATE TRIGGER "Images_log_insert" AFTER INSERT ON "Images"
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION log_space_changes();
+CREATE TRIGGER "Images_log_update" AFTER UPDATE ON "Images"
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION log_space_changes();
+CREATE TRIGGER "Images_log_delete" AFTER DELETE ON "Images"
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION log_space_changes();
+
+GRANT SELECT, INSERT, DELETE ON "CustomerStorageSpaceAggregates" TO customerstoragerecalc_user;
+GRANT SELECT, INSERT, DELETE ON "EntityCounterSpaceAggregates" TO entitycounterrecalc_user;
+GRANT SELECT, DELETE ON "RecalculatorChangeLog" TO entitycounterrecalc_user;
+GRANT SELECT, INSERT, UPDATE ON "RecalculatorWatermarks" TO entitycounterrecalc_user;
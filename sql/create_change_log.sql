@@ -0,0 +1,99 @@
+-- Change log used by incremental recalculation (INCREMENTAL=True)
+-- Statement-level triggers record each distinct (Customer, Space) touched by a statement, along with the
+-- id of the writing transaction. Recalculators store the oldest in-progress transaction id as their
+-- watermark after each run and recompute only the spaces logged since then.
+CREATE TABLE "RecalculatorChangeLog" (
+    "Id"            bigserial PRIMARY KEY,
+    "Source"        varchar(100) NOT NULL,
+    "Customer"      integer NOT NULL,
+    "Space"         integer NOT NULL,
+    "TransactionId" bigint NOT NULL DEFAULT txid_current(),
+    "Changed"       timestamp NOT NULL DEFAULT now()
+);
+CREATE INDEX "IX_RecalculatorChangeLog_Source_TransactionId"
+    ON "RecalculatorChangeLog" ("Source", "TransactionId");
+
+CREATE TABLE "RecalculatorWatermarks" (
+    "Recalculator"  varchar(100) PRIMARY KEY,
+    "TransactionId" bigint NOT NULL,
+    "LastRun"       timestamp NOT NULL,
+    "LastFullRun"   timestamp NOT NULL
+);
+
+-- Log changes to tables with "Customer" and "Space" columns.
+-- An update only changes a space's aggregates when it changes "Customer", "Space" or one of the aggregated columns
+-- named by the trigger's arguments. Rows whose other columns alone were updated, e.g. "LastChecked", are the same in
+-- both transition tables and cancel out, so bookkeeping updates log nothing.
+CREATE OR REPLACE FUNCTION log_space_changes() RETURNS trigger
+    LANGUAGE plpgsql SECURITY DEFINER SET search_path = pg_catalog, public, pg_temp AS $$
+DECLARE
+    aggregated text := '"Customer", "Space"';
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO "RecalculatorChangeLog" ("Source", "Customer", "Space")
+        SELECT DISTINCT TG_TABLE_NAME, "Customer", "Space" FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO "RecalculatorChangeLog" ("Source", "Customer", "Space")
+        SELECT DISTINCT TG_TABLE_NAME, "Customer", "Space" FROM old_rows;
+    ELSE
+        FOR i IN 0 .. TG_NARGS - 1 LOOP
+            aggregated := aggregated || ', ' || quote_ident(TG_ARGV[i]);
+        END LOOP;
+        EXECUTE format('
+            INSERT INTO "RecalculatorChangeLog" ("Source", "Customer", "Space")
+            SELECT DISTINCT %1$L, "Customer", "Space"
+            FROM ((SELECT %2$s FROM new_rows EXCEPT ALL SELECT %2$s FROM old_rows)
+                  UNION ALL
+                  (SELECT %2$s FROM old_rows EXCEPT ALL SELECT %2$s FROM new_rows)) AS changed',
+            TG_TABLE_NAME, aggregated);
+    END IF;
+    RETURN NULL;
+END $$;
+
+-- Log changes to Adjuncts, whose customer and space are parsed from AssetId ({customer}/{space}/{id}).
+-- AssetIds that do not start with a numeric customer and space are skipped rather than failing the write.
+-- Like log_space_changes, an update is only logged when it changes the columns adjuncts are counted by.
+CREATE OR REPLACE FUNCTION log_adjunct_changes() RETURNS trigger
+    LANGUAGE plpgsql SECURITY DEFINER SET search_path = pg_catalog, public, pg_temp AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO "RecalculatorChangeLog" ("Source", "Customer", "Space")
+        SELECT DISTINCT TG_TABLE_NAME,
+               CAST(split_part("AssetId", '/', 1) AS integer), CAST(split_part("AssetId", '/', 2) AS integer)
+        FROM new_rows
+        WHERE "AssetId" ~ '^[0-9]+/[0-9]+/';
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO "RecalculatorChangeLog" ("Source", "Customer", "Space")
+        SELECT DISTINCT TG_TABLE_NAME,
+               CAST(split_part("AssetId", '/', 1) AS integer), CAST(split_part("AssetId", '/', 2) AS integer)
+        FROM old_rows
+        WHERE "AssetId" ~ '^[0-9]+/[0-9]+/';
+    ELSE
+        INSERT INTO "RecalculatorChangeLog" ("Source", "Customer", "Space")
+        SELECT DISTINCT TG_TABLE_NAME,
+               CAST(split_part("AssetId", '/', 1) AS integer), CAST(split_part("AssetId", '/', 2) AS integer)
+        FROM ((SELECT "AssetId", "Origin" FROM new_rows EXCEPT ALL SELECT "AssetId", "Origin" FROM old_rows)
+              UNION ALL
+              (SELECT "AssetId", "Origin" FROM old_rows EXCEPT ALL SELECT "AssetId", "Origin" FROM new_rows)) AS changed
+        WHERE "AssetId" ~ '^[0-9]+/[0-9]+/';
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER "ImageStorage_log_insert" AFTER INSERT ON "ImageStorage"
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION log_space_changes();
+CREATE TRIGGER "ImageStorage_log_update" AFTER UPDATE ON "ImageStorage"
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT
+    EXECUTE FUNCTION log_space_changes('Size', 'ThumbnailSize', 'AdjunctSize');
+CREATE TRIGGER "ImageStorage_log_delete" AFTER DELETE ON "ImageStorage"
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION log_space_changes();
+
+CREATE TRIGGER "Adjuncts_log_insert" AFTER INSERT ON "Adjuncts"
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION log_adjunct_changes();
+CREATE TRIGGER "Adjuncts_log_update" AFTER UPDATE ON "Adjuncts"
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION log_adjunct_changes();
+CREATE TRIGGER "Adjuncts_log_delete" AFTER DELETE ON "Adjuncts"
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION log_adjunct_changes();
+
+GRANT SELECT, DELETE ON "RecalculatorChangeLog" TO customerstoragerecalc_user;
+GRANT SELECT, INSERT, UPDATE ON "RecalculatorWatermarks" TO customerstoragerecalc_user;
@@ -0,0 +1,85 @@
+-- Notifications used by listener mode (LISTEN=True)
+-- Statement-level triggers send a notification on the recalculator_changes channel for each distinct
+-- (Customer, Space) touched by a statement, with a "{source}/{customer}/{space}" payload. Notifications are only
+-- delivered when the writing transaction commits, and identical ones sent by the same transaction are delivered
+-- once, so a bulk write to one space sends a single notification.
+-- Recalculators listening on the channel recompute just the notified spaces.
+
+-- Notify changes to tables with "Customer" and "Space" columns. Like log_space_changes (sql/create_change_log.sql),
+-- an update only notifies the spaces whose "Customer", "Space" or aggregated columns, named by the trigger's
+-- arguments, it changed, so bookkeeping updates such as "LastChecked" send nothing.
+CREATE OR REPLACE FUNCTION notify_space_changes() RETURNS trigger
+    LANGUAGE plpgsql SECURITY DEFINER SET search_path = pg_catalog, public, pg_temp AS $$
+DECLARE
+    aggregated text := '"Customer", "Space"';
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('recalculator_changes', TG_TABLE_NAME || '/' || "Customer" || '/' || "Space")
+        FROM (SELECT DISTINCT "Customer", "Space" FROM new_rows) AS changed;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('recalculator_changes', TG_TABLE_NAME || '/' || "Customer" || '/' || "Space")
+        FROM (SELECT DISTINCT "Customer", "Space" FROM old_rows) AS changed;
+    ELSE
+        FOR i IN 0 .. TG_NARGS - 1 LOOP
+            aggregated := aggregated || ', ' || quote_ident(TG_ARGV[i]);
+        END LOOP;
+        EXECUTE format('
+            SELECT pg_notify(''recalculator_changes'', %1$L || ''/'' || "Customer" || ''/'' || "Space")
+            FROM (SELECT DISTINCT "Customer", "Space"
+                  FROM ((SELECT %2$s FROM new_rows EXCEPT ALL SELECT %2$s FROM old_rows)
+                        UNION ALL
+                        (SELECT %2$s FROM old_rows EXCEPT ALL SELECT %2$s FROM new_rows)) AS rows) AS changed',
+            TG_TABLE_NAME, aggregated);
+    END IF;
+    RETURN NULL;
+END $$;
+
+-- Notify changes to Adjuncts, whose customer and space are parsed from AssetId ({customer}/{space}/{id}).
+-- AssetIds that do not start with a numeric customer and space are skipped rather than failing the write.
+-- An update only notifies the spaces whose adjuncts it changed the "AssetId" or "Origin" of.
+CREATE OR REPLACE FUNCTION notify_adjunct_changes() RETURNS trigger
+    LANGUAGE plpgsql SECURITY DEFINER SET search_path = pg_catalog, public, pg_temp AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('recalculator_changes', TG_TABLE_NAME || '/' || customer_space)
+        FROM (SELECT DISTINCT substring("AssetId" FROM '^([0-9]+/[0-9]+)/') AS customer_space
+              FROM new_rows
+              WHERE "AssetId" ~ '^[0-9]+/[0-9]+/') AS changed;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('recalculator_changes', TG_TABLE_NAME || '/' || customer_space)
+        FROM (SELECT DISTINCT substring("AssetId" FROM '^([0-9]+/[0-9]+)/') AS customer_space
+              FROM old_rows
+              WHERE "AssetId" ~ '^[0-9]+/[0-9]+/') AS changed;
+    ELSE
+        PERFORM pg_notify('recalculator_changes', TG_TABLE_NAME || '/' || customer_space)
+        FROM (SELECT DISTINCT substring("AssetId" FROM '^([0-9]+/[0-9]+)/') AS customer_space
+              FROM ((SELECT "AssetId", "Origin" FROM new_rows EXCEPT ALL SELECT "AssetId", "Origin" FROM old_rows)
+                    UNION ALL
+                    (SELECT "AssetId", "Origin" FROM old_rows EXCEPT ALL SELECT "AssetId", "Origin" FROM new_rows))
+                   AS rows
+              WHERE "AssetId" ~ '^[0-9]+/[0-9]+/') AS changed;
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER "Images_notify_insert" AFTER INSERT ON "Images"
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_space_changes();
+CREATE TRIGGER "Images_notify_update" AFTER UPDATE ON "Images"
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_space_changes();
+CREATE TRIGGER "Images_notify_delete" AFTER DELETE ON "Images"
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_space_changes();
+
+CREATE TRIGGER "ImageStorage_notify_insert" AFTER INSERT ON "ImageStorage"
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_space_changes();
+CREATE TRIGGER "ImageStorage_notify_update" AFTER UPDATE ON "ImageStorage"
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT
+    EXECUTE FUNCTION notify_space_changes('Size', 'ThumbnailSize', 'AdjunctSize');
+CREATE TRIGGER "ImageStorage_notify_delete" AFTER DELETE ON "ImageStorage"
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_space_changes();
+
+CREATE TRIGGER "Adjuncts_notify_insert" AFTER INSERT ON "Adjuncts"
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_adjunct_changes();
+CREATE TRIGGER "Adjuncts_notify_update" AFTER UPDATE ON "Adjuncts"
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_adjunct_changes();
+CREATE TRIGGER "Adjuncts_notify_delete" AFTER DELETE ON "Adjuncts"
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_adjunct_changes();
@@ -0,0 +1,24 @@
+-- Checkpoints used by resumable full recalculations (CHECKPOINT=True)
+-- A full run adds its recalculator's row when it starts, and each customer batch it commits adds its range to
+-- "RecalculatorCheckpointScopes" in the batch's own transaction. Batches run in parallel commit out of order, so a
+-- run that is stopped or killed part way through is resumed from the gaps between the recorded ranges. The rows are
+-- removed once a run completes. TransactionId is the change log watermark taken when the run started.
+CREATE TABLE "RecalculatorCheckpoints" (
+    "Recalculator"  varchar(100) PRIMARY KEY,
+    "RunId"         uuid NOT NULL UNIQUE,
+    "TransactionId" bigint NOT NULL,
+    "Started"       timestamp NOT NULL
+);
+
+CREATE TABLE "RecalculatorCheckpointScopes" (
+    "RunId"        uuid NOT NULL REFERENCES "RecalculatorCheckpoints" ("RunId") ON DELETE CASCADE,
+    "CustomerFrom" bigint NOT NULL,
+    "CustomerTo"   bigint NOT NULL,
+    "Completed"    timestamp NOT NULL,
+    PRIMARY KEY ("RunId", "CustomerFrom")
+);
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON "RecalculatorCheckpoints" TO customerstoragerecalc_user;
+GRANT SELECT, INSERT, UPDATE, DELETE ON "RecalculatorCheckpoints" TO entitycounterrecalc_user;
+GRANT SELECT, INSERT, DELETE ON "RecalculatorCheckpointScopes" TO customerstoragerecalc_user;
+GRANT SELECT, INSERT, DELETE ON "RecalculatorCheckpointScopes" TO entitycounterrecalc_user;
@@ -0,0 +1,51 @@
+from logzero import logger
+
+# SQL expressions for an adjunct's customer and space, by how they can be read from "Adjuncts":
+#   columns - integer "Customer" and "Space" columns, e.g. generated from "AssetId"
+#   index   - the key expressions of the expression index created by sql/create_adjunct_key_index.sql, read back
+#             from the index itself, so the planner can match them to the index and its statistics
+#   parse   - parsed from "AssetId" ({customer}/{space}/{id}) with no index to help, the fallback
+ADJUNCT_KEYS = {
+    "columns": ('"Adjuncts"."Customer"', '"Adjuncts"."Space"'),
+    "parse": ("CAST(split_part(\"AssetId\", '/', 1) AS integer)", "CAST(split_part(\"AssetId\", '/', 2) AS integer)")
+}
+ADJUNCT_KEY_INDEX = "IX_Adjuncts_Customer_Space"
+
+
+def get_adjunct_keys(conn) -> tuple:
+    """Find the cheapest way to read the customer and space of each adjunct, and return the SQL expressions
+    for them as a (customer, space) tuple"""
+    cur = conn.cursor()
+    cur.execute("""
+        WITH adjunct_key_index AS (
+            SELECT indexrelid
+            FROM pg_index
+            WHERE indexrelid = to_regclass(quote_ident(%(index)s))
+              AND indrelid = to_regclass('"Adjuncts"')
+              AND indisvalid
+        )
+        SELECT CASE
+                   WHEN (SELECT COUNT(*)
+                         FROM information_schema.columns
+                         WHERE table_schema = current_schema()
+                           AND table_name = 'Adjuncts'
+                           AND column_name IN ('Customer', 'Space')
+                           AND data_type = 'integer') = 2 THEN 'columns'
+                   WHEN EXISTS (SELECT 1 FROM adjunct_key_index) THEN 'index'
+                   ELSE 'parse'
+               END AS "AdjunctKeys",
+               (SELECT pg_get_indexdef(indexrelid, 1, true) FROM adjunct_key_index) AS "IndexedCustomer",
+               (SELECT pg_get_indexdef(indexrelid, 2, true) FROM adjunct_key_index) AS "IndexedSpace";
+        """, {"index": ADJUNCT_KEY_INDEX})
+    row = cur.fetchone()
+    cur.close()
+
+    adjunct_keys = row[0]
+    if adjunct_keys == "index":
+        keys = (row[1], row[2])
+    else:
+        adjunct_keys = adjunct_keys if adjunct_keys in ADJUNCT_KEYS else "parse"
+        keys = ADJUNCT_KEYS[adjunct_keys]
+
+    logger.info(f"Reading adjunct customer and space keys using {adjunct_keys}")
+    return keys
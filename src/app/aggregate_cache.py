@@ -0,0 +1,73 @@
+import psycopg2
+from psycopg2 import extras
+from logzero import logger
+
+from app.batching import get_recalculation_scope
+from app.change_log import get_watermark, get_current_watermark, get_changed_spaces, set_watermark, prune_change_log
+from app.phases import timed_phase, explain_phase
+
+# The cache tables are created by sql/create_aggregate_cache.sql.
+
+
+def refresh_aggregate_cache(conn, phases: dict, cache_table: str, key_columns: tuple, aggregate_query: str,
+                            sources: list, full_refresh_interval_hours: int, consumers: list, explain: bool) -> int:
+    """Bring a per-space aggregate cache up to date, and commit it.
+
+    aggregate_query computes the cache's rows, in the order of the table's columns, for the spaces in a recalculation
+    scope. Only the spaces logged for the given source tables since the cache's watermark are recomputed, replacing
+    their rows keyed on key_columns (customer, space). The whole cache is rebuilt when it has no watermark yet, or
+    when its last full refresh is older than full_refresh_interval_hours. Change log entries the cache has
+    processed are then pruned, unless one of the other consumers has not processed them yet.
+
+    The refresh is timed as an AggregateCacheRefresh phase. Returns the number of spaces recomputed, or None after a
+    full rebuild."""
+    watermark = get_watermark(conn, cache_table, full_refresh_interval_hours)
+    new_watermark = get_current_watermark(conn)
+    full_refresh = watermark is None or watermark["FullRunDue"]
+    changed_spaces = None if full_refresh else get_changed_spaces(conn, sources, watermark["TransactionId"])
+
+    if full_refresh:
+        logger.info(f"Rebuilding aggregate cache {cache_table}")
+        delete_query = 'DELETE FROM "{cache}";'.format(cache=cache_table)
+    else:
+        logger.info(f"Refreshing {len(changed_spaces)} changed spaces in aggregate cache {cache_table}")
+        delete_query = """
+            DELETE FROM "{cache}"
+            WHERE ("{customer}", "{space}") IN (SELECT * FROM unnest(%(space_customers)s::int[], %(space_spaces)s::int[]));
+            """.format(cache=cache_table, customer=key_columns[0], space=key_columns[1])
+    insert_query = 'INSERT INTO "{cache}" {aggregates};'.format(cache=cache_table, aggregates=aggregate_query)
+    params = get_recalculation_scope(spaces=changed_spaces)
+
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    if full_refresh or changed_spaces:
+        with timed_phase(conn, cur, phases, "AggregateCacheRefresh", cache_table, insert_query,
+                         params, explain=False):
+            cur.execute(delete_query, params)
+            # the insert can only be explained once the rows it replaces are deleted
+            if explain:
+                explain_phase(conn, "AggregateCacheRefresh", insert_query, params)
+            cur.execute(insert_query, params)
+    cur.close()
+
+    set_watermark(conn, cache_table, new_watermark, full_run=full_refresh)
+    prune_change_log(conn, sources, new_watermark, consumers)
+    conn.commit()
+
+    return None if full_refresh else len(changed_spaces)
+
+
+def get_cached_aggregates_query(cache_table: str, key_columns: tuple) -> str:
+    """A query for the cached aggregates of the spaces in a recalculation scope, in the place of the query the
+    cache was filled from"""
+    return """
+        SELECT *
+        FROM "{cache}"
+        WHERE "{customer}" BETWEEN %(customer_from)s AND %(customer_to)s
+          AND (%(customers)s::int[] IS NULL OR "{customer}" = ANY(%(customers)s::int[]))
+          AND (%(customer_froms)s::int[] IS NULL
+               OR EXISTS (SELECT FROM unnest(%(customer_froms)s::int[], %(customer_tos)s::int[]) AS r(f, t)
+                          WHERE "{customer}" BETWEEN r.f AND r.t))
+          AND (%(space_customers)s::int[] IS NULL
+               OR ("{customer}", "{space}") IN (SELECT * FROM unnest(%(space_customers)s::int[], %(space_spaces)s::int[])))
+        ORDER BY "{customer}", "{space}"
+        """.format(cache=cache_table, customer=key_columns[0], space=key_columns[1])
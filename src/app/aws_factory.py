@@ -1,6 +1,6 @@
-import boto3
-
-
 def get_aws_client(resource_type: str, region: str):
-    """Get an aws client"""
-    return boto3.client(resource_type, region)
\ No newline at end of file
+    """Get an aws client. boto3 is only imported here, so runs without CloudWatch do not spend their startup
+    importing it"""
+    import boto3
+
+    return boto3.client(resource_type, region)
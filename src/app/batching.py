@@ -0,0 +1,140 @@
+from psycopg2 import sql
+
+# Bounds of the Postgres integer type used for "Customer" columns. A range covering these
+# matches every customer, which is how a single-shot (unbatched) run is expressed.
+MIN_CUSTOMER = -2147483648
+MAX_CUSTOMER = 2147483647
+
+
+def get_recalculation_scope(customer_from: int = MIN_CUSTOMER, customer_to: int = MAX_CUSTOMER,
+                            spaces: list = None, customers: list = None, customer_ranges: list = None) -> dict:
+    """Build the query parameters that limit a recalculation to an inclusive customer range and, when
+    spaces is given, to just those (customer, space) pairs, when customers is given, to just those customers, or when
+    customer_ranges is given, to the customers in those inclusive (customer_from, customer_to) ranges.
+
+    The customer range is narrowed to the listed spaces' customers, so their rows can be read through an index on
+    "Customer". The customer ranges are passed as two arrays of their first and last customers."""
+    if spaces:
+        customer_from = max(customer_from, min(customer for customer, _ in spaces))
+        customer_to = min(customer_to, max(customer for customer, _ in spaces))
+    return {
+        "customer_from": customer_from,
+        "customer_to": customer_to,
+        "space_customers": [customer for customer, _ in spaces] if spaces is not None else None,
+        "space_spaces": [space for _, space in spaces] if spaces is not None else None,
+        "customers": customers,
+        "customer_froms": [range_from for range_from, _ in customer_ranges] if customer_ranges is not None else None,
+        "customer_tos": [range_to for _, range_to in customer_ranges] if customer_ranges is not None else None
+    }
+
+
+def get_customers_scope(customer_ranges: list) -> dict:
+    """Build a recalculation scope for the customers in a list of inclusive (customer_from, customer_to) ranges:
+    a customer range when they merge into just one, otherwise the merged ranges within the range they span"""
+    merged = []
+    for customer_from, customer_to in sorted(customer_ranges):
+        if merged and customer_from <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], customer_to))
+        else:
+            merged.append((customer_from, customer_to))
+
+    if len(merged) == 1:
+        return get_recalculation_scope(*merged[0])
+    return get_recalculation_scope(merged[0][0], merged[-1][1], customer_ranges=merged)
+
+
+def get_customer_ranges(conn, tables: list, batch_size: int) -> list:
+    """Split the customers found in the given tables into contiguous, inclusive
+    (customer_from, customer_to) ranges of at most batch_size customers each.
+
+    The ranges cover the whole integer space with no gaps, so a customer that first appears
+    part way through a run still falls into exactly one batch. A batch_size of 0 or less
+    disables batching and returns a single range covering every customer."""
+    if batch_size <= 0:
+        return [(MIN_CUSTOMER, MAX_CUSTOMER)]
+
+    return __get_ranges(conn, tables, sql.SQL("(ROW_NUMBER() OVER (ORDER BY customer) - 1) / %(size)s"),
+                        batch_size)
+
+
+def get_customer_partitions(conn, tables: list, partitions: int) -> list:
+    """Split the customers found in the given tables into at most the given number of contiguous, inclusive
+    (customer_from, customer_to) ranges holding roughly equal numbers of customers. Like get_customer_ranges,
+    the ranges cover the whole integer space with no gaps."""
+    if partitions <= 1:
+        return [(MIN_CUSTOMER, MAX_CUSTOMER)]
+
+    return __get_ranges(conn, tables, sql.SQL("NTILE(%(size)s) OVER (ORDER BY customer)"), partitions)
+
+
+def split_scope(conn, scope: dict, tables: list) -> list:
+    """Split a recalculation scope into two smaller scopes that together cover the same customers found in the
+    given tables, or the same (customer, space) pairs, customers or customer ranges when the scope lists them.
+    Returns an empty list when the scope holds a single customer or space and cannot be split any further."""
+    if scope["customer_froms"] is not None:
+        customer_ranges = list(zip(scope["customer_froms"], scope["customer_tos"]))
+        middle = len(customer_ranges) // 2
+        return [get_customers_scope(customer_ranges[:middle]), get_customers_scope(customer_ranges[middle:])]
+
+    if scope["customers"] is not None:
+        customers = scope["customers"]
+        if len(customers) <= 1:
+            return []
+        middle = len(customers) // 2
+        return [get_recalculation_scope(customers[0], customers[middle - 1], customers=customers[:middle]),
+                get_recalculation_scope(customers[middle], customers[-1], customers=customers[middle:])]
+
+    if scope["space_customers"] is not None:
+        spaces = list(zip(scope["space_customers"], scope["space_spaces"]))
+        if len(spaces) <= 1:
+            return []
+        middle = len(spaces) // 2
+        return [get_recalculation_scope(scope["customer_from"], scope["customer_to"], spaces[:middle]),
+                get_recalculation_scope(scope["customer_from"], scope["customer_to"], spaces[middle:])]
+
+    customers = sql.SQL(" UNION ").join(
+        sql.SQL('SELECT "Customer" AS customer FROM {} WHERE "Customer" BETWEEN %(customer_from)s AND %(customer_to)s')
+        .format(sql.Identifier(table)) for table in tables)
+
+    cur = conn.cursor()
+    cur.execute(sql.SQL("""
+        SELECT percentile_disc(0.5) WITHIN GROUP (ORDER BY customer) AS "Middle", COUNT(*) AS "Customers"
+        FROM ({customers}) AS customers;
+        """).format(customers=customers), scope)
+    middle, customer_count = cur.fetchone()
+    cur.close()
+
+    if customer_count <= 1:
+        return []
+
+    # the middle customer ends the first half, so both halves hold at least one customer
+    return [get_recalculation_scope(scope["customer_from"], middle),
+            get_recalculation_scope(middle + 1, scope["customer_to"])]
+
+
+def __get_ranges(conn, tables: list, batch_expression: sql.Composable, size: int) -> list:
+    customers = sql.SQL(" UNION ").join(
+        sql.SQL('SELECT "Customer" AS customer FROM {}').format(sql.Identifier(table)) for table in tables)
+
+    cur = conn.cursor()
+    cur.execute(sql.SQL("""
+        -- Number each distinct customer and take the first customer of every batch.
+        SELECT MIN(customer) AS "BatchStart"
+        FROM (
+            SELECT customer, {batch} AS batch
+            FROM ({customers}) AS customers
+        ) AS numbered
+        GROUP BY batch
+        ORDER BY 1;
+        """).format(batch=batch_expression, customers=customers), {"size": size})
+    batch_starts = [row[0] for row in cur.fetchall()]
+    cur.close()
+
+    if not batch_starts:
+        return [(MIN_CUSTOMER, MAX_CUSTOMER)]
+
+    # Each range runs up to the customer before the next batch start; the outer ranges are
+    # widened to the integer bounds so nothing outside the listed customers is missed.
+    batch_starts[0] = MIN_CUSTOMER
+    batch_ends = [start - 1 for start in batch_starts[1:]] + [MAX_CUSTOMER]
+    return list(zip(batch_starts, batch_ends))
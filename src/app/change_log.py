@@ -0,0 +1,84 @@
+import psycopg2
+from psycopg2 import extras
+
+from logzero import logger
+
+
+# The change log and watermark tables, and the triggers that fill the change log, are created by
+# sql/create_change_log.sql.
+
+
+def get_watermark(conn, recalculator: str, full_recalculation_interval_hours: int):
+    """Get the stored watermark for a recalculator, along with whether a full recalculation is due.
+    Returns None if the recalculator has never stored a watermark"""
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute("""
+        SELECT "TransactionId",
+               "LastFullRun" < now() - make_interval(hours => %(interval)s) AS "FullRunDue"
+        FROM "RecalculatorWatermarks"
+        WHERE "Recalculator" = %(recalculator)s;
+        """, {"recalculator": recalculator, "interval": full_recalculation_interval_hours})
+    watermark = cur.fetchone()
+    cur.close()
+    return watermark
+
+
+def get_current_watermark(conn) -> int:
+    """Get the oldest transaction id that may still be in progress. Every change logged by an older
+    transaction is already visible, so a run that reads the change log after taking this watermark has
+    seen all of them; changes from newer transactions are picked up again by the next run"""
+    cur = conn.cursor()
+    cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot());")
+    watermark = cur.fetchone()[0]
+    cur.close()
+    return watermark
+
+
+def get_changed_spaces(conn, sources: list, since_transaction_id: int) -> list:
+    """Get the distinct (customer, space) pairs logged for the given source tables since a watermark"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT DISTINCT "Customer", "Space"
+        FROM "RecalculatorChangeLog"
+        WHERE "Source" = ANY(%(sources)s)
+          AND "TransactionId" >= %(since)s
+        ORDER BY "Customer", "Space";
+        """, {"sources": sources, "since": since_transaction_id})
+    changed_spaces = [(row[0], row[1]) for row in cur.fetchall()]
+    cur.close()
+
+    logger.info(f"{len(changed_spaces)} spaces changed since transaction {since_transaction_id}")
+    return changed_spaces
+
+
+def set_watermark(conn, recalculator: str, transaction_id: int, full_run: bool):
+    """Store a recalculator's watermark and remove the change log entries it has now processed"""
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO "RecalculatorWatermarks" ("Recalculator", "TransactionId", "LastRun", "LastFullRun")
+        VALUES (%(recalculator)s, %(transaction_id)s, now(), now())
+        ON CONFLICT ("Recalculator")
+        DO UPDATE SET
+            "TransactionId" = excluded."TransactionId",
+            "LastRun"       = excluded."LastRun",
+            "LastFullRun"   = CASE WHEN %(full_run)s THEN excluded."LastFullRun"
+                                   ELSE "RecalculatorWatermarks"."LastFullRun" END;
+        """, {"recalculator": recalculator, "transaction_id": transaction_id, "full_run": full_run})
+    cur.close()
+
+
+def prune_change_log(conn, sources: list, transaction_id: int, consumers: list = None):
+    """Delete change log entries for the given source tables that are older than a watermark. Entries are kept
+    while they are newer than the stored watermark of any of the other consumers (e.g. an aggregate cache) that
+    also read them"""
+    cur = conn.cursor()
+    cur.execute("""
+        DELETE FROM "RecalculatorChangeLog"
+        WHERE "Source" = ANY(%(sources)s)
+          AND "TransactionId" < %(transaction_id)s
+          AND "TransactionId" < ALL (SELECT "TransactionId"
+                                     FROM "RecalculatorWatermarks"
+                                     WHERE "Recalculator" = ANY(%(consumers)s));
+        """, {"sources": sources, "transaction_id": transaction_id, "consumers": consumers or []})
+    logger.debug(f"Pruned {cur.rowcount} change log entries")
+    cur.close()
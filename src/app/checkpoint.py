@@ -0,0 +1,137 @@
+import uuid
+
+import psycopg2
+from psycopg2 import extras
+
+from logzero import logger
+from app.batching import get_recalculation_scope, MIN_CUSTOMER
+from app.change_log import get_current_watermark
+
+
+# The checkpoint table is created by sql/create_checkpoints.sql.
+
+
+def get_checkpoint(conn, recalculator: str):
+    """Get the checkpoint of a recalculator's unfinished full run: its RunId and the TransactionId watermark taken
+    when it started. Returns None if there is no such run"""
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute("""
+        SELECT "RunId", "TransactionId"
+        FROM "RecalculatorCheckpoints"
+        WHERE "Recalculator" = %(recalculator)s;
+        """, {"recalculator": recalculator})
+    checkpoint = cur.fetchone()
+    cur.close()
+    return checkpoint
+
+
+def start_checkpoint(conn, recalculator: str, scopes: list):
+    """Resume the recalculator's unfinished full run, or start a new checkpointed one, over the given customer range
+    scopes. Returns the run's checkpoint, holding the scopes that are still to be recalculated, or None when the
+    scopes are not customer ranges (e.g. the partitions of a hash partitioned table) and cannot be checkpointed"""
+    if any(scope["customers"] is not None or scope["space_customers"] is not None or scope["customer_froms"] is not None
+           for scope in scopes):
+        logger.info("Recalculation scopes are not customer ranges, the run cannot be checkpointed")
+        return None
+
+    existing = get_checkpoint(conn, recalculator)
+    if existing is not None:
+        remaining = __get_remaining_scopes(scopes, __get_completed_ranges(conn, existing["RunId"]))
+        resumed_after = __get_last_customer(scopes, remaining)
+        logger.info(f"Resuming run {existing['RunId']} from customer {resumed_after + 1}, "
+                    f"{len(remaining)} customer ranges to go")
+        checkpoint = {"runId": str(existing["RunId"]), "resumedAfter": resumed_after,
+                      "transactionId": existing["TransactionId"], "scopes": remaining}
+    else:
+        checkpoint = {"runId": str(uuid.uuid4()), "resumedAfter": None,
+                      "transactionId": get_current_watermark(conn), "scopes": scopes}
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO "RecalculatorCheckpoints" ("Recalculator", "RunId", "TransactionId", "Started")
+            VALUES (%(recalculator)s, %(run_id)s, %(transaction_id)s, now());
+            """, {"recalculator": recalculator, "run_id": checkpoint["runId"],
+                  "transaction_id": checkpoint["transactionId"]})
+        cur.close()
+        logger.info(f"Starting checkpointed run {checkpoint['runId']}")
+    conn.commit()
+
+    checkpoint["allScopes"] = scopes
+    return checkpoint
+
+
+def checkpointed(recalculate, recalculator: str, checkpoint: dict):
+    """Wrap recalculate(conn, scope) to record the scope's customer range as done in the same transaction, so the
+    range is committed with the scope's writes. Scopes run in parallel may commit in any order"""
+    def recalculate_and_checkpoint(conn, scope):
+        result = recalculate(conn, scope)
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO "RecalculatorCheckpointScopes" ("RunId", "CustomerFrom", "CustomerTo", "Completed")
+            VALUES (%(run_id)s, %(customer_from)s, %(customer_to)s, now());
+            """, {"run_id": checkpoint["runId"], "customer_from": scope["customer_from"],
+                  "customer_to": scope["customer_to"]})
+        cur.close()
+        return result
+
+    return recalculate_and_checkpoint
+
+
+def finish_checkpoint(conn, recalculator: str, checkpoint: dict) -> dict:
+    """Remove the run's checkpoint once every scope has been recalculated, or keep it for the next run to resume from
+    when the run stopped early. Returns the run's id, the customer it resumed after, the last customer before the
+    first range still to be recalculated, how many ranges that leaves, and whether the run is complete"""
+    remaining = __get_remaining_scopes(checkpoint["scopes"], __get_completed_ranges(conn, checkpoint["runId"]))
+    last_customer = __get_last_customer(checkpoint["allScopes"], remaining)
+    complete = not remaining
+    cur = conn.cursor()
+    if complete:
+        cur.execute("""
+            DELETE FROM "RecalculatorCheckpoints"
+            WHERE "Recalculator" = %(recalculator)s AND "RunId" = %(run_id)s;
+            """, {"recalculator": recalculator, "run_id": checkpoint["runId"]})
+        logger.info(f"Checkpointed run {checkpoint['runId']} complete")
+    else:
+        logger.info(f"Checkpointed run {checkpoint['runId']} stopped with {len(remaining)} customer ranges to go, "
+                    f"from customer {last_customer + 1}, the next run resumes from there")
+    cur.close()
+    conn.commit()
+
+    return {"runId": checkpoint["runId"], "resumedAfter": checkpoint["resumedAfter"], "lastCustomer": last_customer,
+            "remainingScopes": len(remaining), "complete": complete}
+
+
+def __get_completed_ranges(conn, run_id) -> list:
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT "CustomerFrom", "CustomerTo"
+        FROM "RecalculatorCheckpointScopes"
+        WHERE "RunId" = %(run_id)s
+        ORDER BY "CustomerFrom";
+        """, {"run_id": str(run_id)})
+    completed = [(row[0], row[1]) for row in cur.fetchall()]
+    cur.close()
+    return completed
+
+
+def __get_remaining_scopes(scopes: list, completed: list) -> list:
+    # the parts of the customer ranges that no completed range covers. The completed ranges may differ from the
+    # scopes when customers have been added or removed since the interrupted run started
+    remaining = []
+    for scope in scopes:
+        customer_from = scope["customer_from"]
+        for completed_from, completed_to in sorted(completed):
+            if completed_to < customer_from or completed_from > scope["customer_to"]:
+                continue
+            if completed_from > customer_from:
+                remaining.append(get_recalculation_scope(customer_from, completed_from - 1))
+            customer_from = max(customer_from, completed_to + 1)
+        if customer_from <= scope["customer_to"]:
+            remaining.append(get_recalculation_scope(customer_from, scope["customer_to"]))
+    return remaining
+
+
+def __get_last_customer(scopes: list, remaining: list) -> int:
+    # the customer before the lowest range still to be recalculated, or the last one once none are left
+    if remaining:
+        return remaining[0]["customer_from"] - 1
+    return scopes[-1]["customer_to"] if scopes else MIN_CUSTOMER - 1
@@ -0,0 +1,66 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from logzero import logger
+
+NAMESPACE = "Protagonist Recalculator"
+
+# PutMetricData accepts up to 1000 metrics in a single request
+MAX_METRICS_PER_REQUEST = 1000
+
+RETRYABLE_ERROR_CODES = {"Throttling", "ThrottlingException", "RequestLimitExceeded", "ServiceUnavailable",
+                         "InternalFailure", "InternalServiceError"}
+
+
+def get_metric_dimensions(database: str, app_version: str, recalculator_name: str) -> list:
+    """The dimensions every metric from a recalculator is published with"""
+    return [
+        {
+            'Name': "DATABASE_NAME",
+            'Value': database
+        },
+        {
+            'Name': "APP_VERSION",
+            'Value': app_version
+        },
+        {
+            'Name': "RECALCULATOR_NAME",
+            'Value': recalculator_name
+        }
+    ]
+
+
+def publish_metric_data(cloudwatch, metric_data: list, concurrency: int, retries: int):
+    """Publish metric data to CloudWatch in requests of at most MAX_METRICS_PER_REQUEST metrics, sending up to
+    concurrency requests at a time. A request that is throttled or fails on the CloudWatch side is retried up to
+    retries times, backing off exponentially between attempts"""
+    chunks = [metric_data[i:i + MAX_METRICS_PER_REQUEST]
+              for i in range(0, len(metric_data), MAX_METRICS_PER_REQUEST)]
+    logger.debug(f"Publishing {len(metric_data)} CloudWatch metrics in {len(chunks)} requests")
+
+    if concurrency <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            __put_metric_data(cloudwatch, chunk, retries)
+        return
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as executor:
+        # list() raises the first failed request's exception, once every request has finished
+        list(executor.map(lambda chunk: __put_metric_data(cloudwatch, chunk, retries), chunks))
+
+
+def __put_metric_data(cloudwatch, metric_data: list, retries: int):
+    # botocore has already been imported along with the client by now, see app/aws_factory.py
+    from botocore.exceptions import ClientError
+
+    attempt = 0
+    while True:
+        try:
+            cloudwatch.put_metric_data(MetricData=metric_data, Namespace=NAMESPACE)
+            return
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in RETRYABLE_ERROR_CODES or attempt >= retries:
+                raise
+            attempt += 1
+            delay = 0.5 * 2 ** (attempt - 1)
+            logger.warning(f"CloudWatch request failed ({e}), retrying in {delay}s")
+            time.sleep(delay)
@@ -1,13 +1,10 @@
 import os
 
+from app.recalculation_settings import _get_boolean
 
-def _get_boolean(env_name: str, fallback: str) -> bool:
-    return os.environ.get(env_name, fallback).lower() in ("true", "t", "1")
-
+# Settings shared by every recalculation are in app/recalculation_settings.py
 
 # AWS
-REGION = os.environ.get("AWS_REGION", "eu-west-1")
-ENABLE_CLOUDWATCH_INTEGRATION = _get_boolean("ENABLE_CLOUDWATCH_INTEGRATION", "True")
 CLOUDWATCH_SPACE_IMAGE_SIZE_DIFFERENCE_METRIC_NAME = os.environ.get(
     "CLOUDWATCH_SPACE_IMAGE_SIZE_DIFFERENCE_METRIC_NAME", "SpaceImageSizeDelta")
 CLOUDWATCH_SPACE_IMAGE_NUMBER_DIFFERENCE_METRIC_NAME = os.environ.get(
@@ -18,9 +15,8 @@ CLOUDWATCH_SPACE_ADJUNCT_SIZE_DIFFERENCE_METRIC_NAME = os.environ.get(
     "CLOUDWATCH_SPACE_ADJUNCT_SIZE_DIFFERENCE_METRIC_NAME", "SpaceAdjunctSizeDelta")
 CLOUDWATCH_SPACE_ADJUNCT_NUMBER_DIFFERENCE_METRIC_NAME = os.environ.get(
     "CLOUDWATCH_SPACE_ADJUNCT_NUMBER_DIFFERENCE_METRIC_NAME", "SpaceAdjunctNumberDelta")
-APP_VERSION = os.environ.get('APP_VERSION', "1.0")
 
 # Postgres
-CONNECTION_STRING = os.environ.get("CONNECTION_STRING")
-CONNECTION_TIMEOUT = os.environ.get("CONNECTION_TIMEOUT")
-DRY_RUN = _get_boolean("DRY_RUN", "False")
+# Upsert, zero out and roll up a customer batch in one statement over a single aggregation of its spaces, rather
+# than three statements that each read the tables again
+FUSED_RECALCULATION = _get_boolean("FUSED_RECALCULATION", "False")
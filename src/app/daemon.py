@@ -0,0 +1,51 @@
+import signal
+import threading
+
+from logzero import logger
+
+from app.database import get_healthy_connection, end_transaction
+
+
+def run_daemon(run_cleanup, connection_info: dict, connection_timeout: str, interval_seconds: int,
+               cloudwatch=None):
+    """Keep running run_cleanup(conn=..., cloudwatch=...) until SIGTERM or SIGINT is received, reusing one
+    database connection and CloudWatch client across runs.
+
+    Runs start interval_seconds after the previous one finished, or straight away on SIGUSR1. The connection is
+    checked before every run and replaced if it has gone away. A failed run is logged and does not stop the
+    daemon. A stop signal received during a run takes effect once that run has finished."""
+    wake = threading.Event()
+    state = {"stopping": False}
+
+    def request_run(signum, frame):
+        logger.info("Recalculation requested")
+        wake.set()
+
+    def request_stop(signum, frame):
+        logger.info("Stopping after the current recalculation")
+        state["stopping"] = True
+        wake.set()
+
+    previous_handlers = {signum: signal.signal(signum, handler)
+                         for signum, handler in ((signal.SIGUSR1, request_run), (signal.SIGTERM, request_stop),
+                                                 (signal.SIGINT, request_stop))}
+
+    logger.info(f"Running as a daemon, recalculating every {interval_seconds} seconds")
+    conn = None
+    while not state["stopping"]:
+        try:
+            conn = get_healthy_connection(conn, connection_info, connection_timeout)
+            run_cleanup(conn=conn, cloudwatch=cloudwatch)
+        except Exception:
+            logger.exception("Recalculation failed")
+        finally:
+            end_transaction(conn)
+
+        wake.wait(interval_seconds)
+        wake.clear()
+
+    if conn is not None:
+        conn.close()
+    for signum, handler in previous_handlers.items():
+        signal.signal(signum, handler)
+    logger.info("Daemon stopped")
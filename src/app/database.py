@@ -1,6 +1,7 @@
 from urllib.parse import urlparse
 
 import psycopg2
+from psycopg2 import pool, errors
 from logzero import logger
 
 
@@ -14,6 +15,77 @@ def connect_to_postgres(connection_info: dict, connection_timeout: str):
         raise e
 
 
+def create_connection_pool(connection_info: dict, connection_timeout: str, size: int):
+    try:
+        logger.debug(f"creating postgres connection pool of {size} connections")
+        return psycopg2.pool.ThreadedConnectionPool(1, size, **connection_info, connect_timeout=connection_timeout)
+    except Exception as e:
+        logger.error(f"Error connecting to database: {e}")
+        raise e
+
+
+def get_healthy_connection(conn, connection_info: dict, connection_timeout: str):
+    """Return conn if it is still open and answers a query, otherwise close it and return a new connection"""
+    if conn is not None and not conn.closed:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+            conn.rollback()
+            return conn
+        except psycopg2.Error as e:
+            logger.warning(f"Database connection failed health check, reconnecting: {e}")
+            conn.close()
+
+    return connect_to_postgres(connection_info=connection_info, connection_timeout=connection_timeout)
+
+
+def end_transaction(conn):
+    """Roll back any transaction left open on conn, so an idle long-running process does not hold back vacuum.
+    Every write has already been committed (or deliberately rolled back) by then"""
+    if conn is not None and not conn.closed:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            logger.exception("Error ending transaction")
+
+
+# Errors from a statement that gave up, or lost out to another transaction, which can succeed when tried again
+RETRYABLE_ERRORS = (errors.QueryCanceled, errors.LockNotAvailable, errors.SerializationFailure,
+                    errors.DeadlockDetected)
+
+
+def set_transaction_timeouts(conn, statement_timeout_seconds: float, lock_timeout_seconds: float):
+    """Limit how long each statement in the current transaction on conn may run, and how long it may wait for a
+    lock. A timeout of 0 or less leaves the server's setting in place"""
+    timeouts = {name: f"{int(seconds * 1000)}ms" for name, seconds in
+                (("statement_timeout", statement_timeout_seconds), ("lock_timeout", lock_timeout_seconds))
+                if seconds > 0}
+    if not timeouts:
+        return
+
+    cur = conn.cursor()
+    for name, timeout in timeouts.items():
+        cur.execute("SELECT set_config(%(name)s, %(timeout)s, true);", {"name": name, "timeout": timeout})
+    cur.close()
+
+
+def set_transaction_work_mem(conn, work_mem: str):
+    """Set the memory each sort or hash in the current transaction on conn may use before spilling to disk, e.g.
+    "64MB". An empty work_mem leaves the server's setting in place"""
+    if not work_mem:
+        return
+
+    cur = conn.cursor()
+    cur.execute("SELECT set_config('work_mem', %(work_mem)s, true);", {"work_mem": work_mem})
+    cur.close()
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Whether error is a timeout, lock timeout, serialization failure or deadlock"""
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
 def get_connection_config(connection_string: str):
 
     result = urlparse(connection_string)
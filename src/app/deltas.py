@@ -0,0 +1,90 @@
+import csv
+import json
+import shutil
+import tempfile
+from decimal import Decimal
+
+import psycopg2
+from psycopg2 import extras, sql
+
+DELTA_OUTPUT_FORMATS = ("ndjson", "csv")
+
+
+def fetch_delta_rows(conn, cur, query: str, params: dict, staging_table: str, chunk_size: int):
+    """Execute a statement that returns delta rows and return an iterator over chunks of those rows.
+
+    With a chunk_size of 0 or less the rows are fetched in one go with fetchall(), giving a single chunk.
+    Otherwise the statement's result is written to a temporary staging table (dropped at the end of the
+    transaction) and read back through a named server-side cursor, so at most chunk_size rows are held
+    in memory at once. A staging table is needed because Postgres does not allow a cursor to be declared
+    over a statement with data-modifying CTEs."""
+    if chunk_size <= 0:
+        cur.execute(query, params)
+        return iter([cur.fetchall()])
+
+    cur.execute(sql.SQL("CREATE TEMP TABLE {} ON COMMIT DROP AS ").format(sql.Identifier(staging_table))
+                + sql.SQL(query), params)
+    return __stream_staged_rows(conn, staging_table, chunk_size)
+
+
+def __stream_staged_rows(conn, staging_table: str, chunk_size: int):
+    cur = conn.cursor(name=f"{staging_table}_cursor", cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.itersize = chunk_size
+    cur.execute(sql.SQL("SELECT * FROM {}").format(sql.Identifier(staging_table)))
+
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+    cur.close()
+
+
+def open_delta_output(path: str, output_format: str, columns: list):
+    """Open a file to write delta rows to, replacing any earlier one, and write its header.
+
+    Each row is written as a single line holding just its values, in the order of columns, so the column names are
+    only written once: with "ndjson" the first line is {"columns": [...]} and each row is a JSON array, with "csv"
+    the first line is the CSV header."""
+    if output_format not in DELTA_OUTPUT_FORMATS:
+        raise ValueError(f"Unknown delta output format {output_format}, expected one of {DELTA_OUTPUT_FORMATS}")
+
+    output = open(path, "w", newline="")
+    if output_format == "csv":
+        csv.writer(output).writerow(columns)
+    else:
+        output.write(json.dumps({"columns": columns}) + "\n")
+    return output
+
+
+def new_delta_spool():
+    """A temporary file for a recalculation scope to write its delta rows to. A scope's rows are only copied to the
+    delta output once the scope has finished (see copy_delta_spool), so the rows of a batch that is rolled back and
+    retried are not written twice, and scopes running at the same time do not interleave their rows"""
+    return tempfile.TemporaryFile("w+", newline="")
+
+
+def write_delta_rows(output, output_format: str, columns: list, rows: list):
+    """Write delta rows to a delta output or spool, as lines of values in the order of columns. A column missing
+    from a row is written as null"""
+    if output_format == "csv":
+        csv.writer(output).writerows([row.get(column) for column in columns] for row in rows)
+        return
+
+    for row in rows:
+        output.write(json.dumps([row.get(column) for column in columns], default=__json_value) + "\n")
+
+
+def copy_delta_spool(spool, output):
+    """Append the rows a scope wrote to its spool to the delta output, and close the spool"""
+    spool.seek(0)
+    shutil.copyfileobj(spool, output)
+    spool.close()
+
+
+def __json_value(value):
+    # sums of numeric columns are read as Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return str(value)
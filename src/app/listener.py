@@ -0,0 +1,103 @@
+import select
+import signal
+import time
+
+import psycopg2
+from psycopg2 import sql
+from logzero import logger
+
+from app.database import connect_to_postgres, get_healthy_connection, end_transaction
+
+# Longest time spent waiting for a notification before checking for a stop signal
+POLL_SECONDS = 1.0
+
+
+def run_listener(run_cleanup, connection_info: dict, connection_timeout: str, channel: str, sources: list,
+                 debounce_seconds: float, cloudwatch=None):
+    """Keep running run_cleanup(conn=..., cloudwatch=..., spaces=...) for the spaces sent as notifications on
+    channel, until SIGTERM or SIGINT is received.
+
+    Notifications are sent by the triggers in sql/create_change_notifications.sql, with a "{source}/{customer}/
+    {space}" payload. Only those from the given source tables are used. The spaces are collected for
+    debounce_seconds after the first notification, so a burst of writes leads to a single recalculation of every
+    space it touched. Notifications are read over a connection of their own; recalculations reuse another one,
+    which is checked before every run and replaced if it has gone away."""
+    state = {"stopping": False}
+
+    def request_stop(signum, frame):
+        logger.info("Stopping after the current recalculation")
+        state["stopping"] = True
+
+    previous_handlers = {signum: signal.signal(signum, request_stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+    logger.info(f"Listening for changes to {', '.join(sources)} on {channel}")
+    listen_conn = None
+    conn = None
+    pending = set()
+    window_end = None
+    while not state["stopping"]:
+        try:
+            if listen_conn is None or listen_conn.closed:
+                listen_conn = __listen(connection_info, connection_timeout, channel)
+
+            timeout = POLL_SECONDS if window_end is None else max(0.0, window_end - time.monotonic())
+            if select.select([listen_conn], [], [], min(timeout, POLL_SECONDS)) != ([], [], []):
+                listen_conn.poll()
+            pending.update(__get_notified_spaces(listen_conn, sources))
+        except psycopg2.Error as e:
+            # notifications sent while nothing is listening are lost; the scheduled full run picks those up
+            logger.warning(f"Listening connection failed, reconnecting: {e}")
+            if listen_conn is not None:
+                listen_conn.close()
+            listen_conn = None
+            time.sleep(POLL_SECONDS)
+            continue
+
+        if pending and window_end is None:
+            window_end = time.monotonic() + debounce_seconds
+        if window_end is None or time.monotonic() < window_end:
+            continue
+
+        spaces = sorted(pending)
+        pending.clear()
+        window_end = None
+        logger.info(f"Recalculating {len(spaces)} notified spaces")
+        try:
+            conn = get_healthy_connection(conn, connection_info, connection_timeout)
+            run_cleanup(conn=conn, cloudwatch=cloudwatch, spaces=spaces)
+        except Exception:
+            # the spaces are still wrong, so they are tried again with the next window
+            logger.exception("Recalculation failed")
+            pending.update(spaces)
+        finally:
+            end_transaction(conn)
+
+    for open_conn in (listen_conn, conn):
+        if open_conn is not None:
+            open_conn.close()
+    for signum, handler in previous_handlers.items():
+        signal.signal(signum, handler)
+    logger.info("Listener stopped")
+
+
+def __listen(connection_info: dict, connection_timeout: str, channel: str):
+    listen_conn = connect_to_postgres(connection_info=connection_info, connection_timeout=connection_timeout)
+    # notifications are only delivered to a connection outside a transaction
+    listen_conn.autocommit = True
+    cur = listen_conn.cursor()
+    cur.execute(sql.SQL("LISTEN {};").format(sql.Identifier(channel)))
+    cur.close()
+    return listen_conn
+
+
+def __get_notified_spaces(listen_conn, sources: list) -> set:
+    spaces = set()
+    while listen_conn.notifies:
+        payload = listen_conn.notifies.pop(0).payload
+        try:
+            source, customer, space = payload.split("/")
+            if source in sources:
+                spaces.add((int(customer), int(space)))
+        except ValueError:
+            logger.warning(f"Ignoring notification with unexpected payload {payload!r}")
+    return spaces
@@ -0,0 +1,92 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from logzero import logger
+from app.database import create_connection_pool, set_transaction_timeouts, is_retryable_error
+
+
+def run_scopes(conn, connection_info: dict, connection_timeout: str, scopes: list, recalculate,
+               parallelism: int, dry_run: bool, statement_timeout: float = 0, lock_timeout: float = 0,
+               retries: int = 0, split=None, deadline: float = None) -> list:
+    """Call recalculate(conn, scope) for every scope, each in its own transaction, and return the results in
+    scope order. Transactions are rolled back rather than committed when dry_run is set.
+
+    Each transaction's statements are limited to statement_timeout seconds, and lock_timeout seconds waiting for a
+    lock (0 for no limit). A scope that fails with a timeout, serialization failure or deadlock is rolled back and
+    tried again up to retries times, split into the smaller scopes returned by split(conn, scope) when it can be;
+    each smaller scope then returns a result of its own.
+
+    With a parallelism above 1 and more than one scope, the scopes are shared between that many worker threads,
+    each running on its own connection from a pool. Otherwise they run one after another on conn.
+
+    With a deadline, a time.monotonic() value, scopes that have not started by then are skipped and return no
+    results. Scopes already running are finished."""
+    def run_with_retries(scope_conn, scope):
+        if deadline is not None and time.monotonic() >= deadline:
+            logger.debug(f"Skipping {__describe_scope(scope)}, the run's deadline has passed")
+            return []
+        return __run_with_retries(scope_conn, scope, recalculate, dry_run, statement_timeout, lock_timeout,
+                                  retries, split)
+
+    if parallelism <= 1 or len(scopes) <= 1:
+        return [result for scope in scopes for result in run_with_retries(conn, scope)]
+
+    workers = min(parallelism, len(scopes))
+    logger.info(f"Recalculating {len(scopes)} customer partitions over {workers} connections")
+    connection_pool = create_connection_pool(connection_info, connection_timeout, workers)
+
+    def run_on_pooled_connection(scope):
+        pooled_conn = connection_pool.getconn()
+        try:
+            return run_with_retries(pooled_conn, scope)
+        finally:
+            connection_pool.putconn(pooled_conn)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return [result for results in executor.map(run_on_pooled_connection, scopes) for result in results]
+    finally:
+        connection_pool.closeall()
+
+
+def __run_with_retries(conn, scope, recalculate, dry_run: bool, statement_timeout: float, lock_timeout: float,
+                       retries: int, split) -> list:
+    try:
+        return [__run_in_transaction(conn, scope, recalculate, dry_run, statement_timeout, lock_timeout)]
+    except Exception as e:
+        if retries <= 0 or not is_retryable_error(e):
+            raise
+        smaller_scopes = (split(conn, scope) if split is not None else []) or [scope]
+        logger.warning(f"Recalculation of {__describe_scope(scope)} failed ({str(e).splitlines()[0]}), retrying as "
+                       f"{len(smaller_scopes)} scopes")
+        conn.rollback()
+
+    return [result for smaller_scope in smaller_scopes
+            for result in __run_with_retries(conn, smaller_scope, recalculate, dry_run, statement_timeout,
+                                             lock_timeout, retries - 1, split)]
+
+
+def __describe_scope(scope) -> str:
+    if scope["space_customers"] is not None:
+        return f"{len(scope['space_customers'])} spaces"
+    if scope["customers"] is not None:
+        return f"{len(scope['customers'])} customers"
+    if scope["customer_froms"] is not None:
+        return f"{len(scope['customer_froms'])} customer ranges from {scope['customer_from']} to {scope['customer_to']}"
+    return f"customers {scope['customer_from']} to {scope['customer_to']}"
+
+
+def __run_in_transaction(conn, scope, recalculate, dry_run: bool, statement_timeout: float, lock_timeout: float):
+    try:
+        set_transaction_timeouts(conn, statement_timeout, lock_timeout)
+        result = recalculate(conn, scope)
+    except Exception:
+        conn.rollback()
+        raise
+
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+
+    return result
@@ -0,0 +1,123 @@
+import re
+
+from psycopg2 import sql
+from logzero import logger
+
+from app.batching import get_recalculation_scope, MIN_CUSTOMER, MAX_CUSTOMER
+
+# How pg_get_expr() shows a partition's bounds
+RANGE_BOUND = re.compile(r"^FOR VALUES FROM \((.+)\) TO \((.+)\)$")
+HASH_BOUND = re.compile(r"^FOR VALUES WITH \(modulus (\d+), remainder (\d+)\)$")
+
+
+def get_partition_scopes(conn, table: str, tables: list) -> list:
+    """Build a recalculation scope for each partition of table, when it is range or hash partitioned on its
+    "Customer" column alone. Returns None when it is not, so the caller can split customers as usual.
+
+    Each scope only matches the customers stored in its partition, so Postgres prunes the other partitions and a
+    scope's aggregate reads a single partition:
+    - Range partitions give one customer range each. Any gaps between them, which hold the default partition's
+      customers, become ranges of their own, so the ranges still cover every customer.
+    - Hash partitions give one list of customers each: the customers in the partition, along with the customers
+      in the other given tables that hash to it, such as customers whose images have all been deleted."""
+    partitioning = __get_partitioning(conn, table)
+    if partitioning is None:
+        return None
+
+    strategy, partitions = partitioning
+    if strategy == "r":
+        scopes = __get_range_scopes(partitions)
+    elif strategy == "h":
+        scopes = __get_hash_scopes(conn, table, tables, partitions)
+    else:
+        logger.info(f"{table} is list partitioned, recalculating it by customer ranges")
+        return None
+
+    if scopes is None:
+        logger.info(f"Partition bounds of {table} could not be read, recalculating it by customer ranges")
+        return None
+    logger.info(f"Recalculating {table} one partition at a time, in {len(scopes)} scopes")
+    return scopes
+
+
+def __get_partitioning(conn, table: str):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT pt.partstrat, a.attname
+        FROM pg_partitioned_table AS pt
+        JOIN pg_attribute AS a ON a.attrelid = pt.partrelid AND a.attnum = ANY(pt.partattrs::int2[])
+        WHERE pt.partrelid = to_regclass(quote_ident(%(table)s))
+          AND pt.partnatts = 1;
+        """, {"table": table})
+    row = cur.fetchone()
+    if row is None or row[1] != "Customer":
+        cur.close()
+        return None
+
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits AS i
+        JOIN pg_class AS c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(quote_ident(%(table)s))
+        ORDER BY c.relname;
+        """, {"table": table})
+    partitions = cur.fetchall()
+    cur.close()
+
+    return row[0], partitions
+
+
+def __get_range_scopes(partitions: list):
+    ranges = []
+    for _, bound in partitions:
+        if bound == "DEFAULT":
+            continue
+        match = RANGE_BOUND.match(bound)
+        if match is None:
+            return None
+        # the upper bound is exclusive
+        ranges.append((__get_range_bound(match.group(1), MIN_CUSTOMER),
+                       __get_range_bound(match.group(2), MAX_CUSTOMER + 1) - 1))
+    ranges.sort()
+
+    scopes = []
+    next_customer = MIN_CUSTOMER
+    for customer_from, customer_to in ranges:
+        if customer_from > next_customer:
+            scopes.append(get_recalculation_scope(next_customer, customer_from - 1))
+        scopes.append(get_recalculation_scope(customer_from, customer_to))
+        next_customer = customer_to + 1
+    if next_customer <= MAX_CUSTOMER:
+        scopes.append(get_recalculation_scope(next_customer, MAX_CUSTOMER))
+    return scopes
+
+
+def __get_range_bound(value: str, unbounded: int) -> int:
+    if value in ("MINVALUE", "MAXVALUE"):
+        return unbounded
+    return int(value.strip("'"))
+
+
+def __get_hash_scopes(conn, table: str, tables: list, partitions: list):
+    cur = conn.cursor()
+    scopes = []
+    for partition, bound in partitions:
+        match = HASH_BOUND.match(bound)
+        if match is None:
+            cur.close()
+            return None
+
+        others = [sql.SQL("""
+            SELECT "Customer" FROM {}
+            WHERE satisfies_hash_partition(to_regclass(quote_ident(%(table)s)), %(modulus)s, %(remainder)s,
+                                           "Customer")
+            """).format(sql.Identifier(other)) for other in tables if other != table]
+        cur.execute(sql.SQL(" UNION ").join([sql.SQL('SELECT "Customer" FROM {}').format(sql.Identifier(partition)),
+                                             *others]) + sql.SQL(" ORDER BY 1;"),
+                    {"table": table, "modulus": int(match.group(1)), "remainder": int(match.group(2))})
+        customers = [row[0] for row in cur.fetchall()]
+        if customers:
+            scopes.append(get_recalculation_scope(customers[0], customers[-1], customers=customers))
+    cur.close()
+
+    return scopes
@@ -0,0 +1,67 @@
+import time
+from contextlib import contextmanager
+
+from logzero import logger
+
+PHASE_COLUMNS = ["seconds", "rowsReturned", "rowsAffected"]
+
+
+@contextmanager
+def timed_phase(conn, cur, phases: dict, name: str, table: str, query: str, params: dict, explain: bool):
+    """Time a recalculation phase and add its elapsed seconds, rows returned and rows written to table onto
+    phases[name]. The phase's totals are yielded, so the caller can add the delta rows it reads to rowsReturned.
+
+    Rows written are read through cur, a RealDictCursor, from the table's statistics for the current transaction,
+    as a data-modifying CTE returns the delta rows rather than the number of rows it changed. With explain set,
+    the query plan of the phase's statement is logged first; see explain_phase."""
+    if explain:
+        explain_phase(conn, name, query, params)
+
+    phase = phases.setdefault(name, dict.fromkeys(PHASE_COLUMNS, 0))
+    rows_written = __get_rows_written(cur, table)
+    started = time.perf_counter()
+
+    yield phase
+
+    phase["seconds"] += time.perf_counter() - started
+    phase["rowsAffected"] += __get_rows_written(cur, table) - rows_written
+    logger.debug(f"Phase {name} - {phase}")
+
+
+def explain_phase(conn, name: str, query: str, params: dict):
+    """Log the EXPLAIN (ANALYZE, BUFFERS) output for a phase's statement. ANALYZE really runs the statement,
+    so it is run inside a savepoint that is rolled back before the phase itself runs"""
+    cur = conn.cursor()
+    cur.execute("SAVEPOINT explain_phase;")
+    try:
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+        plan = "\n".join(row[0] for row in cur.fetchall())
+    finally:
+        cur.execute("ROLLBACK TO SAVEPOINT explain_phase;")
+        cur.close()
+
+    logger.info(f"Query plan for phase {name}\n{plan}")
+
+
+def merge_phases(phases: dict, scope_phases: dict):
+    """Add the phase totals for one scope onto the totals for the run"""
+    for name, scope_phase in scope_phases.items():
+        phase = phases.setdefault(name, dict.fromkeys(PHASE_COLUMNS, 0))
+        for column in PHASE_COLUMNS:
+            phase[column] += scope_phase[column]
+
+
+def log_phases(phases: dict):
+    """Log the totals for each phase of a run"""
+    for name, phase in phases.items():
+        logger.info(f"Phase {name} - {phase['seconds']:.3f}s, {phase['rowsReturned']} rows returned, "
+                    f"{phase['rowsAffected']} rows affected")
+
+
+def __get_rows_written(cur, table: str) -> int:
+    cur.execute("""
+        SELECT COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0) AS "RowsWritten"
+        FROM pg_stat_xact_user_tables
+        WHERE relid = to_regclass(quote_ident(%(table)s));
+        """, {"table": table})
+    return int(cur.fetchone()["RowsWritten"])
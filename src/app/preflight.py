@@ -0,0 +1,148 @@
+import psycopg2
+from logzero import logger
+
+# What a run does about a missing index:
+#   off    - nothing, the indexes are not checked
+#   warn   - log a warning and run without it
+#   abort  - raise before anything is recalculated
+#   create - build it with CREATE INDEX CONCURRENTLY, then run. A dry run only warns
+INDEX_PREFLIGHT_MODES = ("off", "warn", "abort", "create")
+
+# The planner picks a sequential scan over an index for small tables, so its choice is only reported for tables
+# estimated to hold at least this many rows
+PLANNER_CHECK_MIN_ROWS = 10000
+
+
+def required_index(name: str, table: str, keys: list, probe: str, where: str = None, unique: bool = False) -> dict:
+    """Describe an index a recalculation relies on. keys and where are written the way Postgres shows them in
+    pg_get_indexdef() and pg_get_expr(), e.g. '"Customer"' or '("Scope"::integer)', so an existing index with the
+    same leading keys is found whatever its name. probe is a lookup the index should serve, used to check that the
+    planner does use an index for it."""
+    return {"name": name, "table": table, "keys": keys, "where": where, "unique": unique, "probe": probe}
+
+
+def check_indexes(conn, indexes: list, mode: str, dry_run: bool) -> dict:
+    """Check that each of the given required indexes (see required_index) exists and is valid, and that the planner
+    uses an index for its probe on a table of PLANNER_CHECK_MIN_ROWS rows or more. A missing index is handled as
+    set by mode (see INDEX_PREFLIGHT_MODES); an index the planner does not use is only warned about.
+
+    Returns the names of the indexes that are missing, that were created, and whose probe the planner estimates
+    as a sequential scan."""
+    if mode not in INDEX_PREFLIGHT_MODES:
+        raise ValueError(f"Unknown index preflight mode {mode}, expected one of {INDEX_PREFLIGHT_MODES}")
+
+    result = {"missing": [], "created": [], "sequentialScans": []}
+    if mode == "off":
+        return result
+
+    cur = conn.cursor()
+    for index in indexes:
+        if not __has_index(cur, index):
+            result["missing"].append(index["name"])
+        elif __plans_sequential_scan(cur, index):
+            result["sequentialScans"].append(index["name"])
+    cur.close()
+    # the checks only read the catalogs; end their transaction before any index is built
+    conn.rollback()
+
+    for index in indexes:
+        if index["name"] in result["sequentialScans"]:
+            logger.warning(f"The planner does not use an index for {index['probe']}, an index like "
+                           f"{index['name']} may be unusable or its statistics out of date")
+        if index["name"] not in result["missing"]:
+            continue
+        if mode == "create" and not dry_run and __create_index(conn, index):
+            result["created"].append(index["name"])
+        else:
+            logger.warning(f"Missing index {index['name']}, recalculation will be slower without it: "
+                           f"{__get_create_index_statement(index)}")
+
+    missing = [name for name in result["missing"] if name not in result["created"]]
+    if mode == "abort" and missing:
+        raise RuntimeError(f"Required indexes {missing} are missing")
+
+    logger.info(f"Index preflight - {result}")
+    return result
+
+
+def __has_index(cur, index: dict) -> bool:
+    # a valid index on the table whose leading keys are the required ones, and that covers every row the required
+    # one does: it has no predicate, or the same one. A required unique index, e.g. an ON CONFLICT arbiter, needs
+    # exactly the required keys
+    cur.execute("""
+        SELECT EXISTS (
+            SELECT 1
+            FROM pg_index AS i
+            WHERE i.indrelid = to_regclass(quote_ident(%(table)s))
+              AND i.indisvalid
+              AND (NOT %(unique)s OR (i.indisunique AND i.indnkeyatts = cardinality(%(keys)s::text[])))
+              AND i.indnkeyatts >= cardinality(%(keys)s::text[])
+              AND (i.indpred IS NULL OR pg_get_expr(i.indpred, i.indrelid, true) = %(where)s)
+              AND ARRAY(SELECT pg_get_indexdef(i.indexrelid, k, true)
+                        FROM generate_series(1, cardinality(%(keys)s::text[])) AS k
+                        ORDER BY k) = %(keys)s::text[]
+        );
+        """, {"table": index["table"], "keys": index["keys"], "where": index["where"], "unique": index["unique"]})
+    return cur.fetchone()[0]
+
+
+def __plans_sequential_scan(cur, index: dict) -> bool:
+    # the estimated rows of the table, or of all of its partitions. pg_partition_tree() is empty for a plain table,
+    # and reltuples is -1 for a partitioned parent or a table never analyzed
+    cur.execute("""
+        SELECT COALESCE(SUM(GREATEST(c.reltuples, 0)), 0)
+        FROM pg_class AS c
+        WHERE c.oid = to_regclass(quote_ident(%(table)s))
+           OR c.oid IN (SELECT relid FROM pg_partition_tree(to_regclass(quote_ident(%(table)s))));
+        """, {"table": index["table"]})
+    if cur.fetchone()[0] < PLANNER_CHECK_MIN_ROWS:
+        return False
+
+    cur.execute("EXPLAIN (FORMAT JSON) " + index["probe"])
+    plan = cur.fetchone()[0]
+    return not __uses_index(plan[0]["Plan"])
+
+
+def __uses_index(plan: dict) -> bool:
+    return "Index" in plan["Node Type"] or any(__uses_index(child) for child in plan.get("Plans", []))
+
+
+def __get_create_index_statement(index: dict) -> str:
+    return 'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{table}" ({keys}){where};'.format(
+        unique="UNIQUE " if index["unique"] else "", name=index["name"], table=index["table"],
+        keys=", ".join(index["keys"]), where=f' WHERE {index["where"]}' if index["where"] else "")
+
+
+def __create_index(conn, index: dict) -> bool:
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction, and does not block writes to the table while it builds.
+    # A build that failed before leaves an invalid index behind, which is dropped first. A valid index that already
+    # has the name, but not the required keys, is left alone.
+    statement = __get_create_index_statement(index)
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT i.indisvalid
+            FROM pg_index AS i
+            WHERE i.indexrelid = to_regclass(quote_ident(%(name)s));
+            """, {"name": index["name"]})
+        existing = cur.fetchone()
+        if existing is not None and existing[0]:
+            logger.error(f"Could not create index {index['name']}, an index of that name already exists with "
+                         f"other keys")
+            return False
+        if existing is not None:
+            logger.info(f"Dropping invalid index {index['name']} left by an earlier build")
+            cur.execute('DROP INDEX CONCURRENTLY "{name}";'.format(name=index["name"]))
+
+        logger.info(f"Creating missing index {index['name']}: {statement}")
+        cur.execute(statement)
+        cur.execute('ANALYZE "{table}";'.format(table=index["table"]))
+        return True
+    except psycopg2.Error as e:
+        logger.error(f"Could not create index {index['name']}: {e}")
+        return False
+    finally:
+        cur.close()
+        conn.autocommit = autocommit
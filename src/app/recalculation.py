@@ -0,0 +1,446 @@
+import time
+from functools import partial
+
+import psycopg2
+from psycopg2 import extras
+
+from logzero import logger
+from app.recalculation_settings import (CONNECTION_STRING, DRY_RUN, ENABLE_CLOUDWATCH_INTEGRATION, CONNECTION_TIMEOUT,
+                                        APP_VERSION, REGION, CUSTOMER_BATCH_SIZE, CHECKPOINT, RUN_DEADLINE_SECONDS,
+                                        DELTA_CHUNK_SIZE, INCREMENTAL, FULL_RECALCULATION_INTERVAL_HOURS, PARALLELISM,
+                                        MINIMAL_WRITES, INDEX_PREFLIGHT, EXPLAIN_PHASES,
+                                        CLOUDWATCH_PHASE_DURATION_METRIC_NAME, CLOUDWATCH_DELTA_BREAKDOWN,
+                                        CLOUDWATCH_PUBLISH_CONCURRENCY, CLOUDWATCH_PUBLISH_RETRIES, DAEMON,
+                                        DAEMON_INTERVAL_SECONDS, LISTEN, LISTEN_CHANNEL, LISTEN_DEBOUNCE_SECONDS,
+                                        REPLICA_CONNECTION_STRING, REPLICA_MAX_LAG_SECONDS, VERIFY,
+                                        VERIFY_SAMPLE_PERCENT, CLOUDWATCH_INCONSISTENT_CUSTOMERS_METRIC_NAME,
+                                        STATEMENT_TIMEOUT_SECONDS, LOCK_TIMEOUT_SECONDS, TIMEOUT_RETRIES,
+                                        AGGREGATE_CACHE, AGGREGATE_CACHE_FULL_REFRESH_INTERVAL_HOURS,
+                                        DELTA_OUTPUT_FILE, DELTA_OUTPUT_FORMAT, PARTITIONED_RECALCULATION, WORK_MEM,
+                                        CUSTOMERS, SPACES)
+from app.aggregate_cache import refresh_aggregate_cache, get_cached_aggregates_query
+from app.aws_factory import get_aws_client
+from app.batching import (get_customer_ranges, get_customer_partitions, get_recalculation_scope, get_customers_scope,
+                          split_scope, MIN_CUSTOMER, MAX_CUSTOMER)
+from app.change_log import (get_watermark, get_current_watermark, get_changed_spaces, set_watermark,
+                            prune_change_log)
+from app.checkpoint import get_checkpoint, start_checkpoint, checkpointed, finish_checkpoint
+from app.cloudwatch import get_metric_dimensions, publish_metric_data
+from app.daemon import run_daemon
+from app.database import connect_to_postgres, get_connection_config, set_transaction_work_mem
+from app.deltas import (fetch_delta_rows, open_delta_output, new_delta_spool, write_delta_rows,
+                        copy_delta_spool)
+from app.listener import run_listener
+from app.parallel import run_scopes
+from app.partitions import get_partition_scopes
+from app.phases import timed_phase, merge_phases, log_phases
+from app.preflight import check_indexes
+from app.registry import Recalculation
+from app.replica import open_replica_pool, stage_replica_rows
+from app.targets import get_targets
+
+# The staging table a scope's aggregates are copied into from a replica
+REPLICA_STAGING_TABLE = "replica_aggregates"
+
+
+def run_recalculation(recalculation: Recalculation, conn=None, cloudwatch=None, spaces=None, customers=None,
+                      connection_info=None):
+    """Run a recalculation registered in app/registry.py, or only over the given (customer, space) pairs when spaces
+    is set, or only over the customers in the given inclusive (customer_from, customer_to) ranges when customers is
+    set, and publish its metrics with ENABLE_CLOUDWATCH_INTEGRATION set.
+    In daemon and listener mode an open connection and CloudWatch client are passed in and reused across runs;
+    otherwise a connection is opened for the run and closed at the end.
+    connection_info, when given, is the database recalculated in place of CONNECTION_STRING's"""
+    logger.info(f"Running {recalculation.name}")
+    connection_info = connection_info or get_connection_config(CONNECTION_STRING)
+    own_connection = conn is None
+    if own_connection:
+        conn = connect_to_postgres(connection_info=connection_info, connection_timeout=CONNECTION_TIMEOUT)
+    records = __run_sql(recalculation, conn, connection_info, spaces, customers)
+
+    if ENABLE_CLOUDWATCH_INTEGRATION:
+        logger.info("CloudWatch metrics enabled")
+        cloudwatch = cloudwatch or get_aws_client(resource_type="cloudwatch", region=REGION)
+        publish_metrics(recalculation, records, cloudwatch, connection_info)
+
+    if own_connection:
+        conn.close()
+    logger.info(f"{recalculation.name} complete")
+
+    return records
+
+
+def run_service(run_cleanup, listen_sources: list, description: str):
+    """Run run_cleanup as a listener with LISTEN set, as a daemon with DAEMON set, or else once over the customers and
+    spaces given as arguments or in CUSTOMERS and SPACES"""
+    if LISTEN:
+        run_listener(run_cleanup, get_connection_config(CONNECTION_STRING), CONNECTION_TIMEOUT, LISTEN_CHANNEL,
+                     listen_sources, LISTEN_DEBOUNCE_SECONDS,
+                     get_aws_client(resource_type="cloudwatch", region=REGION) if ENABLE_CLOUDWATCH_INTEGRATION else None)
+    elif DAEMON:
+        run_daemon(run_cleanup, get_connection_config(CONNECTION_STRING), CONNECTION_TIMEOUT, DAEMON_INTERVAL_SECONDS,
+                   get_aws_client(resource_type="cloudwatch", region=REGION) if ENABLE_CLOUDWATCH_INTEGRATION else None)
+    else:
+        run_cleanup(**get_targets(description, CUSTOMERS, SPACES))
+
+
+def get_delta_breakdown(recalculation: Recalculation, rows: list, by_space: bool, breakdown=None):
+    """Build the recalculation's delta totals per customer, or per customer and space, optionally adding to an
+    existing breakdown. Keys are (customer,) or (customer, space) tuples"""
+    breakdown = breakdown if breakdown is not None else {}
+    for row in rows:
+        key = recalculation.get_delta_key(row)
+        totals = breakdown.setdefault(key if by_space else key[:1], recalculation.get_delta_totals([]))
+        recalculation.get_delta_totals([row], totals)
+    return breakdown
+
+
+def publish_metrics(recalculation: Recalculation, records: dict, cloudwatch, connection_info: dict) -> list:
+    """Publish the recalculation's delta totals, its phase durations and the customers a verify run found to be
+    inconsistent, and with CLOUDWATCH_DELTA_BREAKDOWN the delta totals of each customer or space. Returns the
+    published metric data"""
+    metric_data = []
+    dimensions = get_metric_dimensions(connection_info["database"], APP_VERSION, recalculation.name)
+    prefix = recalculation.records_prefix
+    delta_metrics = recalculation.get_delta_metrics()
+
+    # When deltas are streamed the totals are built up chunk by chunk and the rows themselves are not kept
+    if f"{prefix}Totals" in records:
+        totals = records[f"{prefix}Totals"]
+    else:
+        for row in records[f"{prefix}s"]:
+            logger.debug(f"{recalculation.delta_name.capitalize()} - {row}")
+        totals = recalculation.get_delta_totals(records[f"{prefix}s"])
+
+    metric_data.extend({
+        'MetricName': metric_name,
+        'Dimensions': dimensions,
+        'Unit': unit,
+        'Value': totals[total]
+    } for total, metric_name, unit in delta_metrics)
+
+    # time spent in each SQL phase, to show which step a slow run spent its time in
+    for phase_name, phase in records.get("phases", {}).items():
+        metric_data.append({
+            'MetricName': CLOUDWATCH_PHASE_DURATION_METRIC_NAME,
+            'Dimensions': dimensions + [{'Name': "PHASE", 'Value': phase_name}],
+            'Unit': 'Seconds',
+            'Value': phase["seconds"]
+        })
+
+    # the number of customers a verify run found to be inconsistent
+    if "verification" in records:
+        metric_data.append({
+            'MetricName': CLOUDWATCH_INCONSISTENT_CUSTOMERS_METRIC_NAME,
+            'Dimensions': dimensions,
+            'Unit': 'Count',
+            'Value': records["verification"]["inconsistentCustomers"]
+        })
+
+    # the same delta metrics for each customer, or each customer and space, to show where drift came from
+    if CLOUDWATCH_DELTA_BREAKDOWN in ("customer", "space"):
+        if f"{prefix}Breakdown" in records:
+            breakdown = records[f"{prefix}Breakdown"]
+        else:
+            breakdown = get_delta_breakdown(recalculation, records[f"{prefix}s"], CLOUDWATCH_DELTA_BREAKDOWN == "space")
+
+        for breakdown_key, key_totals in breakdown.items():
+            key_dimensions = dimensions + [{'Name': name, 'Value': str(value)}
+                                           for name, value in zip(["CUSTOMER", "SPACE"], breakdown_key)]
+            metric_data.extend({
+                'MetricName': metric_name,
+                'Dimensions': key_dimensions,
+                'Unit': unit,
+                'Value': key_totals[total]
+            } for total, metric_name, unit in delta_metrics)
+
+    try:
+        logger.debug(f"Publishing {len(metric_data)} CloudWatch metrics - {metric_data}")
+        publish_metric_data(cloudwatch, metric_data, CLOUDWATCH_PUBLISH_CONCURRENCY, CLOUDWATCH_PUBLISH_RETRIES)
+        return metric_data
+    except Exception as e:
+        logger.exception(f"Error publishing to CloudWatch")
+        raise e
+
+
+def __run_sql(recalculation, conn, connection_info, spaces=None, customers=None):
+    # In incremental mode only the spaces logged in the change log since the last run's watermark are
+    # recalculated. A full recalculation still runs when there is no watermark yet, or when the last
+    # full run is older than FULL_RECALCULATION_INTERVAL_HOURS, as a safety net for missed changes.
+    # In listener mode the notified spaces are passed in, and the watermark is left to the scheduled runs.
+    # A run targeted at given customers or spaces leaves the watermark alone too, and is never a verify run.
+    # A checkpointed full run that was stopped part way through is resumed before any incremental run, and its
+    # watermark is the one taken when it started.
+    name = recalculation.name
+    started = time.monotonic()
+    if INDEX_PREFLIGHT != "off":
+        check_indexes(conn, recalculation.required_indexes, INDEX_PREFLIGHT, DRY_RUN)
+
+    changed_spaces = spaces
+    targeted = spaces is not None or customers is not None
+    verify = VERIFY and not targeted
+    incremental = recalculation.incremental and INCREMENTAL and not targeted and not VERIFY
+    if incremental:
+        watermark = get_watermark(conn, name, FULL_RECALCULATION_INTERVAL_HOURS)
+        new_watermark = get_current_watermark(conn)
+        resumed = get_checkpoint(conn, name) if CHECKPOINT and not DRY_RUN else None
+        if resumed is not None:
+            new_watermark = resumed["TransactionId"]
+        elif watermark is None or watermark["FullRunDue"]:
+            logger.info("Full recalculation due")
+        else:
+            changed_spaces = get_changed_spaces(conn, recalculation.change_log_sources, watermark["TransactionId"])
+
+    # Customers are independent of each other, so a full recalculation can be split into contiguous
+    # customer ranges, each committed in its own transaction. This keeps row locks on the target
+    # tables short-lived; with CUSTOMER_BATCH_SIZE=0 there is a single range covering
+    # every customer, or one range per worker when PARALLELISM is above 1.
+    # When the base table is partitioned by customer there is a scope per partition instead.
+    # In verify mode a sample of spaces is checked without writing anything, and only the customers that look
+    # inconsistent are recalculated, together in a single scope covering all of their spaces.
+    aggregate_query = recalculation.get_aggregate_query(conn)
+    records = __new_records(recalculation)
+
+    # With AGGREGATE_CACHE set, the per-space aggregates are read from a cache table rather than aggregated from
+    # every row, after recomputing the cached aggregates of just the spaces changed since the cache was last
+    # refreshed. Verify mode checks the base tables themselves, so it does not use the cache. Nor does a dry run,
+    # which would otherwise have to commit the cache's refresh, or read aggregates that are out of date.
+    use_cache = AGGREGATE_CACHE and not verify and not DRY_RUN
+    if use_cache:
+        refresh_aggregate_cache(conn, records["phases"], recalculation.cache_table, recalculation.aggregate_keys,
+                                aggregate_query, recalculation.change_log_sources,
+                                AGGREGATE_CACHE_FULL_REFRESH_INTERVAL_HOURS,
+                                [name] if recalculation.incremental and INCREMENTAL else [], EXPLAIN_PHASES)
+
+    verification = None
+    full_run = False
+    if verify:
+        verification = __verify_sampled_spaces(recalculation, conn, aggregate_query)
+        customer_spaces = __get_customer_spaces(recalculation, conn, verification["inconsistentCustomers"])
+        scopes = [get_recalculation_scope(spaces=customer_spaces)] if customer_spaces else []
+    elif customers is not None:
+        scopes = [get_customers_scope(customers)] if customers else []
+    elif changed_spaces is None:
+        full_run = True
+        scopes = None
+        if PARTITIONED_RECALCULATION:
+            scopes = get_partition_scopes(conn, recalculation.partitioned_table, recalculation.customer_tables)
+        if scopes is None:
+            if PARALLELISM > 1 and CUSTOMER_BATCH_SIZE <= 0:
+                customer_ranges = get_customer_partitions(conn, recalculation.customer_tables, PARALLELISM)
+            else:
+                customer_ranges = get_customer_ranges(conn, recalculation.customer_tables, CUSTOMER_BATCH_SIZE)
+            scopes = [get_recalculation_scope(customer_from, customer_to)
+                      for customer_from, customer_to in customer_ranges]
+    elif changed_spaces:
+        scopes = [get_recalculation_scope(spaces=changed_spaces)]
+    else:
+        scopes = []
+
+    # With REPLICA_CONNECTION_STRING set, the per-space aggregates are read from a replica that has caught up
+    # with the primary, and only the results are written to the primary.
+    replica_pool = None
+    if REPLICA_CONNECTION_STRING and scopes and not use_cache:
+        replica_pool = open_replica_pool(conn, get_connection_config(REPLICA_CONNECTION_STRING), CONNECTION_TIMEOUT,
+                                         PARALLELISM, REPLICA_MAX_LAG_SECONDS)
+
+    # With DELTA_OUTPUT_FILE set, the delta rows are written to a file rather than kept in the records.
+    delta_output = None
+    if DELTA_OUTPUT_FILE:
+        records["deltaOutput"] = DELTA_OUTPUT_FILE.format(recalculator=name, database=connection_info["database"])
+        delta_output = open_delta_output(records["deltaOutput"], DELTA_OUTPUT_FORMAT,
+                                         recalculation.delta_output_columns)
+
+    # Each scope returns its own records, which are merged in scope order so the result is the same
+    # however many connections the scopes were spread over.
+    recalculate = partial(__recalculate_scope, recalculation=recalculation, aggregate_query=aggregate_query,
+                          replica_pool=replica_pool, use_cache=use_cache)
+
+    # With CHECKPOINT set, each batch of a full run records its customer range in its own transaction, and a
+    # resumed run only recalculates the customers no recorded range covers. With RUN_DEADLINE_SECONDS the run stops
+    # starting batches once it has run that long, leaving the rest to the next run.
+    checkpoint = None
+    deadline = None
+    if CHECKPOINT and full_run and not DRY_RUN:
+        checkpoint = start_checkpoint(conn, name, scopes)
+    if checkpoint is not None:
+        scopes = checkpoint["scopes"]
+        recalculate = checkpointed(recalculate, name, checkpoint)
+        deadline = started + RUN_DEADLINE_SECONDS if RUN_DEADLINE_SECONDS > 0 else None
+
+    try:
+        for scope_records in run_scopes(conn, connection_info, CONNECTION_TIMEOUT, scopes, recalculate,
+                                        PARALLELISM, DRY_RUN, STATEMENT_TIMEOUT_SECONDS, LOCK_TIMEOUT_SECONDS,
+                                        TIMEOUT_RETRIES, partial(split_scope, tables=recalculation.customer_tables),
+                                        deadline):
+            __merge_records(recalculation, records, scope_records, delta_output)
+    finally:
+        if replica_pool is not None:
+            replica_pool.closeall()
+        if delta_output is not None:
+            delta_output.close()
+
+    if checkpoint is not None:
+        records["checkpoint"] = finish_checkpoint(conn, name, checkpoint)
+
+    # a full run that stopped early has not yet seen every change since its watermark
+    if incremental and not DRY_RUN and records.get("checkpoint", {}).get("complete", True):
+        set_watermark(conn, name, new_watermark, full_run=changed_spaces is None)
+        prune_change_log(conn, recalculation.change_log_sources, new_watermark,
+                         [recalculation.cache_table] if AGGREGATE_CACHE else [])
+        conn.commit()
+
+    if verification is not None:
+        records["verification"] = {"sampledSpaces": verification["sampledSpaces"],
+                                   "inconsistentCustomers": len(verification["inconsistentCustomers"])}
+
+    log_phases(records["phases"])
+    __log_summary(recalculation, records)
+
+    if DRY_RUN:
+        logger.info(f"DRY RUN ENABLED. Changes have not been committed to the database")
+
+    return records
+
+
+def __verify_sampled_spaces(recalculation, conn, aggregate_query):
+    cur = conn.cursor()
+
+    # Sample spaces from both the base and target tables, so spaces missing from the targets and spaces that no
+    # longer have any rows can both be picked
+    cur.execute(recalculation.verify_sample_query, {"percent": VERIFY_SAMPLE_PERCENT})
+    sampled_spaces = [(row[0], row[1]) for row in cur.fetchall()]
+
+    cur.execute(recalculation.verify_query.format(aggregates=aggregate_query),
+                get_recalculation_scope(spaces=sampled_spaces))
+    inconsistent_customers = [row[0] for row in cur.fetchall()]
+    cur.close()
+
+    logger.info(f"Verified {len(sampled_spaces)} sampled spaces, {len(inconsistent_customers)} customers look "
+                f"inconsistent: {inconsistent_customers}")
+    return {"sampledSpaces": len(sampled_spaces), "inconsistentCustomers": inconsistent_customers}
+
+
+def __get_customer_spaces(recalculation, conn, customers):
+    cur = conn.cursor()
+    cur.execute(recalculation.customer_spaces_query, {"customers": customers})
+    customer_spaces = [(row[0], row[1]) for row in cur.fetchall()]
+    cur.close()
+    return customer_spaces
+
+
+def __log_summary(recalculation, records):
+    # the rows themselves are only logged at debug level, see publish_metrics
+    prefix = recalculation.records_prefix
+    if f"{prefix}s" in records:
+        summary = f"{len(records[f'{prefix}s'])} {recalculation.delta_name}s"
+    else:
+        summary = (f"{records[f'{prefix}Count']} {recalculation.delta_name}s, "
+                   f"totals {records[f'{prefix}Totals']}")
+    if "deltaOutput" in records:
+        summary += f", written to {records['deltaOutput']}"
+    if "verification" in records:
+        summary += f", verification {records['verification']}"
+    logger.info(summary)
+
+
+def __new_records(recalculation):
+    # With DELTA_CHUNK_SIZE or DELTA_OUTPUT_FILE set, delta rows are streamed and only their count and totals are
+    # kept, so memory use does not grow with the number of changed spaces.
+    # A per-customer (or per-space) breakdown for CloudWatch is then built up chunk by chunk in the same way.
+    prefix = recalculation.records_prefix
+    if DELTA_CHUNK_SIZE > 0 or DELTA_OUTPUT_FILE:
+        records = {
+            f"{prefix}Count": 0,
+            f"{prefix}Totals": recalculation.get_delta_totals([]),
+            "phases": {}
+        }
+        if ENABLE_CLOUDWATCH_INTEGRATION and CLOUDWATCH_DELTA_BREAKDOWN in ("customer", "space"):
+            records[f"{prefix}Breakdown"] = {}
+        return records
+
+    return {
+        f"{prefix}s": [],
+        "phases": {}
+    }
+
+
+def __merge_records(recalculation, records, scope_records, delta_output=None):
+    prefix = recalculation.records_prefix
+    merge_phases(records["phases"], scope_records["phases"])
+    if delta_output is not None:
+        copy_delta_spool(scope_records.pop("deltaSpool"), delta_output)
+
+    if f"{prefix}s" in records:
+        records[f"{prefix}s"].extend(scope_records[f"{prefix}s"])
+        return
+
+    records[f"{prefix}Count"] += scope_records[f"{prefix}Count"]
+    __add_totals(records[f"{prefix}Totals"], scope_records[f"{prefix}Totals"])
+    for breakdown_key, key_totals in scope_records.get(f"{prefix}Breakdown", {}).items():
+        __add_totals(records[f"{prefix}Breakdown"].setdefault(breakdown_key, recalculation.get_delta_totals([])),
+                     key_totals)
+
+
+def __add_totals(totals, added):
+    for total in totals:
+        totals[total] += added[total]
+
+
+def __add_deltas(recalculation, records, rows):
+    prefix = recalculation.records_prefix
+    if "deltaSpool" in records:
+        write_delta_rows(records["deltaSpool"], DELTA_OUTPUT_FORMAT, recalculation.delta_output_columns, rows)
+
+    if f"{prefix}s" in records:
+        records[f"{prefix}s"].extend(rows)
+        return
+
+    chunk_totals = recalculation.get_delta_totals(rows)
+    logger.info(f"{recalculation.delta_name.capitalize()} chunk - {len(rows)} rows, totals {chunk_totals}")
+    records[f"{prefix}Count"] += len(rows)
+    __add_totals(records[f"{prefix}Totals"], chunk_totals)
+    if f"{prefix}Breakdown" in records:
+        get_delta_breakdown(recalculation, rows, CLOUDWATCH_DELTA_BREAKDOWN == "space", records[f"{prefix}Breakdown"])
+
+
+def __recalculate_scope(conn, scope, recalculation, aggregate_query, replica_pool=None, use_cache=False):
+    if scope["space_customers"] is None and (scope["customer_from"], scope["customer_to"]) != (MIN_CUSTOMER,
+                                                                                              MAX_CUSTOMER):
+        logger.info(f"Recalculating customers {scope['customer_from']} to {scope['customer_to']}")
+
+    records = __new_records(recalculation)
+    if DELTA_OUTPUT_FILE:
+        records["deltaSpool"] = new_delta_spool()
+    params = {**scope, "minimal_writes": MINIMAL_WRITES}
+    set_transaction_work_mem(conn, WORK_MEM)
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    # With the aggregate cache the scope's aggregates are read from the cache table. When reading from a replica,
+    # the aggregate query runs there and its rows are staged in a temporary table the target tables are written from.
+    aggregate_keys = recalculation.aggregate_keys
+    if use_cache:
+        aggregate_query = get_cached_aggregates_query(recalculation.cache_table, aggregate_keys)
+    elif replica_pool is not None:
+        with timed_phase(conn, cur, records["phases"], recalculation.aggregate_phase, REPLICA_STAGING_TABLE,
+                         aggregate_query, params, False) as phase:
+            phase["rowsReturned"] += stage_replica_rows(replica_pool, cur, aggregate_query, params,
+                                                        REPLICA_STAGING_TABLE, recalculation.aggregate_columns)
+        aggregate_query = "SELECT * FROM {table} ORDER BY {keys}".format(
+            table=REPLICA_STAGING_TABLE, keys=", ".join(f'"{key}"' for key in aggregate_keys))
+
+    recalculation.write(partial(__run_phase, conn, cur, recalculation, records, params), aggregate_query)
+    cur.close()
+
+    return records
+
+
+def __run_phase(conn, cur, recalculation, records, params, name, table, query, deltas=None, get_delta=None):
+    # A statement that returns delta rows reads them through a cursor named deltas, in chunks of DELTA_CHUNK_SIZE
+    with timed_phase(conn, cur, records["phases"], name, table, query, params, EXPLAIN_PHASES) as phase:
+        if deltas is None:
+            cur.execute(query, params)
+            return
+        for chunk in fetch_delta_rows(conn, cur, query, params, deltas, DELTA_CHUNK_SIZE):
+            phase["rowsReturned"] += len(chunk)
+            __add_deltas(recalculation, records, chunk if get_delta is None else [get_delta(row) for row in chunk])
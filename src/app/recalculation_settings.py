@@ -0,0 +1,90 @@
+import os
+
+
+def _get_boolean(env_name: str, fallback: str) -> bool:
+    return os.environ.get(env_name, fallback).lower() in ("true", "t", "1")
+
+
+def _get_int(env_name: str, fallback: str) -> int:
+    return int(os.environ.get(env_name, fallback))
+
+
+# AWS
+REGION = os.environ.get("AWS_REGION", "eu-west-1")
+ENABLE_CLOUDWATCH_INTEGRATION = _get_boolean("ENABLE_CLOUDWATCH_INTEGRATION", "True")
+CLOUDWATCH_PHASE_DURATION_METRIC_NAME = os.environ.get("CLOUDWATCH_PHASE_DURATION_METRIC_NAME", "PhaseDuration")
+CLOUDWATCH_INCONSISTENT_CUSTOMERS_METRIC_NAME = os.environ.get("CLOUDWATCH_INCONSISTENT_CUSTOMERS_METRIC_NAME",
+                                                               "InconsistentCustomers")
+# Also publish the delta metrics per "customer", or per customer and "space". "none" publishes only the totals
+CLOUDWATCH_DELTA_BREAKDOWN = os.environ.get("CLOUDWATCH_DELTA_BREAKDOWN", "none").lower()
+# Number of PutMetricData requests sent at the same time, and the number of retries for a throttled request
+CLOUDWATCH_PUBLISH_CONCURRENCY = _get_int("CLOUDWATCH_PUBLISH_CONCURRENCY", "4")
+CLOUDWATCH_PUBLISH_RETRIES = _get_int("CLOUDWATCH_PUBLISH_RETRIES", "3")
+APP_VERSION = os.environ.get('APP_VERSION', "1.0")
+
+# Postgres
+CONNECTION_STRING = os.environ.get("CONNECTION_STRING")
+CONNECTION_TIMEOUT = os.environ.get("CONNECTION_TIMEOUT")
+# Read replica to compute aggregates on, and how long to wait for it to replay the primary's latest changes
+# before reading from the primary instead
+REPLICA_CONNECTION_STRING = os.environ.get("REPLICA_CONNECTION_STRING")
+REPLICA_MAX_LAG_SECONDS = _get_int("REPLICA_MAX_LAG_SECONDS", "60")
+DRY_RUN = _get_boolean("DRY_RUN", "False")
+# Longest time each statement of a customer batch may run, and may wait for a row lock, in seconds. 0 for no limit
+STATEMENT_TIMEOUT_SECONDS = float(os.environ.get("STATEMENT_TIMEOUT_SECONDS", "0"))
+LOCK_TIMEOUT_SECONDS = float(os.environ.get("LOCK_TIMEOUT_SECONDS", "0"))
+# Number of times a batch that timed out, or hit a serialization failure or deadlock, is retried as two smaller ones
+TIMEOUT_RETRIES = _get_int("TIMEOUT_RETRIES", "3")
+# Read per-space aggregates from a cache table refreshed from the change log, rebuilding the whole cache every
+# AGGREGATE_CACHE_FULL_REFRESH_INTERVAL_HOURS
+AGGREGATE_CACHE = _get_boolean("AGGREGATE_CACHE", "False")
+AGGREGATE_CACHE_FULL_REFRESH_INTERVAL_HOURS = _get_int("AGGREGATE_CACHE_FULL_REFRESH_INTERVAL_HOURS", "24")
+# Number of customers recalculated (and committed) per transaction. 0 runs every customer in one transaction
+CUSTOMER_BATCH_SIZE = _get_int("CUSTOMER_BATCH_SIZE", "0")
+# Record the customer range of each batch a full recalculation commits, so a run that is stopped or killed part way
+# through is resumed from the ranges it has not committed by the next one. With RUN_DEADLINE_SECONDS, a
+# checkpointed run starts no new batches after running that long. 0 for no limit
+CHECKPOINT = _get_boolean("CHECKPOINT", "False")
+RUN_DEADLINE_SECONDS = _get_int("RUN_DEADLINE_SECONDS", "0")
+# Number of delta rows read at a time from a server-side cursor. 0 fetches every delta row into memory at once
+DELTA_CHUNK_SIZE = _get_int("DELTA_CHUNK_SIZE", "0")
+# Write every delta row to this file as compact "ndjson" or "csv", naming the columns once, instead of returning and
+# logging the rows. {recalculator} and {database} in the path are replaced with the recalculator's and database's
+# names
+DELTA_OUTPUT_FILE = os.environ.get("DELTA_OUTPUT_FILE", "")
+DELTA_OUTPUT_FORMAT = os.environ.get("DELTA_OUTPUT_FORMAT", "ndjson").lower()
+# Only recalculate spaces recorded in the change log since the last run (see sql/create_change_log.sql), for the
+# recalculations that support it
+INCREMENTAL = _get_boolean("INCREMENTAL", "False")
+# In incremental mode, run a full recalculation when the last one is older than this
+FULL_RECALCULATION_INTERVAL_HOURS = _get_int("FULL_RECALCULATION_INTERVAL_HOURS", "24")
+# Number of connections used to recalculate customer partitions at the same time
+PARALLELISM = _get_int("PARALLELISM", "1")
+# When a recalculation's base table is range or hash partitioned by customer, recalculate one partition at a time
+PARTITIONED_RECALCULATION = _get_boolean("PARTITIONED_RECALCULATION", "False")
+# Memory each sort or hash of a customer batch or partition may use, e.g. 64MB. Empty keeps the server's work_mem
+WORK_MEM = os.environ.get("WORK_MEM", "")
+# Only rewrite rows whose values have changed. Customer storage then stamps LastCalculated on the customer row
+MINIMAL_WRITES = _get_boolean("MINIMAL_WRITES", "False")
+# Before a run, check the indexes the recalculation relies on exist: "off", "warn", "abort" or "create" them
+# concurrently when missing
+INDEX_PREFLIGHT = os.environ.get("INDEX_PREFLIGHT", "off").lower()
+# Log EXPLAIN (ANALYZE, BUFFERS) output for each SQL phase. Each statement is then run twice, once rolled back
+EXPLAIN_PHASES = _get_boolean("EXPLAIN_PHASES", "False")
+# Check a TABLESAMPLE of VERIFY_SAMPLE_PERCENT percent of spaces without writing, and only recalculate the customers
+# that look inconsistent
+VERIFY = _get_boolean("VERIFY", "False")
+VERIFY_SAMPLE_PERCENT = float(os.environ.get("VERIFY_SAMPLE_PERCENT", "1"))
+
+# Service
+# Limit a one-off run to these customers and customer ranges, e.g. "2,5,10-20", and to these spaces, as
+# "customer/space" or bare spaces of every listed customer. Overridden by --customers and --spaces
+CUSTOMERS = os.environ.get("CUSTOMERS", "")
+SPACES = os.environ.get("SPACES", "")
+# Keep running, recalculating every DAEMON_INTERVAL_SECONDS (or on SIGUSR1) over a reused connection
+DAEMON = _get_boolean("DAEMON", "False")
+DAEMON_INTERVAL_SECONDS = _get_int("DAEMON_INTERVAL_SECONDS", "300")
+# Recalculate just the spaces sent as notifications on LISTEN_CHANNEL, LISTEN_DEBOUNCE_SECONDS after the first one
+LISTEN = _get_boolean("LISTEN", "False")
+LISTEN_CHANNEL = os.environ.get("LISTEN_CHANNEL", "recalculator_changes")
+LISTEN_DEBOUNCE_SECONDS = float(os.environ.get("LISTEN_DEBOUNCE_SECONDS", "5"))
@@ -0,0 +1,23 @@
+import os
+
+from app.recalculation_settings import (_get_int, REGION, ENABLE_CLOUDWATCH_INTEGRATION, CONNECTION_STRING,
+                                        CONNECTION_TIMEOUT, REPLICA_CONNECTION_STRING, DELTA_OUTPUT_FILE, CUSTOMERS,
+                                        SPACES, DAEMON, DAEMON_INTERVAL_SECONDS, LISTEN, LISTEN_CHANNEL,
+                                        LISTEN_DEBOUNCE_SECONDS)
+
+# Settings shared with each recalculation are in app/recalculation_settings.py
+
+
+def _get_list(env_name: str) -> list:
+    return [value.strip() for value in os.environ.get(env_name, "").split(",") if value.strip()]
+
+
+# Postgres
+# Comma separated connection strings of several databases to recalculate in one run, in place of CONNECTION_STRING,
+# up to DATABASE_PARALLELISM of them at the same time
+CONNECTION_STRINGS = _get_list("CONNECTION_STRINGS")
+DATABASE_PARALLELISM = _get_int("DATABASE_PARALLELISM", "4")
+
+# Service
+# Comma separated names of the recalculations to run, e.g. "customer_storage_recalculator". Empty runs all of them
+RECALCULATIONS = _get_list("RECALCULATIONS")
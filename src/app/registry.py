@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+from typing import Callable
+
+from logzero import logger
+
+# Definitions of the recalculations that can be run together by recalculator.py, by name, in the order they were
+# registered
+RECALCULATIONS = {}
+
+
+@dataclass(frozen=True)
+class Recalculation:
+    """The definition of a recalculation, run by app/recalculation.py.
+
+    base_tables are the tables it aggregates, target_tables the tables it writes, and listen_sources the tables
+    whose change notifications it recalculates in listener mode. Customers are batched over customer_tables, and
+    partitioned_table is the base table whose customer partitions are recalculated one at a time.
+    required_indexes are checked before a run, see app/preflight.py.
+
+    get_aggregate_query(conn) returns the query of the fresh per-space aggregates of a scope, whose rows have
+    aggregate_keys and the columns of aggregate_columns. They are cached in cache_table, refreshed from the change
+    logged for change_log_sources, or staged from a replica in the aggregate_phase phase. With incremental set, the
+    recalculation supports INCREMENTAL runs over the spaces in the change log.
+    write(run_phase, aggregate_query) writes a scope's aggregates to the target tables, running each statement
+    through run_phase(name, table, query, deltas=None, get_delta=None); a statement that returns delta rows names
+    the cursor they are read through as deltas, and get_delta optionally maps each row.
+
+    verify_sample_query picks the sampled spaces of a verify run, and verify_query, with an {aggregates}
+    placeholder for the aggregate query, the customers among them that look inconsistent.
+    customer_spaces_query returns every space of the given %(customers)s.
+
+    The delta rows are returned in the records under records_prefix, and described as delta_name in the logs;
+    delta_output_columns are written to DELTA_OUTPUT_FILE. get_delta_totals(rows, totals=None) sums delta rows,
+    get_delta_key(row) is the row's (customer, space), and get_delta_metrics() returns a (total, metric name, unit)
+    for each metric published from the totals."""
+    name: str
+    base_tables: list
+    target_tables: list
+    listen_sources: list
+    customer_tables: list = None
+    partitioned_table: str = None
+    required_indexes: list = None
+    get_aggregate_query: Callable = None
+    aggregate_columns: str = None
+    aggregate_keys: tuple = None
+    aggregate_phase: str = None
+    cache_table: str = None
+    change_log_sources: list = None
+    incremental: bool = False
+    write: Callable = None
+    verify_sample_query: str = None
+    verify_query: str = None
+    customer_spaces_query: str = None
+    records_prefix: str = None
+    delta_name: str = None
+    delta_output_columns: list = None
+    get_delta_totals: Callable = None
+    get_delta_key: Callable = None
+    get_delta_metrics: Callable = None
+
+
+def register_recalculation(recalculation: Recalculation) -> Recalculation:
+    """Register a recalculation under its name, to be run by recalculator.py"""
+    RECALCULATIONS[recalculation.name] = recalculation
+    return recalculation
+
+
+def get_recalculations(names: list) -> list:
+    """Return the registered recalculations with the given names, or every registered recalculation when names is
+    empty, in the order they were registered"""
+    unknown = [name for name in names if name not in RECALCULATIONS]
+    if unknown:
+        raise ValueError(f"Unknown recalculations {unknown}, expected some of {list(RECALCULATIONS)}")
+
+    selected = [RECALCULATIONS[name] for name in RECALCULATIONS if not names or name in names]
+    logger.debug(f"Recalculations to run - {[recalculation.name for recalculation in selected]}")
+    return selected
+
+
+def get_listen_sources(recalculations: list) -> list:
+    """The tables whose change notifications any of the given recalculations recalculate"""
+    sources = []
+    for recalculation in recalculations:
+        sources.extend(source for source in recalculation.listen_sources if source not in sources)
+    return sources
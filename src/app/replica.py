@@ -0,0 +1,80 @@
+import time
+
+import psycopg2
+from logzero import logger
+
+from app.database import create_connection_pool
+from app.staging import create_staging_table, copy_query_result
+
+# Time between checks of how far a lagging replica has replayed
+REPLAY_POLL_SECONDS = 1.0
+
+
+def open_replica_pool(conn, replica_connection_info: dict, connection_timeout: str, size: int, max_lag_seconds: int):
+    """Open a pool of up to size connections to a read replica, once the replica has replayed every change
+    committed on the primary (conn) so far. If it has not caught up within max_lag_seconds, the pool is closed
+    and None is returned, so the caller reads from the primary instead"""
+    replica_pool = create_connection_pool(replica_connection_info, connection_timeout, max(size, 1))
+    replica_conn = replica_pool.getconn()
+    try:
+        caught_up = __wait_for_replay(conn, replica_conn, max_lag_seconds)
+    except psycopg2.Error as e:
+        logger.warning(f"Could not check replica lag, reading from the primary: {e}")
+        caught_up = False
+    finally:
+        replica_pool.putconn(replica_conn)
+
+    if not caught_up:
+        replica_pool.closeall()
+        return None
+
+    logger.info("Reading aggregates from the replica")
+    return replica_pool
+
+
+def stage_replica_rows(replica_pool, cur, query: str, params: dict, staging_table: str, columns: str) -> int:
+    """Run an aggregate query on a replica connection and copy its rows into a temporary staging table on the
+    primary, through cur, with COPY. The staging table is created with the given column definitions and dropped at
+    the end of the transaction. Returns the number of rows staged"""
+    create_staging_table(cur, staging_table, columns)
+
+    replica_conn = replica_pool.getconn()
+    try:
+        replica_conn.set_session(readonly=True)
+        replica_cur = replica_conn.cursor()
+        staged = copy_query_result(replica_cur, query, params, cur, staging_table)
+        replica_cur.close()
+    finally:
+        replica_conn.rollback()
+        replica_pool.putconn(replica_conn)
+
+    return staged
+
+
+def __wait_for_replay(conn, replica_conn, max_lag_seconds: int) -> bool:
+    cur = conn.cursor()
+    cur.execute("SELECT pg_current_wal_lsn()::text;")
+    primary_lsn = cur.fetchone()[0]
+    cur.close()
+
+    deadline = time.monotonic() + max_lag_seconds
+    replica_cur = replica_conn.cursor()
+    try:
+        while True:
+            replica_cur.execute("SELECT pg_is_in_recovery(), pg_last_wal_replay_lsn() >= %(lsn)s::pg_lsn;",
+                                {"lsn": primary_lsn})
+            in_recovery, replayed = replica_cur.fetchone()
+            replica_conn.rollback()
+
+            if not in_recovery:
+                logger.warning("Replica connection is not to a standby server, reading from it without a lag check")
+                return True
+            if replayed:
+                return True
+            if time.monotonic() >= deadline:
+                logger.warning(f"Replica has not replayed up to {primary_lsn} within {max_lag_seconds} seconds, "
+                               f"reading from the primary")
+                return False
+            time.sleep(REPLAY_POLL_SECONDS)
+    finally:
+        replica_cur.close()
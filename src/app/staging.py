@@ -0,0 +1,25 @@
+import tempfile
+
+from psycopg2 import sql
+
+# Bytes of COPY data held in memory before it is spooled to a temporary file. Kept small, as the recalculators run
+# in containers with little memory and a replica's aggregates for every space can be far larger
+SPOOL_MAX_BYTES = 4 * 1024 * 1024
+
+
+def create_staging_table(cur, staging_table: str, columns: str):
+    """Create a temporary staging table with the given column definitions, dropped at the end of the transaction"""
+    cur.execute(sql.SQL("CREATE TEMP TABLE {} ({}) ON COMMIT DROP;").format(sql.Identifier(staging_table),
+                                                                             sql.SQL(columns)))
+
+
+def copy_query_result(source_cur, query: str, params: dict, cur, staging_table: str) -> int:
+    """Copy the rows returned by a query on one connection (source_cur) into a staging table on another (cur) with
+    COPY, without building a Python object for each row. The rows pass through a buffer that is spooled to disk
+    once it outgrows SPOOL_MAX_BYTES. Returns the number of rows copied"""
+    copy_out = source_cur.mogrify("COPY (" + query + ") TO STDOUT", params)
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as buffer:
+        source_cur.copy_expert(copy_out.decode(), buffer)
+        buffer.seek(0)
+        cur.copy_expert(sql.SQL("COPY {} FROM STDIN").format(sql.Identifier(staging_table)), buffer)
+    return cur.rowcount
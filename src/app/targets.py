@@ -0,0 +1,72 @@
+import argparse
+
+
+def parse_customer_ranges(value: str) -> list:
+    """Parse a comma-separated list of customers and inclusive customer ranges, e.g. "2,5,10-20", into a list of
+    (customer_from, customer_to) ranges"""
+    ranges = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        customer_from, _, customer_to = item.partition("-")
+        try:
+            ranges.append((int(customer_from), int(customer_to or customer_from)))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid customer or customer range {item!r}")
+        if ranges[-1][0] > ranges[-1][1]:
+            raise argparse.ArgumentTypeError(f"customer range {item!r} is empty")
+    return ranges
+
+
+def parse_spaces(value: str) -> list:
+    """Parse a comma-separated list of spaces, each either "customer/space" or a bare space of every targeted
+    customer, e.g. "2/1,2/5" or "1,5", into a list of (customer, space) pairs with a customer of None for bare
+    spaces"""
+    spaces = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        customer, _, space = item.rpartition("/")
+        try:
+            spaces.append((int(customer) if customer else None, int(space)))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid space {item!r}")
+    return spaces
+
+
+def get_targets(description: str, customers: str, spaces: str, args: list = None) -> dict:
+    """Read the customers and spaces a one-off run is limited to from the command line, falling back to the given
+    customers and spaces settings (see parse_customer_ranges and parse_spaces).
+
+    Returns the run_cleanup keyword arguments for the target: customer ranges as "customers", or (customer, space)
+    pairs as "spaces", where bare spaces are paired with every targeted customer. Returns an empty dict when
+    nothing is targeted, for a run over every customer."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--customers", type=parse_customer_ranges, default=parse_customer_ranges(customers),
+                        metavar="CUSTOMERS", help='customers and customer ranges to recalculate, e.g. "2,5,10-20" '
+                                                  "(default CUSTOMERS)")
+    parser.add_argument("--spaces", type=parse_spaces, default=parse_spaces(spaces), metavar="SPACES",
+                        help='spaces to recalculate, as "customer/space", or bare spaces of every customer in '
+                             '--customers, e.g. "2/1,2/5" (default SPACES)')
+    arguments = parser.parse_args(args)
+
+    if not arguments.spaces:
+        return {"customers": arguments.customers} if arguments.customers else {}
+
+    if any(customer is None for customer, _ in arguments.spaces):
+        if not arguments.customers:
+            parser.error("bare spaces need --customers")
+        if sum(customer_to - customer_from + 1 for customer_from, customer_to in arguments.customers) > 10000:
+            parser.error("bare spaces can only be paired with up to 10000 customers")
+
+    targeted_spaces = set()
+    for customer, space in arguments.spaces:
+        if customer is not None:
+            targeted_spaces.add((customer, space))
+            continue
+        for customer_from, customer_to in arguments.customers:
+            targeted_spaces.update((targeted_customer, space)
+                                   for targeted_customer in range(customer_from, customer_to + 1))
+    return {"spaces": sorted(targeted_spaces)}
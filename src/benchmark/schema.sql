@@ -0,0 +1,52 @@
+-- Minimal copy of the DLCS tables read and written by the recalculators, with the keys and indexes
+-- the recalculation queries rely on. Only the columns the recalculators use are included.
+CREATE TABLE "Images" (
+    "Id"       varchar(500) PRIMARY KEY,
+    "Customer" integer NOT NULL,
+    "Space"    integer NOT NULL
+);
+CREATE INDEX "IX_Images_Customer_Space" ON "Images" ("Customer", "Space");
+
+CREATE TABLE "ImageStorage" (
+    "Id"                 varchar(500) NOT NULL,
+    "Customer"           integer NOT NULL,
+    "Space"              integer NOT NULL,
+    "ThumbnailSize"      bigint NOT NULL DEFAULT 0,
+    "Size"               bigint NOT NULL DEFAULT 0,
+    "LastChecked"        timestamp,
+    "CheckingInProgress" boolean NOT NULL DEFAULT false,
+    "AdjunctSize"        bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY ("Id", "Customer", "Space")
+);
+CREATE INDEX "IX_ImageStorage_Customer_Space" ON "ImageStorage" ("Customer", "Space");
+
+CREATE TABLE "Adjuncts" (
+    "Id"      varchar(500) PRIMARY KEY,
+    "AssetId" varchar(500) NOT NULL,
+    "Origin"  varchar(1000)
+);
+CREATE INDEX "IX_Adjuncts_AssetId" ON "Adjuncts" ("AssetId");
+
+CREATE TABLE "CustomerStorage" (
+    "Customer"                  integer NOT NULL,
+    "StoragePolicy"             varchar(500) NOT NULL,
+    "NumberOfStoredImages"      bigint NOT NULL,
+    "TotalSizeOfStoredImages"   bigint NOT NULL,
+    "TotalSizeOfThumbnails"     bigint NOT NULL,
+    "LastCalculated"            timestamp,
+    "Space"                     integer,
+    "NumberOfStoredAdjuncts"    bigint NOT NULL DEFAULT 0,
+    "TotalSizeOfStoredAdjuncts" bigint NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX "IX_CustomerStorage_Customer_Space" ON "CustomerStorage" ("Customer", "Space")
+    WHERE "Space" IS NOT NULL;
+CREATE UNIQUE INDEX "IX_CustomerStorage_Customer" ON "CustomerStorage" ("Customer")
+    WHERE "Space" IS NULL;
+
+CREATE TABLE "EntityCounters" (
+    "Type"     varchar(100) NOT NULL,
+    "Scope"    varchar(100) NOT NULL,
+    "Next"     bigint NOT NULL,
+    "Customer" integer NOT NULL,
+    PRIMARY KEY ("Type", "Scope", "Customer")
+);
@@ -0,0 +1,167 @@
+import os
+
+from psycopg2 import sql
+from logzero import logger
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), "schema.sql")
+
+# Tables written by the recalculators. A drifted copy of each is kept so every benchmark run starts
+# from the same state.
+TARGET_TABLES = ["CustomerStorage", "EntityCounters"]
+
+SCENARIOS = {
+    # a typical installation: a modest number of customers and evenly sized spaces
+    "default": {
+        "customers": 50, "spaces": 10, "images_per_space": 100,
+        "huge_spaces": 0, "huge_space_images": 0, "adjunct_fraction": 0.2, "drift": 0.05, "seed": 0.5
+    },
+    # many customers with only a few small spaces each
+    "many-customers": {
+        "customers": 5000, "spaces": 3, "images_per_space": 10,
+        "huge_spaces": 0, "huge_space_images": 0, "adjunct_fraction": 0.1, "drift": 0.05, "seed": 0.5
+    },
+    # a few spaces holding most of the images
+    "huge-spaces": {
+        "customers": 20, "spaces": 5, "images_per_space": 20,
+        "huge_spaces": 3, "huge_space_images": 200000, "adjunct_fraction": 0.5, "drift": 0.05, "seed": 0.5
+    },
+    # most stored totals are wrong, as after a bulk re-ingest
+    "heavy-drift": {
+        "customers": 200, "spaces": 10, "images_per_space": 50,
+        "huge_spaces": 0, "huge_space_images": 0, "adjunct_fraction": 0.2, "drift": 0.9, "seed": 0.5
+    },
+}
+
+
+def create_schema(conn):
+    """Create the synthetic DLCS tables"""
+    cur = conn.cursor()
+    with open(SCHEMA_FILE) as schema:
+        cur.execute(schema.read())
+    conn.commit()
+    cur.close()
+
+
+def generate(conn, scenario: dict):
+    """Fill the synthetic tables for a scenario, with stored totals that have drifted from the source
+    tables by the scenario's drift fraction, and keep a copy of the drifted target tables"""
+    logger.info(f"Generating synthetic data - {scenario}")
+    cur = conn.cursor()
+    cur.execute("SELECT setseed(%(seed)s);", scenario)
+
+    # evenly sized spaces, plus the huge spaces in space 1000 of the first customers
+    cur.execute("""
+        INSERT INTO "Images" ("Id", "Customer", "Space")
+        SELECT c || '/' || s || '/' || i, c, s
+        FROM generate_series(1, %(customers)s) AS c,
+             generate_series(0, %(spaces)s - 1) AS s,
+             generate_series(1, %(images_per_space)s) AS i
+        UNION ALL
+        SELECT c || '/1000/' || i, c, 1000
+        FROM generate_series(1, %(huge_spaces)s) AS c,
+             generate_series(1, %(huge_space_images)s) AS i;
+        """, scenario)
+
+    cur.execute("""
+        INSERT INTO "ImageStorage" ("Id", "Customer", "Space", "ThumbnailSize", "Size", "LastChecked", "AdjunctSize")
+        SELECT "Id", "Customer", "Space", (random() * 100000)::bigint, (random() * 10000000)::bigint, now(),
+               CASE WHEN random() < %(adjunct_fraction)s THEN (random() * 100000)::bigint ELSE 0 END
+        FROM "Images";
+        """, scenario)
+
+    # most adjuncts are hosted; the rest have no origin and are not counted
+    cur.execute("""
+        INSERT INTO "Adjuncts" ("Id", "AssetId", "Origin")
+        SELECT "Id" || '/adjunct', "Id", CASE WHEN random() < 0.8 THEN 's3://synthetic/' || "Id" END
+        FROM "Images"
+        WHERE random() < %(adjunct_fraction)s;
+        """, scenario)
+
+    cur.execute("""
+        INSERT INTO "CustomerStorage" ("Customer", "StoragePolicy", "NumberOfStoredImages", "TotalSizeOfStoredImages",
+                                       "TotalSizeOfThumbnails", "NumberOfStoredAdjuncts", "TotalSizeOfStoredAdjuncts",
+                                       "LastCalculated", "Space")
+        SELECT i."Customer", 'default', i."Images", i."Size", i."ThumbnailSize", COALESCE(a."Adjuncts", 0),
+               i."AdjunctSize", now(), i."Space"
+        FROM (SELECT "Customer", "Space", COUNT(*) AS "Images", SUM("Size") AS "Size",
+                     SUM("ThumbnailSize") AS "ThumbnailSize", SUM("AdjunctSize") AS "AdjunctSize"
+              FROM "ImageStorage"
+              GROUP BY "Customer", "Space") AS i
+        LEFT JOIN (SELECT im."Customer", im."Space", COUNT(*) AS "Adjuncts"
+                   FROM "Adjuncts" ad
+                   JOIN "Images" im ON im."Id" = ad."AssetId"
+                   WHERE ad."Origin" IS NOT NULL
+                   GROUP BY im."Customer", im."Space") AS a
+               ON a."Customer" = i."Customer" AND a."Space" = i."Space";
+
+        -- customer totals that add up to the space rows before they drift
+        INSERT INTO "CustomerStorage" ("Customer", "StoragePolicy", "NumberOfStoredImages", "TotalSizeOfStoredImages",
+                                       "TotalSizeOfThumbnails", "NumberOfStoredAdjuncts", "TotalSizeOfStoredAdjuncts",
+                                       "LastCalculated", "Space")
+        SELECT "Customer", 'default', SUM("NumberOfStoredImages"), SUM("TotalSizeOfStoredImages"),
+               SUM("TotalSizeOfThumbnails"), SUM("NumberOfStoredAdjuncts"), SUM("TotalSizeOfStoredAdjuncts"), now(), NULL
+        FROM "CustomerStorage"
+        GROUP BY "Customer";
+
+        UPDATE "CustomerStorage"
+        SET "NumberOfStoredImages"    = "NumberOfStoredImages" + 1 + (random() * 10)::int,
+            "TotalSizeOfStoredImages" = "TotalSizeOfStoredImages" + (random() * 10000)::bigint
+        WHERE "Space" IS NOT NULL AND random() < %(drift)s;
+
+        -- spaces whose images have all been deleted, which the recalculator zeroes out
+        INSERT INTO "CustomerStorage" ("Customer", "StoragePolicy", "NumberOfStoredImages", "TotalSizeOfStoredImages",
+                                       "TotalSizeOfThumbnails", "LastCalculated", "Space")
+        SELECT c, 'default', 10, 10000, 1000, now(), 2000
+        FROM generate_series(1, %(customers)s) AS c
+        WHERE random() < %(drift)s;
+        """, scenario)
+
+    cur.execute("""
+        INSERT INTO "EntityCounters" ("Type", "Scope", "Next", "Customer")
+        SELECT 'space-images', "Space"::varchar, COUNT(*), "Customer"
+        FROM "Images"
+        GROUP BY "Customer", "Space";
+
+        INSERT INTO "EntityCounters" ("Type", "Scope", "Next", "Customer")
+        SELECT 'customer-images', "Customer"::varchar, SUM("Next"), 0
+        FROM "EntityCounters"
+        WHERE "Type" = 'space-images'
+        GROUP BY "Customer";
+
+        UPDATE "EntityCounters"
+        SET "Next" = "Next" + 1 + (random() * 10)::int
+        WHERE "Type" = 'space-images' AND random() < %(drift)s;
+
+        -- counters for spaces with no images left
+        INSERT INTO "EntityCounters" ("Type", "Scope", "Next", "Customer")
+        SELECT 'space-images', '2000', 10, c
+        FROM generate_series(1, %(customers)s) AS c
+        WHERE random() < %(drift)s;
+        """, scenario)
+
+    for table in TARGET_TABLES:
+        cur.execute(sql.SQL("CREATE TABLE {} AS SELECT * FROM {};").format(
+            sql.Identifier(f"{table}Drifted"), sql.Identifier(table)))
+
+    conn.commit()
+    cur.close()
+
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("VACUUM ANALYZE;")
+    cur.close()
+    conn.autocommit = False
+
+
+def restore_drifted_tables(conn):
+    """Put the target tables back to the drifted state created by generate"""
+    cur = conn.cursor()
+    for table in TARGET_TABLES:
+        cur.execute(sql.SQL("TRUNCATE {table}; INSERT INTO {table} SELECT * FROM {drifted};").format(
+            table=sql.Identifier(table), drifted=sql.Identifier(f"{table}Drifted")))
+    conn.commit()
+
+    conn.autocommit = True
+    cur.execute(sql.SQL("VACUUM ANALYZE {};").format(sql.SQL(", ").join(map(sql.Identifier, TARGET_TABLES))))
+    conn.autocommit = False
+    cur.close()
@@ -1,126 +1,169 @@
-import psycopg2
-from psycopg2 import extras
-
-from logzero import logger
-from app.customer_storage_recalculator_settings import (CONNECTION_STRING, DRY_RUN, ENABLE_CLOUDWATCH_INTEGRATION,
-                                                        CLOUDWATCH_SPACE_IMAGE_SIZE_DIFFERENCE_METRIC_NAME,
+from app.customer_storage_recalculator_settings import (CLOUDWATCH_SPACE_IMAGE_SIZE_DIFFERENCE_METRIC_NAME,
                                                         CLOUDWATCH_SPACE_IMAGE_NUMBER_DIFFERENCE_METRIC_NAME,
                                                         CLOUDWATCH_SPACE_THUMBNAIL_SIZE_DIFFERENCE_METRIC_NAME,
                                                         CLOUDWATCH_SPACE_ADJUNCT_SIZE_DIFFERENCE_METRIC_NAME,
                                                         CLOUDWATCH_SPACE_ADJUNCT_NUMBER_DIFFERENCE_METRIC_NAME,
-                                                        CONNECTION_TIMEOUT, APP_VERSION, REGION)
-from app.aws_factory import get_aws_client
-from app.database import connect_to_postgres, get_connection_config
+                                                        FUSED_RECALCULATION)
+from app.adjuncts import get_adjunct_keys
+from app.preflight import required_index
+from app.recalculation import run_recalculation, run_service, publish_metrics
+from app.registry import Recalculation, register_recalculation
 
 
-def run_cleanup():
-    logger.info("Running customer storage recalculator")
-    connection_info = get_connection_config(CONNECTION_STRING)
-    conn = connect_to_postgres(connection_info=connection_info, connection_timeout=CONNECTION_TIMEOUT)
-    records = __run_sql(conn)
+def run_cleanup(conn=None, cloudwatch=None, spaces=None, customers=None, connection_info=None):
+    """Recalculate customer storage, or only the given (customer, space) pairs when spaces is set, or only the
+    customers in the given inclusive (customer_from, customer_to) ranges when customers is set.
+    See app/recalculation.py for the run itself, which writes the SQL below"""
+    return run_recalculation(RECALCULATION, conn=conn, cloudwatch=cloudwatch, spaces=spaces, customers=customers,
+                             connection_info=connection_info)
 
-    if ENABLE_CLOUDWATCH_INTEGRATION:
-        logger.info("CloudWatch metrics enabled")
-        cloudwatch = get_aws_client(resource_type="cloudwatch", region=REGION)
-        set_cloudwatch_metrics(records, cloudwatch, connection_info)
 
-    conn.close()
-    logger.info("Customer storage recalculator complete")
+def set_cloudwatch_metrics(records, cloudwatch, connection_info):
+    return publish_metrics(RECALCULATION, records, cloudwatch, connection_info)
 
-    return records
 
+DELTA_COLUMNS = ["TotalSizeDelta", "NumberOfImagesDelta", "TotalSizeOfThumbnailsDelta",
+                 "TotalAdjunctSizeDelta", "NumberOfAdjunctsDelta"]
+# The columns of a space delta row, in the order they are written to DELTA_OUTPUT_FILE. Zeroed out spaces have no
+# CustomerInImageStorageTable or SpaceInImageStorageTable
+DELTA_OUTPUT_COLUMNS = ["Customer", "CustomerInImageStorageTable", "Space", "SpaceInImageStorageTable",
+                        "TotalSizeOfStoredImages", "TotalSizeInImageStorageTable", "TotalSizeDelta",
+                        "NumberOfStoredImages", "NumberOfImagesInImageStorageTable", "NumberOfImagesDelta",
+                        "TotalSizeOfThumbnails", "TotalSizeOfThumbnailsInImageStorageTable",
+                        "TotalSizeOfThumbnailsDelta", "TotalSizeOfStoredAdjuncts",
+                        "TotalAdjunctSizeInImageStorageTable", "TotalAdjunctSizeDelta", "NumberOfStoredAdjuncts",
+                        "NumberOfAdjunctsInAdjunctsTable", "NumberOfAdjunctsDelta"]
 
-def set_cloudwatch_metrics(records, cloudwatch, connection_info):
-    metric_data = []
-    dimensions = [{
-                    'Name': "DATABASE_NAME",
-                    'Value': connection_info["database"]
-                },
-                {
-                    'Name': "APP_VERSION",
-                    'Value': APP_VERSION
-                },
-                {
-                    'Name': "RECALCULATOR_NAME",
-                    'Value': "customer_storage_recalculator"
-                }]
-
-    space_total_image_size_delta = 0
-    space_total_image_number_delta = 0
-    space_total_thumbnail_size_delta = 0
-    space_total_adjunct_size_delta = 0
-    space_total_adjunct_number_delta = 0
-
-    for key in records["spaceChanges"]:
-        logger.info(f"Space delta - {key}")
-        space_total_image_size_delta += abs(key["TotalSizeDelta"])
-        space_total_image_number_delta += abs(key["NumberOfImagesDelta"])
-        space_total_thumbnail_size_delta += abs(key["TotalSizeOfThumbnailsDelta"])
-        space_total_adjunct_size_delta += abs(key["TotalAdjunctSizeDelta"])
-        space_total_adjunct_number_delta += abs(key["NumberOfAdjunctsDelta"])
-
-    metric_data.extend([
-        {
-            'MetricName': CLOUDWATCH_SPACE_IMAGE_SIZE_DIFFERENCE_METRIC_NAME,
-            'Dimensions': dimensions,
-            'Unit': 'Bytes',
-            'Value': space_total_image_size_delta
-        },
-        {
-            'MetricName': CLOUDWATCH_SPACE_IMAGE_NUMBER_DIFFERENCE_METRIC_NAME,
-            'Dimensions': dimensions,
-            'Unit': 'Count',
-            'Value': space_total_image_number_delta
-        },
-        {
-            'MetricName': CLOUDWATCH_SPACE_THUMBNAIL_SIZE_DIFFERENCE_METRIC_NAME,
-            'Dimensions': dimensions,
-            'Unit': 'Bytes',
-            'Value': space_total_thumbnail_size_delta
-        },
-        {
-            'MetricName': CLOUDWATCH_SPACE_ADJUNCT_SIZE_DIFFERENCE_METRIC_NAME,
-            'Dimensions': dimensions,
-            'Unit': 'Bytes',
-            'Value': space_total_adjunct_size_delta
-        },
-        {
-            'MetricName': CLOUDWATCH_SPACE_ADJUNCT_NUMBER_DIFFERENCE_METRIC_NAME,
-            'Dimensions': dimensions,
-            'Unit': 'Count',
-            'Value': space_total_adjunct_number_delta
-        }
-    ])
-
-    try:
-        logger.debug(f"Publishing CloudWatch metrics - {metric_data}")
-        cloudwatch.put_metric_data(MetricData=metric_data,
-                                   Namespace='Protagonist Recalculator')
-        return metric_data
-    except Exception as e:
-        logger.exception(f"Error publishing to CloudWatch")
-        raise e
-
-
-def __run_sql(conn):
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    # Step 1: aggregate ImageStorage and Adjuncts per customer/space and upsert into CustomerStorage.
-    # Three CTEs build up the fresh totals:
-    #   img_cte   — sums Size, ThumbnailSize, and AdjunctSize from ImageStorage
-    #   adj_cte   — counts hosted adjuncts (Origin IS NOT NULL/non-empty) from the Adjuncts table,
-    #               extracting Customer and Space from the AssetId string ({customer}/{space}/{id})
-    #   cte       — joins the two, so every customer/space row has both image and adjunct metrics
-    # The UPSERT inserts new rows for customer/space pairs not yet in CustomerStorage,
-    # or updates existing rows when any total has changed.
-    # ON CONFLICT targets the partial unique index on (Customer, Space) WHERE Space IS NOT NULL,
-    # which covers all real spaces including space 0 (stub assets). The NULL-space aggregate
-    # row is never written here — it is derived in step 3.
-    # The final SELECT returns the pre-upsert snapshot joined against the new CTE values so
-    # we can report deltas. CTEs execute on a snapshot before any DML in the same statement,
-    # so CustomerStorage reads here reflect the state *before* the upsert.
-    # See https://www.postgresql.org/docs/11/queries-with.html
-    cur.execute("""
+
+def get_space_change_totals(space_changes, totals=None):
+    """Sum the absolute value of each delta column, optionally adding to existing totals"""
+    totals = totals if totals is not None else dict.fromkeys(DELTA_COLUMNS, 0)
+    for key in space_changes:
+        for column in DELTA_COLUMNS:
+            totals[column] += abs(key[column])
+    return totals
+
+
+def __get_space_key(row):
+    # spaces that are new to CustomerStorage only have the customer and space from ImageStorage
+    customer = row["Customer"] if row["Customer"] is not None else row["CustomerInImageStorageTable"]
+    space = row["Space"] if row["Space"] is not None else row["SpaceInImageStorageTable"]
+    return customer, space
+
+
+def __get_delta_metrics():
+    # read when the metrics are published, so each total is published under the metric name set at the time
+    return [
+        ("TotalSizeDelta", CLOUDWATCH_SPACE_IMAGE_SIZE_DIFFERENCE_METRIC_NAME, 'Bytes'),
+        ("NumberOfImagesDelta", CLOUDWATCH_SPACE_IMAGE_NUMBER_DIFFERENCE_METRIC_NAME, 'Count'),
+        ("TotalSizeOfThumbnailsDelta", CLOUDWATCH_SPACE_THUMBNAIL_SIZE_DIFFERENCE_METRIC_NAME, 'Bytes'),
+        ("TotalAdjunctSizeDelta", CLOUDWATCH_SPACE_ADJUNCT_SIZE_DIFFERENCE_METRIC_NAME, 'Bytes'),
+        ("NumberOfAdjunctsDelta", CLOUDWATCH_SPACE_ADJUNCT_NUMBER_DIFFERENCE_METRIC_NAME, 'Count')
+    ]
+
+
+RECALCULATOR_NAME = "customer_storage_recalculator"
+AGGREGATE_CACHE_TABLE = "CustomerStorageSpaceAggregates"
+CHANGE_LOG_SOURCES = ["ImageStorage", "Adjuncts"]
+LISTEN_SOURCES = CHANGE_LOG_SOURCES
+CUSTOMER_TABLES = ["ImageStorage", "CustomerStorage"]
+# Indexes the recalculation relies on, checked before a run with INDEX_PREFLIGHT set. The adjunct key index is
+# detected separately, see app/adjuncts.py
+REQUIRED_INDEXES = [
+    # summing the images of each space of a customer range, and zeroing out spaces that have none left
+    required_index("IX_ImageStorage_Customer_Space", "ImageStorage", ['"Customer"', '"Space"'],
+                   'SELECT 1 FROM "ImageStorage" WHERE "Customer" = 1 AND "Space" = 1'),
+    # the upsert's ON CONFLICT target
+    required_index("IX_CustomerStorage_Customer_Space", "CustomerStorage", ['"Customer"', '"Space"'],
+                   'SELECT 1 FROM "CustomerStorage" WHERE "Customer" = 1 AND "Space" = 1',
+                   where='"Space" IS NOT NULL', unique=True),
+]
+
+
+# Verify mode samples spaces from both sides, so spaces missing from CustomerStorage and spaces that no longer have
+# any images can both be picked. TABLESAMPLE SYSTEM reads just the sampled pages of each table.
+VERIFY_SAMPLE_QUERY = """
+    SELECT "Customer", "Space" FROM "ImageStorage" TABLESAMPLE SYSTEM (%(percent)s)
+    UNION
+    SELECT "Customer", "Space" FROM "CustomerStorage" TABLESAMPLE SYSTEM (%(percent)s)
+    WHERE "Space" IS NOT NULL
+    ORDER BY 1, 2;
+    """
+# A customer looks inconsistent when one of its sampled spaces differs from freshly aggregated totals, or
+# when its customer-level (NULL space) row does not add up to its space rows.
+VERIFY_QUERY = """
+    WITH cte AS (
+        {aggregates}
+    ),
+    stored AS (
+        SELECT *
+        FROM "CustomerStorage"
+        WHERE "Space" IS NOT NULL
+          AND ("Customer", "Space") IN (SELECT * FROM unnest(%(space_customers)s::int[], %(space_spaces)s::int[]))
+    )
+    SELECT COALESCE(stored."Customer", cte."Customer") AS "Customer"
+    FROM stored
+    FULL OUTER JOIN cte ON stored."Customer" = cte."Customer" AND stored."Space" = cte."Space"
+    WHERE coalesce("TotalSizeOfStoredImages", 0)   != coalesce("TotalSizeInImageStorageTable", 0)
+       OR coalesce("NumberOfStoredImages", 0)      != coalesce("NumberOfImagesInImageStorageTable", 0)
+       OR coalesce("TotalSizeOfThumbnails", 0)     != coalesce("TotalSizeOfThumbnailsInImageStorageTable", 0)
+       OR coalesce("TotalSizeOfStoredAdjuncts", 0) != coalesce("TotalAdjunctSizeInImageStorageTable", 0)
+       OR coalesce("NumberOfStoredAdjuncts", 0)    != coalesce("NumberOfAdjunctsInAdjunctsTable", 0)
+    UNION
+    SELECT cs."Customer"
+    FROM "CustomerStorage" AS cs
+    JOIN (
+        SELECT "Customer",
+               SUM("NumberOfStoredImages")      AS numberOfImages,
+               SUM("TotalSizeOfStoredImages")   AS totalImageSize,
+               SUM("TotalSizeOfThumbnails")     AS totalThumbnailSize,
+               SUM("NumberOfStoredAdjuncts")    AS numberOfAdjuncts,
+               SUM("TotalSizeOfStoredAdjuncts") AS totalAdjunctSize
+        FROM "CustomerStorage"
+        WHERE "Space" IS NOT NULL
+        GROUP BY "Customer"
+    ) AS vals ON cs."Customer" = vals."Customer" AND cs."Space" IS NULL
+    WHERE (cs."NumberOfStoredImages", cs."TotalSizeOfStoredImages", cs."TotalSizeOfThumbnails",
+           cs."NumberOfStoredAdjuncts", cs."TotalSizeOfStoredAdjuncts")
+          IS DISTINCT FROM
+          (vals.numberOfImages, vals.totalImageSize, vals.totalThumbnailSize,
+           vals.numberOfAdjuncts, vals.totalAdjunctSize)
+    ORDER BY 1;
+    """
+CUSTOMER_SPACES_QUERY = """
+    SELECT "Customer", "Space" FROM "ImageStorage" WHERE "Customer" = ANY(%(customers)s)
+    UNION
+    SELECT "Customer", "Space" FROM "CustomerStorage" WHERE "Customer" = ANY(%(customers)s) AND "Space" IS NOT NULL
+    ORDER BY 1, 2;
+    """
+
+
+SPACE_TOTAL_COLUMNS = """
+    "Customer" integer, "Space" integer,
+    "TotalSizeInImageStorageTable" numeric, "NumberOfImagesInImageStorageTable" bigint,
+    "TotalSizeOfThumbnailsInImageStorageTable" numeric, "TotalAdjunctSizeInImageStorageTable" numeric,
+    "NumberOfAdjunctsInAdjunctsTable" bigint
+"""
+
+
+def __get_bigint_space_totals_query(space_totals_query):
+    # The totals as bigint, whether they were aggregated here, read from the cache or staged from a replica. SUM()
+    # of a bigint is numeric, so without this the deltas of upserted spaces would be Decimal while those of zeroed
+    # spaces are int
+    return """
+            SELECT "Customer", "Space",
+                   "TotalSizeInImageStorageTable"::bigint AS "TotalSizeInImageStorageTable",
+                   "NumberOfImagesInImageStorageTable"::bigint AS "NumberOfImagesInImageStorageTable",
+                   "TotalSizeOfThumbnailsInImageStorageTable"::bigint AS "TotalSizeOfThumbnailsInImageStorageTable",
+                   "TotalAdjunctSizeInImageStorageTable"::bigint AS "TotalAdjunctSizeInImageStorageTable",
+                   "NumberOfAdjunctsInAdjunctsTable"::bigint AS "NumberOfAdjunctsInAdjunctsTable"
+            FROM ({space_totals}) AS totals
+    """.format(space_totals=space_totals_query)
+
+
+def __get_space_totals_query(adjunct_keys):
+    # Fresh totals for each customer/space in a scope, built up from three CTEs (see step 1, SPACE_UPSERT_QUERY).
+    return """
         -- Aggregate image/thumbnail/adjunct sizes from ImageStorage per customer/space.
         WITH img_cte AS (
             SELECT "Customer", "Space",
@@ -129,164 +172,361 @@ def __run_sql(conn):
                    SUM("ThumbnailSize") AS "TotalSizeOfThumbnailsInImageStorageTable",
                    SUM("AdjunctSize")   AS "TotalAdjunctSizeInImageStorageTable"
             FROM "ImageStorage"
+            WHERE "Customer" BETWEEN %(customer_from)s AND %(customer_to)s
+              AND (%(customers)s::int[] IS NULL OR "Customer" = ANY(%(customers)s::int[]))
+              AND (%(customer_froms)s::int[] IS NULL
+                   OR EXISTS (SELECT FROM unnest(%(customer_froms)s::int[], %(customer_tos)s::int[]) AS r(f, t)
+                              WHERE "Customer" BETWEEN r.f AND r.t))
+              AND (%(space_customers)s::int[] IS NULL
+                   OR ("Customer", "Space") IN (SELECT * FROM unnest(%(space_customers)s::int[], %(space_spaces)s::int[])))
             GROUP BY "Customer", "Space"
         ),
         -- Count hosted adjuncts per customer/space.
-        -- AssetId is stored as '{customer}/{space}/{id}', so split_part extracts the components.
+        -- The customer and space come from key columns, or are parsed from the AssetId.
         -- Only adjuncts with a non-empty Origin are hosted (i.e. stored by DLCS).
         adj_cte AS (
-            SELECT CAST(split_part("AssetId", '/', 1) AS integer) AS "Customer",
-                   CAST(split_part("AssetId", '/', 2) AS integer) AS "Space",
+            SELECT {adjunct_customer} AS "Customer",
+                   {adjunct_space} AS "Space",
                    COUNT(*) AS "NumberOfAdjunctsInAdjunctsTable"
             FROM "Adjuncts"
             WHERE "Origin" IS NOT NULL AND "Origin" != ''
+              AND {adjunct_customer} BETWEEN %(customer_from)s AND %(customer_to)s
+              AND (%(customers)s::int[] IS NULL OR {adjunct_customer} = ANY(%(customers)s::int[]))
+              AND (%(customer_froms)s::int[] IS NULL
+                   OR EXISTS (SELECT FROM unnest(%(customer_froms)s::int[], %(customer_tos)s::int[]) AS r(f, t)
+                              WHERE {adjunct_customer} BETWEEN r.f AND r.t))
+              AND (%(space_customers)s::int[] IS NULL
+                   OR ({adjunct_customer}, {adjunct_space})
+                      IN (SELECT * FROM unnest(%(space_customers)s::int[], %(space_spaces)s::int[])))
             GROUP BY 1, 2
-        ),
+        )
         -- Combine image and adjunct aggregates. LEFT JOIN so spaces with no hosted adjuncts
         -- still appear with a zero adjunct count.
-        cte AS (
-            SELECT img_cte."Customer",
-                   img_cte."Space",
-                   img_cte."TotalSizeInImageStorageTable",
-                   img_cte."NumberOfImagesInImageStorageTable",
-                   img_cte."TotalSizeOfThumbnailsInImageStorageTable",
-                   img_cte."TotalAdjunctSizeInImageStorageTable",
-                   COALESCE(adj_cte."NumberOfAdjunctsInAdjunctsTable", 0) AS "NumberOfAdjunctsInAdjunctsTable"
-            FROM img_cte
-            LEFT JOIN adj_cte
-                   ON img_cte."Customer" = adj_cte."Customer"
-                  AND img_cte."Space"    = adj_cte."Space"
-            ORDER BY img_cte."Customer", img_cte."Space"
-        ),
-        -- Upsert the fresh aggregates into CustomerStorage for all non-null spaces.
-        ins AS (
-            INSERT INTO "CustomerStorage"
-                   ( "Customer", "StoragePolicy", "NumberOfStoredImages", "TotalSizeOfStoredImages",
-                     "TotalSizeOfThumbnails", "NumberOfStoredAdjuncts", "TotalSizeOfStoredAdjuncts",
-                     "LastCalculated", "Space" )
-                   SELECT cte."Customer", 'default', cte."NumberOfImagesInImageStorageTable", cte."TotalSizeInImageStorageTable",
-                          cte."TotalSizeOfThumbnailsInImageStorageTable", cte."NumberOfAdjunctsInAdjunctsTable", cte."TotalAdjunctSizeInImageStorageTable",
-                          current_timestamp, cte."Space"
-                    FROM cte
-                   ON CONFLICT ("Customer", "Space") WHERE "Space" IS NOT NULL
-                   DO UPDATE SET
-                       "Customer"                = excluded."Customer",
-                       "StoragePolicy"           = excluded."StoragePolicy",
-                       "NumberOfStoredImages"    = excluded."NumberOfStoredImages",
-                       "TotalSizeOfStoredImages" = excluded."TotalSizeOfStoredImages",
-                       "TotalSizeOfThumbnails"   = excluded."TotalSizeOfThumbnails",
-                       "NumberOfStoredAdjuncts"  = excluded."NumberOfStoredAdjuncts",
-                       "TotalSizeOfStoredAdjuncts" = excluded."TotalSizeOfStoredAdjuncts",
-                       "LastCalculated"          = excluded."LastCalculated",
-                       "Space"                   = excluded."Space"
-                   RETURNING *
-        )
-        -- Return only rows where something changed, comparing the pre-upsert CustomerStorage
-        -- snapshot against the freshly aggregated values.
+        SELECT img_cte."Customer",
+               img_cte."Space",
+               img_cte."TotalSizeInImageStorageTable",
+               img_cte."NumberOfImagesInImageStorageTable",
+               img_cte."TotalSizeOfThumbnailsInImageStorageTable",
+               img_cte."TotalAdjunctSizeInImageStorageTable",
+               COALESCE(adj_cte."NumberOfAdjunctsInAdjunctsTable", 0) AS "NumberOfAdjunctsInAdjunctsTable"
+        FROM img_cte
+        LEFT JOIN adj_cte
+               ON img_cte."Customer" = adj_cte."Customer"
+              AND img_cte."Space"    = adj_cte."Space"
+        ORDER BY img_cte."Customer", img_cte."Space"
+        """.format(adjunct_customer=adjunct_keys[0], adjunct_space=adjunct_keys[1])
+
+
+def __get_aggregate_query(conn):
+    return __get_space_totals_query(get_adjunct_keys(conn))
+
+
+# Step 1: aggregate ImageStorage and Adjuncts per customer/space and upsert into CustomerStorage.
+# Three CTEs build up the fresh totals:
+#   img_cte   — sums Size, ThumbnailSize, and AdjunctSize from ImageStorage
+#   adj_cte   — counts hosted adjuncts (Origin IS NOT NULL/non-empty) from the Adjuncts table,
+#               reading Customer and Space with the adjunct_keys expressions (see app/adjuncts.py)
+#   cte       — joins the two, so every customer/space row has both image and adjunct metrics
+# When reading from a replica, the totals query runs there and cte reads its rows from a staging table.
+# With the aggregate cache, cte reads the cached totals instead.
+# The UPSERT inserts new rows for customer/space pairs not yet in CustomerStorage,
+# or updates existing rows. With MINIMAL_WRITES, existing rows are only rewritten when a
+# value has changed, so unchanged spaces produce no dead tuples or WAL; their LastCalculated
+# then records when they last changed, and the per-run stamp lives on the NULL-space row (step 3).
+# ON CONFLICT targets the partial unique index on (Customer, Space) WHERE Space IS NOT NULL,
+# which covers all real spaces including space 0 (stub assets). The NULL-space aggregate
+# row is never written here — it is derived in step 3.
+# The final SELECT returns the pre-upsert snapshot joined against the new CTE values so
+# we can report deltas. CTEs execute on a snapshot before any DML in the same statement,
+# so CustomerStorage reads here reflect the state *before* the upsert.
+# See https://www.postgresql.org/docs/11/queries-with.html
+SPACE_UPSERT_QUERY = """
+    WITH cte AS (
+        {space_totals}
+    ),
+    -- Upsert the fresh aggregates into CustomerStorage for all non-null spaces.
+    ins AS (
+        INSERT INTO "CustomerStorage"
+               ( "Customer", "StoragePolicy", "NumberOfStoredImages", "TotalSizeOfStoredImages",
+                 "TotalSizeOfThumbnails", "NumberOfStoredAdjuncts", "TotalSizeOfStoredAdjuncts",
+                 "LastCalculated", "Space" )
+               SELECT cte."Customer", 'default', cte."NumberOfImagesInImageStorageTable", cte."TotalSizeInImageStorageTable",
+                      cte."TotalSizeOfThumbnailsInImageStorageTable", cte."NumberOfAdjunctsInAdjunctsTable", cte."TotalAdjunctSizeInImageStorageTable",
+                      current_timestamp, cte."Space"
+                FROM cte
+               ON CONFLICT ("Customer", "Space") WHERE "Space" IS NOT NULL
+               DO UPDATE SET
+                   "Customer"                = excluded."Customer",
+                   "StoragePolicy"           = excluded."StoragePolicy",
+                   "NumberOfStoredImages"    = excluded."NumberOfStoredImages",
+                   "TotalSizeOfStoredImages" = excluded."TotalSizeOfStoredImages",
+                   "TotalSizeOfThumbnails"   = excluded."TotalSizeOfThumbnails",
+                   "NumberOfStoredAdjuncts"  = excluded."NumberOfStoredAdjuncts",
+                   "TotalSizeOfStoredAdjuncts" = excluded."TotalSizeOfStoredAdjuncts",
+                   "LastCalculated"          = excluded."LastCalculated",
+                   "Space"                   = excluded."Space"
+               WHERE NOT %(minimal_writes)s
+                  OR ("CustomerStorage"."StoragePolicy", "CustomerStorage"."NumberOfStoredImages",
+                      "CustomerStorage"."TotalSizeOfStoredImages", "CustomerStorage"."TotalSizeOfThumbnails",
+                      "CustomerStorage"."NumberOfStoredAdjuncts", "CustomerStorage"."TotalSizeOfStoredAdjuncts")
+                     IS DISTINCT FROM
+                     (excluded."StoragePolicy", excluded."NumberOfStoredImages",
+                      excluded."TotalSizeOfStoredImages", excluded."TotalSizeOfThumbnails",
+                      excluded."NumberOfStoredAdjuncts", excluded."TotalSizeOfStoredAdjuncts")
+               RETURNING *
+    )
+    -- Return only rows where something changed, comparing the pre-upsert CustomerStorage
+    -- snapshot against the freshly aggregated values.
+    SELECT y."Customer",
+           cte."Customer" AS "CustomerInImageStorageTable",
+           y."Space",
+           cte."Space" AS "SpaceInImageStorageTable",
+           "TotalSizeOfStoredImages",
+           "TotalSizeInImageStorageTable",
+           coalesce("TotalSizeOfStoredImages", 0) - coalesce("TotalSizeInImageStorageTable", 0) AS "TotalSizeDelta",
+           "NumberOfStoredImages",
+           "NumberOfImagesInImageStorageTable",
+           coalesce("NumberOfStoredImages", 0) - coalesce("NumberOfImagesInImageStorageTable", 0) AS "NumberOfImagesDelta",
+           "TotalSizeOfThumbnails",
+           "TotalSizeOfThumbnailsInImageStorageTable",
+           coalesce("TotalSizeOfThumbnails", 0) - coalesce("TotalSizeOfThumbnailsInImageStorageTable", 0) AS "TotalSizeOfThumbnailsDelta",
+           "TotalSizeOfStoredAdjuncts",
+           "TotalAdjunctSizeInImageStorageTable",
+           coalesce("TotalSizeOfStoredAdjuncts", 0) - coalesce("TotalAdjunctSizeInImageStorageTable", 0) AS "TotalAdjunctSizeDelta",
+           "NumberOfStoredAdjuncts",
+           "NumberOfAdjunctsInAdjunctsTable",
+           coalesce("NumberOfStoredAdjuncts", 0) - coalesce("NumberOfAdjunctsInAdjunctsTable", 0) AS "NumberOfAdjunctsDelta"
+    FROM "CustomerStorage" AS y
+    RIGHT OUTER JOIN cte ON y."Customer" = cte."Customer" AND y."Space" = cte."Space"
+    WHERE coalesce("TotalSizeOfStoredImages", 0)       - coalesce("TotalSizeInImageStorageTable", 0)        != 0
+       OR coalesce("NumberOfStoredImages", 0)          - coalesce("NumberOfImagesInImageStorageTable", 0)   != 0
+       OR coalesce("TotalSizeOfThumbnails", 0)         - coalesce("TotalSizeOfThumbnailsInImageStorageTable", 0) != 0
+       OR coalesce("TotalSizeOfStoredAdjuncts", 0)     - coalesce("TotalAdjunctSizeInImageStorageTable", 0) != 0
+       OR coalesce("NumberOfStoredAdjuncts", 0)        - coalesce("NumberOfAdjunctsInAdjunctsTable", 0)     != 0
+    ORDER BY y."Customer", cte."Customer", y."Space", cte."Space";
+    """
+
+# Step 2: zero out CustomerStorage rows for spaces that no longer have any ImageStorage records.
+# The upsert in step 1 only touches spaces that currently exist in ImageStorage, so a space
+# whose last image was deleted would be silently skipped and retain stale non-zero totals.
+# Adjunct columns are included: if all images are gone, adjuncts cannot exist either
+# (adjuncts are always associated with an image). Any residual adjunct values are also zeroed.
+# Only non-null spaces are considered — the NULL aggregate row is never written directly.
+# The old values are captured via the to_zero CTE (which reads the pre-update snapshot) so
+# they can be reported as deltas alongside the changes from step 1.
+ZERO_OUT_QUERY = """
+    -- Identify non-null spaces with no remaining ImageStorage records.
+    WITH to_zero AS (
+        SELECT "Customer", "Space",
+               "NumberOfStoredImages", "TotalSizeOfStoredImages", "TotalSizeOfThumbnails",
+               "NumberOfStoredAdjuncts", "TotalSizeOfStoredAdjuncts"
+        FROM "CustomerStorage"
+        WHERE "Space" IS NOT NULL
+          AND "Customer" BETWEEN %(customer_from)s AND %(customer_to)s
+          AND (%(customers)s::int[] IS NULL OR "Customer" = ANY(%(customers)s::int[]))
+          AND (%(customer_froms)s::int[] IS NULL
+               OR EXISTS (SELECT FROM unnest(%(customer_froms)s::int[], %(customer_tos)s::int[]) AS r(f, t)
+                          WHERE "Customer" BETWEEN r.f AND r.t))
+          AND (%(space_customers)s::int[] IS NULL
+               OR ("Customer", "Space") IN (SELECT * FROM unnest(%(space_customers)s::int[], %(space_spaces)s::int[])))
+          AND NOT EXISTS (
+            SELECT 1 FROM "ImageStorage"
+            WHERE "ImageStorage"."Customer" = "CustomerStorage"."Customer"
+              AND "ImageStorage"."Space" = "CustomerStorage"."Space"
+          )
+    ),
+    -- Zero out the identified rows and stamp LastCalculated.
+    -- Covers both non-zero rows (actual changes) and already-zero rows (e.g. space 0 with
+    -- no images/adjuncts) that are skipped by the step 1 upsert but still need LastCalculated
+    -- updated. The final SELECT filters to only rows with non-zero deltas for reporting.
+    -- With MINIMAL_WRITES the already-zero rows are left alone.
+    zeroed AS (
+        UPDATE "CustomerStorage"
+        SET "NumberOfStoredImages"      = 0,
+            "TotalSizeOfStoredImages"   = 0,
+            "TotalSizeOfThumbnails"     = 0,
+            "NumberOfStoredAdjuncts"    = 0,
+            "TotalSizeOfStoredAdjuncts" = 0,
+            "LastCalculated"            = current_timestamp
+        FROM to_zero
+        WHERE "CustomerStorage"."Customer" = to_zero."Customer"
+          AND "CustomerStorage"."Space"    = to_zero."Space"
+          AND (NOT %(minimal_writes)s
+               OR to_zero."NumberOfStoredImages"    != 0
+               OR to_zero."TotalSizeOfStoredImages" != 0
+               OR to_zero."TotalSizeOfThumbnails"   != 0
+               OR to_zero."NumberOfStoredAdjuncts"  != 0
+               OR to_zero."TotalSizeOfStoredAdjuncts" != 0)
+    )
+    -- Return the old (pre-zero) values as deltas so they feed into CloudWatch metrics.
+    -- Rows already at zero are excluded — their delta is 0 so nothing meaningful to report.
+    SELECT "Customer",
+           "Space",
+           "TotalSizeOfStoredImages",
+           0 AS "TotalSizeInImageStorageTable",
+           "TotalSizeOfStoredImages"   AS "TotalSizeDelta",
+           "NumberOfStoredImages",
+           0 AS "NumberOfImagesInImageStorageTable",
+           "NumberOfStoredImages"      AS "NumberOfImagesDelta",
+           "TotalSizeOfThumbnails",
+           0 AS "TotalSizeOfThumbnailsInImageStorageTable",
+           "TotalSizeOfThumbnails"     AS "TotalSizeOfThumbnailsDelta",
+           "TotalSizeOfStoredAdjuncts",
+           0 AS "TotalAdjunctSizeInImageStorageTable",
+           "TotalSizeOfStoredAdjuncts" AS "TotalAdjunctSizeDelta",
+           "NumberOfStoredAdjuncts",
+           0 AS "NumberOfAdjunctsInAdjunctsTable",
+           "NumberOfStoredAdjuncts"    AS "NumberOfAdjunctsDelta"
+    FROM to_zero
+    WHERE "NumberOfStoredImages"    != 0
+       OR "TotalSizeOfStoredImages" != 0
+       OR "TotalSizeOfThumbnails"   != 0
+       OR "NumberOfStoredAdjuncts"  != 0
+       OR "TotalSizeOfStoredAdjuncts" != 0;
+    """
+
+# Step 3: roll up all per-space totals into the NULL-space aggregate row for each customer.
+# Space IS NULL is the customer-level aggregate (formerly space 0 prior to the
+# StopSpaceZeroCustomerStorage migration). All non-null spaces — including space 0 which
+# now tracks stub assets — are included in the sum.
+# LastCalculated on the NULL-space row is stamped on every run, so it always records when the
+# customer was last recalculated, even when MINIMAL_WRITES leaves its space rows untouched.
+ROLLUP_QUERY = """
+    UPDATE "CustomerStorage" AS cs
+    SET "NumberOfStoredImages"      = numberOfImages,
+        "TotalSizeOfStoredImages"   = totalImageSize,
+        "TotalSizeOfThumbnails"     = totalThumbnailSize,
+        "NumberOfStoredAdjuncts"    = numberOfAdjuncts,
+        "TotalSizeOfStoredAdjuncts" = totalAdjunctSize,
+        "LastCalculated"            = current_timestamp
+    FROM (
+        -- Sum every real space (non-null) per customer to produce the customer-wide totals.
+        SELECT "Customer",
+               SUM("NumberOfStoredImages")      AS numberOfImages,
+               SUM("TotalSizeOfStoredImages")   AS totalImageSize,
+               SUM("TotalSizeOfThumbnails")     AS totalThumbnailSize,
+               SUM("NumberOfStoredAdjuncts")    AS numberOfAdjuncts,
+               SUM("TotalSizeOfStoredAdjuncts") AS totalAdjunctSize
+        FROM "CustomerStorage"
+        WHERE "Space" IS NOT NULL
+          AND "Customer" BETWEEN %(customer_from)s AND %(customer_to)s
+          AND (%(customers)s::int[] IS NULL OR "Customer" = ANY(%(customers)s::int[]))
+          AND (%(customer_froms)s::int[] IS NULL
+               OR EXISTS (SELECT FROM unnest(%(customer_froms)s::int[], %(customer_tos)s::int[]) AS r(f, t)
+                          WHERE "Customer" BETWEEN r.f AND r.t))
+          AND (%(space_customers)s::int[] IS NULL OR "Customer" = ANY(%(space_customers)s::int[]))
+        GROUP BY "Customer"
+        ORDER BY "Customer"
+    ) AS vals
+    -- Write the aggregated totals into the NULL-space row for this customer.
+    WHERE cs."Customer" = vals."Customer" AND "Space" IS NULL;
+"""
+
+# With FUSED_RECALCULATION, steps 1 to 3 run in a single statement, so ImageStorage is aggregated once and
+# CustomerStorage read once, rather than being read again by the zero-out's NOT EXISTS and the rollup:
+#   stored  — the scope's current space rows. For a scope of given spaces every space of their customers is read,
+#             as a customer's rollup also sums its spaces outside the scope; only the scope's own are compared.
+#   merged  — FULL OUTER JOIN of the stored rows with the fresh totals. A stored space missing from the fresh
+#             totals has no images left, and its fresh totals are 0.
+#   ins     — the step 1 upsert of every space with fresh totals
+#   zeroed  — the step 2 zero-out of every space without
+#   rollup  — the step 3 update of each customer's NULL-space row, summed from the values just written (merged)
+#             and the stored values of spaces outside the scope
+# The data-modifying CTEs each write different rows, and all of them run whether or not they are referenced.
+# The final SELECT returns the delta rows of steps 1 and 2, in the same order.
+FUSED_QUERY = """
+    WITH cte AS (
+        {space_totals}
+    ),
+    stored AS (
+        SELECT "Customer", "Space",
+               "NumberOfStoredImages", "TotalSizeOfStoredImages", "TotalSizeOfThumbnails",
+               "NumberOfStoredAdjuncts", "TotalSizeOfStoredAdjuncts",
+               (%(space_customers)s::int[] IS NULL
+                OR ("Customer", "Space") IN (SELECT * FROM unnest(%(space_customers)s::int[], %(space_spaces)s::int[])))
+               AS "InScope"
+        FROM "CustomerStorage"
+        WHERE "Space" IS NOT NULL
+          AND "Customer" BETWEEN %(customer_from)s AND %(customer_to)s
+          AND (%(customers)s::int[] IS NULL OR "Customer" = ANY(%(customers)s::int[]))
+          AND (%(customer_froms)s::int[] IS NULL
+               OR EXISTS (SELECT FROM unnest(%(customer_froms)s::int[], %(customer_tos)s::int[]) AS r(f, t)
+                          WHERE "Customer" BETWEEN r.f AND r.t))
+          AND (%(space_customers)s::int[] IS NULL OR "Customer" = ANY(%(space_customers)s::int[]))
+    ),
+    merged AS (
         SELECT y."Customer",
                cte."Customer" AS "CustomerInImageStorageTable",
                y."Space",
                cte."Space" AS "SpaceInImageStorageTable",
-               "TotalSizeOfStoredImages",
-               "TotalSizeInImageStorageTable",
-               coalesce("TotalSizeOfStoredImages", 0) - coalesce("TotalSizeInImageStorageTable", 0) AS "TotalSizeDelta",
-               "NumberOfStoredImages",
-               "NumberOfImagesInImageStorageTable",
-               coalesce("NumberOfStoredImages", 0) - coalesce("NumberOfImagesInImageStorageTable", 0) AS "NumberOfImagesDelta",
-               "TotalSizeOfThumbnails",
-               "TotalSizeOfThumbnailsInImageStorageTable",
-               coalesce("TotalSizeOfThumbnails", 0) - coalesce("TotalSizeOfThumbnailsInImageStorageTable", 0) AS "TotalSizeOfThumbnailsDelta",
-               "TotalSizeOfStoredAdjuncts",
-               "TotalAdjunctSizeInImageStorageTable",
-               coalesce("TotalSizeOfStoredAdjuncts", 0) - coalesce("TotalAdjunctSizeInImageStorageTable", 0) AS "TotalAdjunctSizeDelta",
-               "NumberOfStoredAdjuncts",
-               "NumberOfAdjunctsInAdjunctsTable",
-               coalesce("NumberOfStoredAdjuncts", 0) - coalesce("NumberOfAdjunctsInAdjunctsTable", 0) AS "NumberOfAdjunctsDelta"
-        FROM "CustomerStorage" AS y
-        RIGHT OUTER JOIN cte ON y."Customer" = cte."Customer" AND y."Space" = cte."Space"
-        WHERE coalesce("TotalSizeOfStoredImages", 0)       - coalesce("TotalSizeInImageStorageTable", 0)        != 0
-           OR coalesce("NumberOfStoredImages", 0)          - coalesce("NumberOfImagesInImageStorageTable", 0)   != 0
-           OR coalesce("TotalSizeOfThumbnails", 0)         - coalesce("TotalSizeOfThumbnailsInImageStorageTable", 0) != 0
-           OR coalesce("TotalSizeOfStoredAdjuncts", 0)     - coalesce("TotalAdjunctSizeInImageStorageTable", 0) != 0
-           OR coalesce("NumberOfStoredAdjuncts", 0)        - coalesce("NumberOfAdjunctsInAdjunctsTable", 0)     != 0
-        ORDER BY y."Customer", cte."Customer", y."Space", cte."Space";
-        """)
-
-    space_level_changes = cur.fetchall()
-
-    # Step 2: zero out CustomerStorage rows for spaces that no longer have any ImageStorage records.
-    # The upsert in step 1 only touches spaces that currently exist in ImageStorage, so a space
-    # whose last image was deleted would be silently skipped and retain stale non-zero totals.
-    # Adjunct columns are included: if all images are gone, adjuncts cannot exist either
-    # (adjuncts are always associated with an image). Any residual adjunct values are also zeroed.
-    # Only non-null spaces are considered — the NULL aggregate row is never written directly.
-    # The old values are captured via the to_zero CTE (which reads the pre-update snapshot) so
-    # they can be reported as deltas alongside the changes from step 1.
-    cur.execute("""
-        -- Identify non-null spaces with no remaining ImageStorage records.
-        WITH to_zero AS (
-            SELECT "Customer", "Space",
-                   "NumberOfStoredImages", "TotalSizeOfStoredImages", "TotalSizeOfThumbnails",
-                   "NumberOfStoredAdjuncts", "TotalSizeOfStoredAdjuncts"
-            FROM "CustomerStorage"
-            WHERE "Space" IS NOT NULL
-              AND NOT EXISTS (
-                SELECT 1 FROM "ImageStorage"
-                WHERE "ImageStorage"."Customer" = "CustomerStorage"."Customer"
-                  AND "ImageStorage"."Space" = "CustomerStorage"."Space"
-              )
-        ),
-        -- Zero out the identified rows and stamp LastCalculated.
-        -- Covers both non-zero rows (actual changes) and already-zero rows (e.g. space 0 with
-        -- no images/adjuncts) that are skipped by the step 1 upsert but still need LastCalculated
-        -- updated. The final SELECT filters to only rows with non-zero deltas for reporting.
-        zeroed AS (
-            UPDATE "CustomerStorage"
-            SET "NumberOfStoredImages"      = 0,
-                "TotalSizeOfStoredImages"   = 0,
-                "TotalSizeOfThumbnails"     = 0,
-                "NumberOfStoredAdjuncts"    = 0,
-                "TotalSizeOfStoredAdjuncts" = 0,
-                "LastCalculated"            = current_timestamp
-            FROM to_zero
-            WHERE "CustomerStorage"."Customer" = to_zero."Customer"
-              AND "CustomerStorage"."Space"    = to_zero."Space"
-        )
-        -- Return the old (pre-zero) values as deltas so they feed into CloudWatch metrics.
-        -- Rows already at zero are excluded — their delta is 0 so nothing meaningful to report.
-        SELECT "Customer",
-               "Space",
-               "TotalSizeOfStoredImages",
-               0 AS "TotalSizeInImageStorageTable",
-               "TotalSizeOfStoredImages"   AS "TotalSizeDelta",
-               "NumberOfStoredImages",
-               0 AS "NumberOfImagesInImageStorageTable",
-               "NumberOfStoredImages"      AS "NumberOfImagesDelta",
-               "TotalSizeOfThumbnails",
-               0 AS "TotalSizeOfThumbnailsInImageStorageTable",
-               "TotalSizeOfThumbnails"     AS "TotalSizeOfThumbnailsDelta",
-               "TotalSizeOfStoredAdjuncts",
-               0 AS "TotalAdjunctSizeInImageStorageTable",
-               "TotalSizeOfStoredAdjuncts" AS "TotalAdjunctSizeDelta",
-               "NumberOfStoredAdjuncts",
-               0 AS "NumberOfAdjunctsInAdjunctsTable",
-               "NumberOfStoredAdjuncts"    AS "NumberOfAdjunctsDelta"
-        FROM to_zero
-        WHERE "NumberOfStoredImages"    != 0
-           OR "TotalSizeOfStoredImages" != 0
-           OR "TotalSizeOfThumbnails"   != 0
-           OR "NumberOfStoredAdjuncts"  != 0
-           OR "TotalSizeOfStoredAdjuncts" != 0;
-        """)
-
-    zeroed_space_changes = cur.fetchall()
-    space_level_changes = list(space_level_changes) + list(zeroed_space_changes)
-
-    # Step 3: roll up all per-space totals into the NULL-space aggregate row for each customer.
-    # Space IS NULL is the customer-level aggregate (formerly space 0 prior to the
-    # StopSpaceZeroCustomerStorage migration). All non-null spaces — including space 0 which
-    # now tracks stub assets — are included in the sum.
-    cur.execute("""
+               y."TotalSizeOfStoredImages",
+               CASE WHEN cte."Customer" IS NULL THEN 0
+                    ELSE cte."TotalSizeInImageStorageTable" END AS "TotalSizeInImageStorageTable",
+               y."NumberOfStoredImages",
+               CASE WHEN cte."Customer" IS NULL THEN 0
+                    ELSE cte."NumberOfImagesInImageStorageTable" END AS "NumberOfImagesInImageStorageTable",
+               y."TotalSizeOfThumbnails",
+               CASE WHEN cte."Customer" IS NULL THEN 0
+                    ELSE cte."TotalSizeOfThumbnailsInImageStorageTable" END AS "TotalSizeOfThumbnailsInImageStorageTable",
+               y."TotalSizeOfStoredAdjuncts",
+               CASE WHEN cte."Customer" IS NULL THEN 0
+                    ELSE cte."TotalAdjunctSizeInImageStorageTable" END AS "TotalAdjunctSizeInImageStorageTable",
+               y."NumberOfStoredAdjuncts",
+               CASE WHEN cte."Customer" IS NULL THEN 0
+                    ELSE cte."NumberOfAdjunctsInAdjunctsTable" END AS "NumberOfAdjunctsInAdjunctsTable"
+        FROM (SELECT * FROM stored WHERE "InScope") AS y
+        FULL OUTER JOIN cte ON y."Customer" = cte."Customer" AND y."Space" = cte."Space"
+    ),
+    ins AS (
+        INSERT INTO "CustomerStorage"
+               ( "Customer", "StoragePolicy", "NumberOfStoredImages", "TotalSizeOfStoredImages",
+                 "TotalSizeOfThumbnails", "NumberOfStoredAdjuncts", "TotalSizeOfStoredAdjuncts",
+                 "LastCalculated", "Space" )
+               SELECT "CustomerInImageStorageTable", 'default', "NumberOfImagesInImageStorageTable", "TotalSizeInImageStorageTable",
+                      "TotalSizeOfThumbnailsInImageStorageTable", "NumberOfAdjunctsInAdjunctsTable", "TotalAdjunctSizeInImageStorageTable",
+                      current_timestamp, "SpaceInImageStorageTable"
+                FROM merged
+               WHERE "CustomerInImageStorageTable" IS NOT NULL
+               ON CONFLICT ("Customer", "Space") WHERE "Space" IS NOT NULL
+               DO UPDATE SET
+                   "Customer"                = excluded."Customer",
+                   "StoragePolicy"           = excluded."StoragePolicy",
+                   "NumberOfStoredImages"    = excluded."NumberOfStoredImages",
+                   "TotalSizeOfStoredImages" = excluded."TotalSizeOfStoredImages",
+                   "TotalSizeOfThumbnails"   = excluded."TotalSizeOfThumbnails",
+                   "NumberOfStoredAdjuncts"  = excluded."NumberOfStoredAdjuncts",
+                   "TotalSizeOfStoredAdjuncts" = excluded."TotalSizeOfStoredAdjuncts",
+                   "LastCalculated"          = excluded."LastCalculated",
+                   "Space"                   = excluded."Space"
+               WHERE NOT %(minimal_writes)s
+                  OR ("CustomerStorage"."StoragePolicy", "CustomerStorage"."NumberOfStoredImages",
+                      "CustomerStorage"."TotalSizeOfStoredImages", "CustomerStorage"."TotalSizeOfThumbnails",
+                      "CustomerStorage"."NumberOfStoredAdjuncts", "CustomerStorage"."TotalSizeOfStoredAdjuncts")
+                     IS DISTINCT FROM
+                     (excluded."StoragePolicy", excluded."NumberOfStoredImages",
+                      excluded."TotalSizeOfStoredImages", excluded."TotalSizeOfThumbnails",
+                      excluded."NumberOfStoredAdjuncts", excluded."TotalSizeOfStoredAdjuncts")
+    ),
+    zeroed AS (
+        UPDATE "CustomerStorage"
+        SET "NumberOfStoredImages"      = 0,
+            "TotalSizeOfStoredImages"   = 0,
+            "TotalSizeOfThumbnails"     = 0,
+            "NumberOfStoredAdjuncts"    = 0,
+            "TotalSizeOfStoredAdjuncts" = 0,
+            "LastCalculated"            = current_timestamp
+        FROM merged
+        WHERE "CustomerStorage"."Customer" = merged."Customer"
+          AND "CustomerStorage"."Space"    = merged."Space"
+          AND merged."CustomerInImageStorageTable" IS NULL
+          AND (NOT %(minimal_writes)s
+               OR merged."NumberOfStoredImages"    != 0
+               OR merged."TotalSizeOfStoredImages" != 0
+               OR merged."TotalSizeOfThumbnails"   != 0
+               OR merged."NumberOfStoredAdjuncts"  != 0
+               OR merged."TotalSizeOfStoredAdjuncts" != 0)
+    ),
+    rollup AS (
         UPDATE "CustomerStorage" AS cs
         SET "NumberOfStoredImages"      = numberOfImages,
             "TotalSizeOfStoredImages"   = totalImageSize,
@@ -295,37 +535,91 @@ def __run_sql(conn):
             "TotalSizeOfStoredAdjuncts" = totalAdjunctSize,
             "LastCalculated"            = current_timestamp
         FROM (
-            -- Sum every real space (non-null) per customer to produce the customer-wide totals.
             SELECT "Customer",
                    SUM("NumberOfStoredImages")      AS numberOfImages,
                    SUM("TotalSizeOfStoredImages")   AS totalImageSize,
                    SUM("TotalSizeOfThumbnails")     AS totalThumbnailSize,
                    SUM("NumberOfStoredAdjuncts")    AS numberOfAdjuncts,
                    SUM("TotalSizeOfStoredAdjuncts") AS totalAdjunctSize
-            FROM "CustomerStorage"
-            WHERE "Space" IS NOT NULL
+            FROM (
+                SELECT COALESCE("Customer", "CustomerInImageStorageTable") AS "Customer",
+                       "NumberOfImagesInImageStorageTable" AS "NumberOfStoredImages",
+                       "TotalSizeInImageStorageTable" AS "TotalSizeOfStoredImages",
+                       "TotalSizeOfThumbnailsInImageStorageTable" AS "TotalSizeOfThumbnails",
+                       "NumberOfAdjunctsInAdjunctsTable" AS "NumberOfStoredAdjuncts",
+                       "TotalAdjunctSizeInImageStorageTable" AS "TotalSizeOfStoredAdjuncts"
+                FROM merged
+                UNION ALL
+                SELECT "Customer", "NumberOfStoredImages", "TotalSizeOfStoredImages", "TotalSizeOfThumbnails",
+                       "NumberOfStoredAdjuncts", "TotalSizeOfStoredAdjuncts"
+                FROM stored
+                WHERE NOT "InScope"
+            ) AS spaces
             GROUP BY "Customer"
-            ORDER BY "Customer"
         ) AS vals
-        -- Write the aggregated totals into the NULL-space row for this customer.
-        WHERE cs."Customer" = vals."Customer" AND "Space" IS NULL;
-    """)
+        WHERE cs."Customer" = vals."Customer" AND "Space" IS NULL
+    )
+    SELECT "Customer",
+           "CustomerInImageStorageTable",
+           "Space",
+           "SpaceInImageStorageTable",
+           "TotalSizeOfStoredImages",
+           "TotalSizeInImageStorageTable",
+           coalesce("TotalSizeOfStoredImages", 0) - coalesce("TotalSizeInImageStorageTable", 0) AS "TotalSizeDelta",
+           "NumberOfStoredImages",
+           "NumberOfImagesInImageStorageTable",
+           coalesce("NumberOfStoredImages", 0) - coalesce("NumberOfImagesInImageStorageTable", 0) AS "NumberOfImagesDelta",
+           "TotalSizeOfThumbnails",
+           "TotalSizeOfThumbnailsInImageStorageTable",
+           coalesce("TotalSizeOfThumbnails", 0) - coalesce("TotalSizeOfThumbnailsInImageStorageTable", 0) AS "TotalSizeOfThumbnailsDelta",
+           "TotalSizeOfStoredAdjuncts",
+           "TotalAdjunctSizeInImageStorageTable",
+           coalesce("TotalSizeOfStoredAdjuncts", 0) - coalesce("TotalAdjunctSizeInImageStorageTable", 0) AS "TotalAdjunctSizeDelta",
+           "NumberOfStoredAdjuncts",
+           "NumberOfAdjunctsInAdjunctsTable",
+           coalesce("NumberOfStoredAdjuncts", 0) - coalesce("NumberOfAdjunctsInAdjunctsTable", 0) AS "NumberOfAdjunctsDelta"
+    FROM merged
+    WHERE coalesce("TotalSizeOfStoredImages", 0)       - coalesce("TotalSizeInImageStorageTable", 0)        != 0
+       OR coalesce("NumberOfStoredImages", 0)          - coalesce("NumberOfImagesInImageStorageTable", 0)   != 0
+       OR coalesce("TotalSizeOfThumbnails", 0)         - coalesce("TotalSizeOfThumbnailsInImageStorageTable", 0) != 0
+       OR coalesce("TotalSizeOfStoredAdjuncts", 0)     - coalesce("TotalAdjunctSizeInImageStorageTable", 0) != 0
+       OR coalesce("NumberOfStoredAdjuncts", 0)        - coalesce("NumberOfAdjunctsInAdjunctsTable", 0)     != 0
+    ORDER BY "CustomerInImageStorageTable" IS NULL, "Customer", "CustomerInImageStorageTable", "Space",
+             "SpaceInImageStorageTable";
+    """
+
+
+def __write(run_phase, space_totals_query):
+    space_totals_query = __get_bigint_space_totals_query(space_totals_query)
+    if FUSED_RECALCULATION:
+        run_phase("FusedRecalculation", "CustomerStorage", FUSED_QUERY.format(space_totals=space_totals_query),
+                  deltas="space_changes", get_delta=__get_space_change)
+        return
 
-    records = {
-        "spaceChanges": space_level_changes
-    }
+    run_phase("SpaceUpsert", "CustomerStorage", SPACE_UPSERT_QUERY.format(space_totals=space_totals_query),
+              deltas="space_changes")
+    run_phase("SpaceZeroOut", "CustomerStorage", ZERO_OUT_QUERY, deltas="zeroed_space_changes")
+    run_phase("CustomerRollup", "CustomerStorage", ROLLUP_QUERY)
 
-    logger.info(records)
 
-    if DRY_RUN:
-        logger.info(f"DRY RUN ENABLED. Changes have not been committed to the database")
-    else:
-        conn.commit()
+def __get_space_change(row):
+    # zeroed out spaces are returned without the ImageStorage customer and space, as by step 2
+    if row["CustomerInImageStorageTable"] is None:
+        return {column: value for column, value in row.items()
+                if column not in ("CustomerInImageStorageTable", "SpaceInImageStorageTable")}
+    return row
 
-    cur.close()
 
-    return records
+RECALCULATION = register_recalculation(Recalculation(
+    RECALCULATOR_NAME, base_tables=["ImageStorage", "Adjuncts"], target_tables=["CustomerStorage"],
+    listen_sources=LISTEN_SOURCES, customer_tables=CUSTOMER_TABLES, partitioned_table="ImageStorage",
+    required_indexes=REQUIRED_INDEXES, get_aggregate_query=__get_aggregate_query,
+    aggregate_columns=SPACE_TOTAL_COLUMNS, aggregate_keys=("Customer", "Space"), aggregate_phase="SpaceAggregate",
+    cache_table=AGGREGATE_CACHE_TABLE, change_log_sources=CHANGE_LOG_SOURCES, incremental=True, write=__write,
+    verify_sample_query=VERIFY_SAMPLE_QUERY, verify_query=VERIFY_QUERY, customer_spaces_query=CUSTOMER_SPACES_QUERY,
+    records_prefix="spaceChange", delta_name="space delta", delta_output_columns=DELTA_OUTPUT_COLUMNS,
+    get_delta_totals=get_space_change_totals, get_delta_key=__get_space_key, get_delta_metrics=__get_delta_metrics))
 
 
 if __name__ == "__main__":
-    run_cleanup()
\ No newline at end of file
+    run_service(run_cleanup, LISTEN_SOURCES, "Recalculate customer storage")
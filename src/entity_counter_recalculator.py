@@ -1,138 +1,202 @@
-import psycopg2
-from psycopg2 import extras
+from app.entity_counter_recalculator_settings import (CLOUDWATCH_SPACE_DELETE_METRIC_NAME,
+                                                      CLOUDWATCH_SPACE_DIFFERENCE_METRIC_NAME)
+from app.preflight import required_index
+from app.recalculation import run_recalculation, run_service, publish_metrics
+from app.registry import Recalculation, register_recalculation
 
-from logzero import logger
-from app.entity_counter_recalculator_settings import (DRY_RUN, ENABLE_CLOUDWATCH_INTEGRATION,
-                                                      CLOUDWATCH_SPACE_DELETE_METRIC_NAME,
-                                                      CLOUDWATCH_SPACE_DIFFERENCE_METRIC_NAME,
-                                                      APP_VERSION, REGION,
-                                                      CONNECTION_TIMEOUT, CONNECTION_STRING)
-from app.aws_factory import get_aws_client
-from app.database import connect_to_postgres, get_connection_config
 
+def run_cleanup(conn=None, cloudwatch=None, spaces=None, customers=None, connection_info=None):
+    """Recalculate entity counters, or only the given (customer, space) pairs when spaces is set, or only the
+    customers in the given inclusive (customer_from, customer_to) ranges when customers is set.
+    See app/recalculation.py for the run itself, which writes the SQL below"""
+    return run_recalculation(RECALCULATION, conn=conn, cloudwatch=cloudwatch, spaces=spaces, customers=customers,
+                             connection_info=connection_info)
 
-def run_cleanup():
-    logger.info("Running entity counter recalculator")
-    connection_info = get_connection_config(CONNECTION_STRING)
-    conn = connect_to_postgres(connection_info=connection_info,connection_timeout=CONNECTION_TIMEOUT)
-    records = __run_sql(conn)
 
-    if ENABLE_CLOUDWATCH_INTEGRATION:
-        logger.info("CloudWatch metrics enabled")
-        cloudwatch = get_aws_client(resource_type="cloudwatch", region=REGION)
-        set_cloudwatch_metrics(records, cloudwatch, connection_info)
-
-    conn.close()
-    logger.info("Entity counter recalculator complete")
-
-    return records
+def set_cloudwatch_metrics(records, cloudwatch, connection_info):
+    return publish_metrics(RECALCULATION, records, cloudwatch, connection_info)
 
 
-def set_cloudwatch_metrics(records, cloudwatch, connection_info):
-    metric_data = []
-    dimensions = [{
-                    'Name': "DATABASE_NAME",
-                    'Value': connection_info["database"]
-                },
-                {
-                    'Name': "APP_VERSION",
-                    'Value': APP_VERSION
-                },
-                {
-                    'Name': "RECALCULATOR_NAME",
-                    'Value': "entity_counter_recalculator"
-                }]
-
-    space_delta = 0
-    space_deletes_needed = 0
-
-    for key in records["spaceImages"]:
-        logger.info(f"Space images delta - {key}")
+def get_space_image_totals(space_images, totals=None):
+    """Sum the absolute space image deltas and count the spaces with no images left, optionally adding to
+    existing totals"""
+    totals = totals if totals is not None else {"delta": 0, "deletesNeeded": 0}
+    for key in space_images:
         if key["delta"] is not None:
-            space_delta += abs(key["delta"])
+            totals["delta"] += abs(key["delta"])
         else:
-            space_deletes_needed += 1
-
-    metric_data.extend([
-        {
-            'MetricName': CLOUDWATCH_SPACE_DIFFERENCE_METRIC_NAME,
-            'Dimensions': dimensions,
-            'Unit': 'Count',
-            'Value': space_delta
-        },
-        {
-            'MetricName': CLOUDWATCH_SPACE_DELETE_METRIC_NAME,
-            'Dimensions': dimensions,
-            'Unit': 'Count',
-            'Value': space_deletes_needed
-        }
-    ])
-
-    try:
-        logger.debug(f"Publishing CloudWatch metrics - {metric_data}")
-        cloudwatch.put_metric_data(MetricData=metric_data,
-                                   Namespace='Protagonist Recalculator')
-        return metric_data
-    except Exception as e:
-        logger.exception(f"Error publishing to CloudWatch")
-        raise e
-
-
-def __run_sql(conn):
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    # update space images
-    cur.execute("""
-        WITH cte AS (
-        SELECT 'space-images', x.space, x.count::bigint, x.customer
-            FROM (SELECT count(*) as count, "Space" as space, "Customer" as customer
+            totals["deletesNeeded"] += 1
+    return totals
+
+
+def __get_space_key(row):
+    return row["Customer"], row["Scope"]
+
+
+def __get_delta_metrics():
+    # read when the metrics are published, so each total is published under the metric name set at the time
+    return [
+        ("delta", CLOUDWATCH_SPACE_DIFFERENCE_METRIC_NAME, 'Count'),
+        ("deletesNeeded", CLOUDWATCH_SPACE_DELETE_METRIC_NAME, 'Count')
+    ]
+
+
+RECALCULATOR_NAME = "entity_counter_recalculator"
+# The columns of a space images delta row, in the order they are written to DELTA_OUTPUT_FILE
+DELTA_OUTPUT_COLUMNS = ["Customer", "space", "Scope", "count", "Next", "delta"]
+LISTEN_SOURCES = ["Images"]
+CUSTOMER_TABLES = ["Images", "EntityCounters"]
+# Sources the aggregate cache is refreshed from; sql/create_aggregate_cache.sql logs changes to "Images"
+CHANGE_LOG_SOURCES = ["Images"]
+AGGREGATE_CACHE_TABLE = "EntityCounterSpaceAggregates"
+# Indexes the recalculation relies on, checked before a run with INDEX_PREFLIGHT set
+REQUIRED_INDEXES = [
+    # counting the images of each space of a customer range
+    required_index("IX_Images_Customer_Space", "Images", ['"Customer"', '"Space"'],
+                   'SELECT 1 FROM "Images" WHERE "Customer" = 1 AND "Space" = 1'),
+    # reading the space-images counters of a customer range
+    required_index("IX_EntityCounters_Type_Customer_Scope", "EntityCounters", ['"Type"', '"Customer"', '"Scope"'],
+                   'SELECT 1 FROM "EntityCounters" WHERE "Type" = \'space-images\' AND "Customer" = 1'),
+    # the rollup, which finds each customer-images counter by its Scope as a customer id
+    required_index("IX_EntityCounters_CustomerImages_Scope", "EntityCounters", ['("Scope"::integer)'],
+                   'SELECT 1 FROM "EntityCounters" WHERE "Type" = \'customer-images\' AND "Scope"::INT = 1',
+                   where='"Type"::text = \'customer-images\'::text'),
+]
+
+
+# Verify mode samples spaces from both sides, so spaces without a counter and counters for spaces that no longer
+# have any images can both be picked. TABLESAMPLE SYSTEM reads just the sampled pages of each table.
+VERIFY_SAMPLE_QUERY = """
+    SELECT "Customer", "Space" FROM "Images" TABLESAMPLE SYSTEM (%(percent)s)
+    UNION
+    SELECT "Customer", "Scope"::int FROM "EntityCounters" TABLESAMPLE SYSTEM (%(percent)s)
+    WHERE "Type" = 'space-images'
+    ORDER BY 1, 2;
+    """
+# A customer looks inconsistent when one of its sampled space counters differs from a fresh count of its
+# images, or when its customer-images counter does not add up to its space-images counters.
+VERIFY_QUERY = """
+    WITH counts AS ({aggregates}),
+    stored AS (
+        SELECT "Customer", "Scope", "Next"
+        FROM "EntityCounters"
+        WHERE "Type" = 'space-images'
+          AND ("Customer", "Scope") IN (SELECT customer, space::varchar
+                                        FROM unnest(%(space_customers)s::int[], %(space_spaces)s::int[])
+                                             AS spaces (customer, space))
+    )
+    SELECT COALESCE(stored."Customer", counts.customer) AS "Customer"
+    FROM stored
+    FULL OUTER JOIN counts ON stored."Customer" = counts.customer AND stored."Scope" = counts.space::varchar
+    WHERE coalesce(stored."Next", 0) != coalesce(counts.count, 0)
+    UNION
+    SELECT vals."Customer"
+    FROM "EntityCounters" AS ec
+    JOIN (SELECT SUM("Next") AS totalImages, "Customer"
+          FROM "EntityCounters"
+          WHERE "Type" = 'space-images'
+          GROUP BY "Customer") AS vals
+      ON ec."Type" = 'customer-images' AND ec."Scope"::INT = vals."Customer"
+    WHERE ec."Next" != vals.totalImages
+    ORDER BY 1;
+    """
+CUSTOMER_SPACES_QUERY = """
+    SELECT "Customer", "Space" FROM "Images" WHERE "Customer" = ANY(%(customers)s)
+    UNION
+    SELECT "Customer", "Scope"::int FROM "EntityCounters"
+    WHERE "Type" = 'space-images' AND "Customer" = ANY(%(customers)s)
+    ORDER BY 1, 2;
+    """
+
+
+SPACE_COUNT_COLUMNS = "count bigint, space integer, customer integer"
+SPACE_COUNTS_QUERY = """
+        SELECT count(*) as count, "Space" as space, "Customer" as customer
               FROM "Images"
+              WHERE "Customer" BETWEEN %(customer_from)s AND %(customer_to)s
+                AND (%(customers)s::int[] IS NULL OR "Customer" = ANY(%(customers)s::int[]))
+                AND (%(customer_froms)s::int[] IS NULL
+                     OR EXISTS (SELECT FROM unnest(%(customer_froms)s::int[], %(customer_tos)s::int[]) AS r(f, t)
+                                WHERE "Customer" BETWEEN r.f AND r.t))
+                AND (%(space_customers)s::int[] IS NULL
+                     OR ("Customer", "Space") IN (SELECT * FROM unnest(%(space_customers)s::int[], %(space_spaces)s::int[])))
               GROUP BY customer, space
-              ORDER BY customer, space) as x), ins as
-                  (
-        INSERT INTO "EntityCounters" ("Type", "Scope", "Next", "Customer")
-        SELECT 'space-images', cte.space, cte.count::bigint, cte.customer
-        FROM cte
-        ON CONFLICT ("Type", "Scope", "Customer")
-        DO UPDATE SET ("Type", "Scope", "Next", "Customer")  =
-            ROW (excluded."Type", excluded."Scope", excluded."Next", excluded."Customer")
-        RETURNING *)
-        -- selects with `with` execute on snapshots, so changes from the upsert aren't seen here.
-        -- See https://www.postgresql.org/docs/11/queries-with.html
-        SELECT "Customer", "space","Scope", count, "Next", count - "Next" as delta
-        FROM "EntityCounters" as y
-          LEFT OUTER JOIN cte ON cte.customer = y."Customer" and cte.space::varchar = y."Scope"
-            where y."Type" = 'space-images' and coalesce(count - "Next", -1) != 0
-             order by "Customer", "Scope";
-        """)
-
-    space_image_changes = cur.fetchall()
-
-    cur.execute("""
-        UPDATE "EntityCounters" as ec
-        SET "Next" = totalImages
-        FROM (select SUM("Next") AS totalImages,
-                     "Customer"
-            from "EntityCounters"
-            where "Type" = 'space-images'
-            group by "Customer") AS vals
-        WHERE ec."Type" = 'customer-images' and ec."Scope"::INT = vals."Customer";
-    """)
-
-    records = {
-        "spaceImages": space_image_changes}
-
-    logger.info(records)
-
-    if DRY_RUN:
-        logger.info(f"DRY RUN ENABLED. Changes have not been committed to the database")
-    else:
-        conn.commit()
-
-    cur.close()
-
-    return records
+              ORDER BY customer, space
+        """
+
+
+# update space images
+# with MINIMAL_WRITES, counters that already hold the right value are not rewritten
+SPACE_IMAGES_QUERY = """
+    WITH cte AS (
+    SELECT 'space-images', x.space, x.count::bigint, x.customer
+        FROM ({space_counts}) as x), ins as
+              (
+    INSERT INTO "EntityCounters" ("Type", "Scope", "Next", "Customer")
+    SELECT 'space-images', cte.space, cte.count::bigint, cte.customer
+    FROM cte
+    ON CONFLICT ("Type", "Scope", "Customer")
+    DO UPDATE SET ("Type", "Scope", "Next", "Customer")  =
+        ROW (excluded."Type", excluded."Scope", excluded."Next", excluded."Customer")
+    WHERE NOT %(minimal_writes)s OR "EntityCounters"."Next" IS DISTINCT FROM excluded."Next"
+    RETURNING *)
+    -- selects with `with` execute on snapshots, so changes from the upsert aren't seen here.
+    -- See https://www.postgresql.org/docs/11/queries-with.html
+    SELECT "Customer", "space","Scope", count, "Next", count - "Next" as delta
+    FROM "EntityCounters" as y
+      LEFT OUTER JOIN cte ON cte.customer = y."Customer" and cte.space::varchar = y."Scope"
+        where y."Type" = 'space-images' and coalesce(count - "Next", -1) != 0
+          and y."Customer" BETWEEN %(customer_from)s AND %(customer_to)s
+          and (%(customers)s::int[] IS NULL OR y."Customer" = ANY(%(customers)s::int[]))
+          and (%(customer_froms)s::int[] IS NULL
+               OR EXISTS (SELECT FROM unnest(%(customer_froms)s::int[], %(customer_tos)s::int[]) AS r(f, t)
+                          WHERE y."Customer" BETWEEN r.f AND r.t))
+          and (%(space_customers)s::int[] IS NULL
+               OR (y."Customer", y."Scope") IN (SELECT customer, space::varchar
+                                               FROM unnest(%(space_customers)s::int[], %(space_spaces)s::int[])
+                                                    AS spaces (customer, space)))
+         order by "Customer", "Scope";
+    """
+
+CUSTOMER_IMAGES_QUERY = """
+    UPDATE "EntityCounters" as ec
+    SET "Next" = totalImages
+    FROM (select SUM("Next") AS totalImages,
+                 "Customer"
+        from "EntityCounters"
+        where "Type" = 'space-images'
+          and "Customer" BETWEEN %(customer_from)s AND %(customer_to)s
+          and (%(customers)s::int[] IS NULL OR "Customer" = ANY(%(customers)s::int[]))
+          and (%(customer_froms)s::int[] IS NULL
+               OR EXISTS (SELECT FROM unnest(%(customer_froms)s::int[], %(customer_tos)s::int[]) AS r(f, t)
+                          WHERE "Customer" BETWEEN r.f AND r.t))
+          and (%(space_customers)s::int[] IS NULL OR "Customer" = ANY(%(space_customers)s::int[]))
+        group by "Customer") AS vals
+    WHERE ec."Type" = 'customer-images' and ec."Scope"::INT = vals."Customer"
+      and (NOT %(minimal_writes)s OR ec."Next" IS DISTINCT FROM totalImages);
+"""
+
+
+def __get_aggregate_query(conn):
+    return SPACE_COUNTS_QUERY
+
+
+def __write(run_phase, space_counts_query):
+    run_phase("SpaceImagesUpsert", "EntityCounters", SPACE_IMAGES_QUERY.format(space_counts=space_counts_query),
+              deltas="space_image_changes")
+    run_phase("CustomerImagesRollup", "EntityCounters", CUSTOMER_IMAGES_QUERY)
+
+
+RECALCULATION = register_recalculation(Recalculation(
+    RECALCULATOR_NAME, base_tables=["Images"], target_tables=["EntityCounters"], listen_sources=LISTEN_SOURCES,
+    customer_tables=CUSTOMER_TABLES, partitioned_table="Images", required_indexes=REQUIRED_INDEXES,
+    get_aggregate_query=__get_aggregate_query, aggregate_columns=SPACE_COUNT_COLUMNS,
+    aggregate_keys=("customer", "space"), aggregate_phase="SpaceImagesAggregate", cache_table=AGGREGATE_CACHE_TABLE,
+    change_log_sources=CHANGE_LOG_SOURCES, write=__write, verify_sample_query=VERIFY_SAMPLE_QUERY,
+    verify_query=VERIFY_QUERY, customer_spaces_query=CUSTOMER_SPACES_QUERY, records_prefix="spaceImage",
+    delta_name="space images delta", delta_output_columns=DELTA_OUTPUT_COLUMNS,
+    get_delta_totals=get_space_image_totals, get_delta_key=__get_space_key, get_delta_metrics=__get_delta_metrics))
 
 
 if __name__ == "__main__":
-    run_cleanup()
+    run_service(run_cleanup, LISTEN_SOURCES, "Recalculate entity counters")
@@ -0,0 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from logzero import logger
+
+from app.recalculator_settings import (CONNECTION_STRING, CONNECTION_TIMEOUT, ENABLE_CLOUDWATCH_INTEGRATION, REGION,
+                                       RECALCULATIONS, DAEMON, DAEMON_INTERVAL_SECONDS, LISTEN, LISTEN_CHANNEL,
+                                       LISTEN_DEBOUNCE_SECONDS, CUSTOMERS, SPACES, CONNECTION_STRINGS,
+                                       DATABASE_PARALLELISM, REPLICA_CONNECTION_STRING, DELTA_OUTPUT_FILE)
+from app.aws_factory import get_aws_client
+from app.daemon import run_daemon
+from app.database import connect_to_postgres, get_connection_config, end_transaction
+from app.listener import run_listener
+from app.recalculation import run_recalculation
+from app.registry import get_recalculations, get_listen_sources
+from app.targets import get_targets
+
+# importing the recalculators registers them
+import customer_storage_recalculator
+import entity_counter_recalculator
+
+
+def run_cleanup(conn=None, cloudwatch=None, spaces=None, customers=None, connection_info=None):
+    """Run each recalculation named in RECALCULATIONS (or every registered one) over one connection and CloudWatch
+    client, and return their records by name. Only the given (customer, space) pairs are recalculated when spaces
+    is set, and only the customers in the given (customer_from, customer_to) ranges when customers is set.
+    connection_info, when given, is the database recalculated in place of CONNECTION_STRING's.
+
+    A recalculation that fails is logged and its transaction rolled back, and the remaining ones still run; the
+    first failure is raised once they have all finished."""
+    recalculations = get_recalculations(RECALCULATIONS)
+    connection_info = connection_info or get_connection_config(CONNECTION_STRING)
+    logger.info(f"Running recalculations {[recalculation.name for recalculation in recalculations]} on "
+                f"{connection_info['database']}")
+    own_connection = conn is None
+    if own_connection:
+        conn = connect_to_postgres(connection_info=connection_info, connection_timeout=CONNECTION_TIMEOUT)
+    if ENABLE_CLOUDWATCH_INTEGRATION:
+        cloudwatch = cloudwatch or get_aws_client(resource_type="cloudwatch", region=REGION)
+
+    records = {}
+    failure = None
+    try:
+        for recalculation in recalculations:
+            try:
+                records[recalculation.name] = run_recalculation(recalculation, conn=conn, cloudwatch=cloudwatch,
+                                                                   spaces=spaces, customers=customers,
+                                                                   connection_info=connection_info)
+            except Exception as e:
+                logger.exception(f"Recalculation {recalculation.name} failed")
+                end_transaction(conn)
+                failure = failure or e
+    finally:
+        if own_connection:
+            conn.close()
+
+    if failure is not None:
+        raise failure
+    logger.info("Recalculations complete")
+
+    return records
+
+
+def run_databases(cloudwatch=None, spaces=None, customers=None):
+    """Run the recalculations (see run_cleanup) on every database in CONNECTION_STRINGS, up to DATABASE_PARALLELISM
+    of them at the same time, each over its own connection, and return their records by database name.
+    Every database's metrics are published through one CloudWatch client, with its own DATABASE_NAME dimension.
+
+    A database that cannot be connected to, or whose recalculations fail, is logged and the others still run; the
+    first failure is raised once they have all finished."""
+    connection_infos = [get_connection_config(connection_string) for connection_string in CONNECTION_STRINGS]
+    databases = [connection_info["database"] for connection_info in connection_infos]
+    repeated = sorted({database for database in databases if databases.count(database) > 1})
+    if repeated:
+        raise ValueError(f"Databases {repeated} are listed more than once in CONNECTION_STRINGS, so their metrics "
+                         f"could not be told apart")
+    if REPLICA_CONNECTION_STRING:
+        raise ValueError("REPLICA_CONNECTION_STRING is the replica of a single database, and cannot be used with "
+                         "CONNECTION_STRINGS")
+    if DELTA_OUTPUT_FILE and "{database}" not in DELTA_OUTPUT_FILE:
+        raise ValueError("DELTA_OUTPUT_FILE needs a {database} placeholder when used with CONNECTION_STRINGS")
+    if ENABLE_CLOUDWATCH_INTEGRATION:
+        cloudwatch = cloudwatch or get_aws_client(resource_type="cloudwatch", region=REGION)
+
+    def run_database(connection_info):
+        try:
+            return run_cleanup(cloudwatch=cloudwatch, spaces=spaces, customers=customers,
+                               connection_info=connection_info), None
+        except Exception as e:
+            logger.exception(f"Recalculating database {connection_info['database']} failed")
+            return None, e
+
+    workers = max(1, min(DATABASE_PARALLELISM, len(connection_infos)))
+    logger.info(f"Recalculating databases {databases}, {workers} at a time")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run_database, connection_infos))
+
+    failures = [failure for _, failure in results if failure is not None]
+    if failures:
+        logger.error(f"{len(failures)} of {len(databases)} databases failed")
+        raise failures[0]
+    logger.info("Databases complete")
+
+    return {database: records for database, (records, _) in zip(databases, results)}
+
+
+if __name__ == "__main__":
+    if LISTEN:
+        run_listener(run_cleanup, get_connection_config(CONNECTION_STRING), CONNECTION_TIMEOUT, LISTEN_CHANNEL,
+                     get_listen_sources(get_recalculations(RECALCULATIONS)), LISTEN_DEBOUNCE_SECONDS,
+                     get_aws_client(resource_type="cloudwatch", region=REGION) if ENABLE_CLOUDWATCH_INTEGRATION else None)
+    elif DAEMON:
+        run_daemon(run_cleanup, get_connection_config(CONNECTION_STRING), CONNECTION_TIMEOUT, DAEMON_INTERVAL_SECONDS,
+                   get_aws_client(resource_type="cloudwatch", region=REGION) if ENABLE_CLOUDWATCH_INTEGRATION else None)
+    elif CONNECTION_STRINGS:
+        run_databases(**get_targets("Run the registered recalculations", CUSTOMERS, SPACES))
+    else:
+        run_cleanup(**get_targets("Run the registered recalculations", CUSTOMERS, SPACES))
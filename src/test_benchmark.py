@@ -0,0 +1,57 @@
+import os
+import unittest
+
+from unittest import mock
+
+import app.recalculation
+import customer_storage_recalculator
+from benchmark.__main__ import main
+
+CONNECTION_STRING = "postgresql://postgres@localhost:55432/postgres"
+
+
+@mock.patch("benchmark.__main__.restore_drifted_tables")
+@mock.patch("benchmark.__main__.generate")
+@mock.patch("benchmark.__main__.create_schema")
+@mock.patch("benchmark.__main__.connect_to_postgres")
+@mock.patch("app.recalculation.DRY_RUN", True)
+@mock.patch("app.recalculation.ENABLE_CLOUDWATCH_INTEGRATION", True)
+@mock.patch("app.recalculation.PARALLELISM", 1)
+@mock.patch("customer_storage_recalculator.FUSED_RECALCULATION", False)
+class TestBenchmark(unittest.TestCase):
+
+    @mock.patch("customer_storage_recalculator.run_cleanup")
+    def test_settings_are_overridden_where_they_are_read(self, mock_run_cleanup, mock_connect, *_):
+        mock_connect.return_value.cursor.return_value.fetchone.return_value = (0, 0)
+        settings = {}
+
+        def run_cleanup(connection_info):
+            settings.update(parallelism=app.recalculation.PARALLELISM,
+                            fused=customer_storage_recalculator.FUSED_RECALCULATION,
+                            dry_run=app.recalculation.DRY_RUN,
+                            cloudwatch=app.recalculation.ENABLE_CLOUDWATCH_INTEGRATION)
+            return {"spaceChanges": [{}], "phases": {}}
+        mock_run_cleanup.side_effect = run_cleanup
+
+        with mock.patch("sys.argv", ["benchmark", "--connection-string", CONNECTION_STRING,
+                                     "--recalculator", "customer_storage_recalculator",
+                                     "--setting", "PARALLELISM=3", "--setting", "FUSED_RECALCULATION=true"]):
+            main()
+
+        self.assertEqual(settings, {"parallelism": 3, "fused": True, "dry_run": False, "cloudwatch": False})
+        mock_run_cleanup.assert_called_once_with(connection_info={
+            "database": f"recalculator_benchmark_{os.getpid()}", "user": "postgres", "password": None,
+            "host": "localhost", "port": 55432})
+
+    def test_unknown_settings_are_an_error(self, mock_connect, *_):
+        with mock.patch("sys.argv", ["benchmark", "--connection-string", CONNECTION_STRING,
+                                     "--recalculator", "entity_counter_recalculator",
+                                     "--setting", "FUSED_RECALCULATION=true"]):
+            with self.assertRaises(ValueError):
+                main()
+
+        mock_connect.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+
+from unittest import mock
+
+from psycopg2 import sql
+
+from app.staging import create_staging_table, copy_query_result
+
+ROWS = b"1\t2\t300\n1\t3\t400\n"
+
+
+class TestStaging(unittest.TestCase):
+
+    def test_staging_table_is_created_with_the_given_columns_and_dropped_on_commit(self):
+        cur = mock.MagicMock()
+
+        create_staging_table(cur, "replica_space_totals", '"Customer" integer, "Space" integer')
+
+        cur.execute.assert_called_once_with(sql.Composed([
+            sql.SQL("CREATE TEMP TABLE "), sql.Identifier("replica_space_totals"), sql.SQL(" ("),
+            sql.SQL('"Customer" integer, "Space" integer'), sql.SQL(") ON COMMIT DROP;")]))
+
+    def test_query_result_is_copied_into_the_staging_table(self):
+        source_cur = mock.MagicMock()
+        source_cur.mogrify.return_value = b"COPY (SELECT 1 WHERE 2 = 2) TO STDOUT"
+        source_cur.copy_expert.side_effect = lambda query, buffer: buffer.write(ROWS)
+        cur = mock.MagicMock(rowcount=2)
+        copied = []
+        cur.copy_expert.side_effect = lambda query, buffer: copied.append(buffer.read())
+
+        rows = copy_query_result(source_cur, "SELECT 1 WHERE 2 = %(two)s", {"two": 2}, cur, "replica_space_totals")
+
+        self.assertEqual(rows, 2)
+        source_cur.mogrify.assert_called_once_with("COPY (SELECT 1 WHERE 2 = %(two)s) TO STDOUT", {"two": 2})
+        source_cur.copy_expert.assert_called_once_with("COPY (SELECT 1 WHERE 2 = 2) TO STDOUT", mock.ANY)
+        cur.copy_expert.assert_called_once_with(
+            sql.Composed([sql.SQL("COPY "), sql.Identifier("replica_space_totals"), sql.SQL(" FROM STDIN")]), mock.ANY)
+        self.assertEqual(copied, [ROWS])
+
+    @mock.patch("app.staging.SPOOL_MAX_BYTES", len(ROWS) - 1)
+    def test_copy_data_larger_than_the_spool_limit_is_spooled_to_disk(self):
+        source_cur = mock.MagicMock()
+        source_cur.mogrify.return_value = b"COPY (SELECT 1) TO STDOUT"
+        source_cur.copy_expert.side_effect = lambda query, buffer: buffer.write(ROWS)
+        cur = mock.MagicMock()
+        spooled = []
+        cur.copy_expert.side_effect = lambda query, buffer: spooled.append((buffer._rolled, buffer.read()))
+
+        copy_query_result(source_cur, "SELECT 1", {}, cur, "replica_space_totals")
+
+        self.assertEqual(spooled, [(True, ROWS)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import os
+import unittest
+
+from benchmark.startup import ENTRY_POINTS, measure_startup
+
+# The startup times depend on the machine, so they are only checked with STARTUP_BENCHMARK set. The budgets are for
+# the best of STARTUP_RUNS runs of each entry point, which take ~0.1s today, and can be raised for slower machines
+# through the environment. Going over them most likely means a heavy module is imported at startup again.
+STARTUP_BENCHMARK = os.environ.get("STARTUP_BENCHMARK", "False").lower() in ("true", "1")
+STARTUP_RUNS = 3
+IMPORT_BUDGET_SECONDS = float(os.environ.get("STARTUP_IMPORT_BUDGET_SECONDS", "2"))
+FIRST_QUERY_BUDGET_SECONDS = float(os.environ.get("STARTUP_FIRST_QUERY_BUDGET_SECONDS", "3"))
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_entry_points_do_not_load_aws_without_cloudwatch(self):
+        for entry_point in ENTRY_POINTS:
+            with self.subTest(entry_point=entry_point):
+                self.assertEqual(measure_startup(entry_point, 1)["awsModules"], [])
+
+    @unittest.skipUnless(STARTUP_BENCHMARK, "set STARTUP_BENCHMARK=True to check the startup budgets")
+    def test_entry_points_start_within_budget(self):
+        for entry_point in ENTRY_POINTS:
+            with self.subTest(entry_point=entry_point):
+                startup = measure_startup(entry_point, STARTUP_RUNS)
+
+                self.assertLess(startup["importSeconds"], IMPORT_BUDGET_SECONDS, startup)
+                self.assertLess(startup["firstQuerySeconds"], FIRST_QUERY_BUDGET_SECONDS, startup)
+
+
+if __name__ == '__main__':
+    unittest.main()